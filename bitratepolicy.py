@@ -0,0 +1,73 @@
+import os
+import time
+
+from metrics import REGISTRY
+
+BITRATE_CHANGES = REGISTRY.counter('jellychord_bitrate_changes_total', 'Steps taken on the bitrate ladder', ('direction',))
+
+DEFAULT_LADDER = (64000, 96000, 128000, 192000, 256000, 384000)
+
+# Load average per CPU, 0 where the platform has none
+def cpuLoad() -> float:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return 0.0
+
+# Picks the bitrate tracks are requested at from a ladder
+# The channel bitrate caps the rung, pressure on the host or Jellyfin moves every guild down one rung per new track
+# Pressure is over a limit, relief is under half of every limit, and the rung changes at most once per hold period
+class BitratePolicy():
+    def __init__(self, client, ladder: list[int] = DEFAULT_LADDER, segmentLatency: float = 2,
+                 jfLatency: float = 1, cpuBudget: float = 0.8, hold: float = 30) -> None:
+        self.client = client
+        self.ladder = sorted(set(ladder))
+        self.limits = {'segment-latency': segmentLatency, 'jf-latency': jfLatency, 'cpu-load': cpuBudget}
+        self.hold = hold
+        # rungs below the channel's cap
+        self.step = 0
+        self.changedAt = 0
+
+    def measurements(self) -> dict:
+        return {
+            'segment-latency': self.client.streamLatency,
+            'jf-latency': self.client.apiLatency(),
+            'cpu-load': cpuLoad()
+        }
+
+    # Ratio of the measurement closest to its limit, above 1 is pressure
+    def pressure(self) -> float:
+        values = self.measurements()
+        return max((values[k] / limit for k, limit in self.limits.items() if limit > 0), default=0)
+
+    def update(self):
+        now = time.monotonic()
+        if now - self.changedAt < self.hold:
+            return
+        pressure = self.pressure()
+        if pressure > 1 and self.step < len(self.ladder) - 1:
+            self.step += 1
+            self.changedAt = now
+            BITRATE_CHANGES.inc(1, 'down')
+        elif pressure < 0.5 and self.step > 0:
+            self.step -= 1
+            self.changedAt = now
+            BITRATE_CHANGES.inc(1, 'up')
+
+    # Bitrate for the next track in a channel with the given bitrate
+    def choose(self, channelBitrate: int) -> int:
+        self.update()
+        return self.rung(channelBitrate)
+
+    # Current rung for a channel, without looking at the pressure
+    def rung(self, channelBitrate: int) -> int:
+        rungs = [rate for rate in self.ladder if rate <= channelBitrate]
+        if not rungs:
+            return channelBitrate
+        return rungs[max(0, len(rungs) - 1 - self.step)]
+
+    def stats(self) -> dict:
+        return {
+            'step': self.step,
+            **{k: round(v, 3) for k, v in self.measurements().items()}
+        }
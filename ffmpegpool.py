@@ -0,0 +1,259 @@
+import asyncio
+import collections
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+from discord.oggparse import OggStream
+
+from opusstream import resolvePlaylist, iterSegments
+from bitratepolicy import cpuLoad
+from metrics import REGISTRY
+
+FFMPEG_REAPED = REGISTRY.counter('jellychord_ffmpeg_reaped_total', 'ffmpeg processes killed after stalling')
+FFMPEG_DEGRADED = REGISTRY.counter('jellychord_ffmpeg_degraded_total', 'Tracks transcoded at the degraded bitrate')
+
+# Audio source reading Ogg Opus from a pooled ffmpeg process
+# Runs on the voice client's thread, the pool watches waitingSince to find stalled processes
+class PooledFFmpegSource(discord.AudioSource):
+    def __init__(self, pool: 'FFmpegPool', process: subprocess.Popen) -> None:
+        self.pool = pool
+        self.process = process
+        self.feeder = None
+        self.waitingSince = None
+        self.closed = False
+        self.__packets = OggStream(process.stdout).iter_packets()
+        self.__first = None
+
+    def __next(self) -> bytes:
+        self.waitingSince = time.monotonic()
+        try:
+            while True:
+                packet = next(self.__packets, b'')
+                # stream headers are not audio
+                if not packet.startswith((b'OpusHead', b'OpusTags')):
+                    return packet
+        except (OSError, ValueError):
+            # killed or closed under us
+            return b''
+        finally:
+            self.waitingSince = None
+
+    # Blocks until ffmpeg produced the first packet, returns False if it exited without any
+    def prime(self) -> bool:
+        self.__first = self.__next()
+        return bool(self.__first)
+
+    def read(self) -> bytes:
+        if self.__first is not None:
+            packet, self.__first = self.__first, None
+            return packet
+        return self.__next()
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if not self.closed:
+            self.closed = True
+            self.pool._release(self)
+
+# Transcodes streams the server does not send as Opus
+# A few ffmpeg processes are kept spawned and waiting on stdin, so starting a track only has to feed one
+# Input segments are fetched with the JF client and written to stdin, ffmpeg never talks to the server
+class FFmpegPool():
+    def __init__(self, maxProcesses: int = 16, idle: int = 2, stallTimeout: float = 20,
+                 cpuBudget: float = 0.8, degradedBitrate: int = 64000) -> None:
+        self.maxProcesses = maxProcesses
+        self.idle = idle
+        self.stallTimeout = stallTimeout
+        self.cpuBudget = cpuBudget
+        self.degradedBitrate = degradedBitrate
+        self.active = set()
+        self.reaped = 0
+        self.spawned = 0
+        self.warmStarts = 0
+        # (bitrate, process) waiting for input, oldest first
+        self.__idle = collections.deque()
+        self.__slots = asyncio.Semaphore(maxProcesses)
+        # a writer and a reader per process at most
+        self.__executor = ThreadPoolExecutor(max_workers=maxProcesses * 2 + 1, thread_name_prefix='ffmpeg')
+        self.__loop = None
+        self.__reaper = None
+        self.__refill = None
+
+    def args(self, bitrate: int, offset: float = 0) -> list[str]:
+        args = ['ffmpeg']
+        if offset:
+            args += ['-ss', str(offset)]
+        args += ['-i', 'pipe:0', '-map_metadata', '-1', '-f', 'opus', '-c:a', 'libopus',
+                 '-ar', '48000', '-ac', '2', '-b:a', f'{bitrate // 1000}k', '-loglevel', 'warning', 'pipe:1']
+        return args
+
+    def __spawn(self, bitrate: int, offset: float = 0) -> subprocess.Popen:
+        try:
+            process = subprocess.Popen(self.args(bitrate, offset), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        except FileNotFoundError:
+            raise discord.ClientException('ffmpeg was not found.') from None
+        except subprocess.SubprocessError as e:
+            raise discord.ClientException(f'Popen failed: {e.__class__.__name__}: {e}') from e
+        self.spawned += 1
+        return process
+
+    # True when another encoder at the full rate would exceed the CPU budget
+    def overBudget(self) -> bool:
+        return len(self.active) >= self.maxProcesses * self.cpuBudget or cpuLoad() > self.cpuBudget
+
+    # Bitrate to transcode at, lowered while the CPU budget is exhausted
+    def bitrate(self, requested: int) -> int:
+        if requested > self.degradedBitrate and self.overBudget():
+            FFMPEG_DEGRADED.inc()
+            return self.degradedBitrate
+        return requested
+
+    def running(self) -> int:
+        return sum(1 for source in list(self.active) if source.process.poll() is None)
+
+    # Starts transcoding the HLS stream at url, returns once the first packet is ready
+    # resolved is (playlist, attrs) when the playlist was already fetched
+    # Raises discord.ClientException when ffmpeg is missing or produced no audio
+    async def open(self, client, url: str, bitrate: int, offset: float = 0, resolved: tuple = None) -> PooledFFmpegSource:
+        self.__loop = asyncio.get_running_loop()
+        if self.__reaper is None or self.__reaper.done():
+            self.__reaper = self.__loop.create_task(self.reap())
+
+        playlist, _ = resolved or await resolvePlaylist(client, url)
+        try:
+            await asyncio.wait_for(self.__slots.acquire(), self.stallTimeout)
+        except asyncio.TimeoutError:
+            raise discord.ClientException('too many ffmpeg processes') from None
+        try:
+            process = None if offset else self.__takeIdle(bitrate)
+            if process:
+                self.warmStarts += 1
+            else:
+                process = await self.__loop.run_in_executor(self.__executor, self.__spawn, bitrate, offset)
+            self.__startRefill(bitrate)
+        except BaseException:
+            self.__slots.release()
+            raise
+
+        source = PooledFFmpegSource(self, process)
+        self.active.add(source)
+        source.feeder = self.__loop.create_task(self.__feed(client, url, playlist, process))
+        try:
+            if not await self.__loop.run_in_executor(self.__executor, source.prime):
+                raise discord.ClientException('ffmpeg produced no audio')
+        except BaseException:
+            source.cleanup()
+            raise
+        return source
+
+    async def __feed(self, client, url: str, playlist, process: subprocess.Popen):
+        complete = False
+        try:
+            async for data in iterSegments(client, playlist):
+                await self.__loop.run_in_executor(self.__executor, process.stdin.write, data)
+            complete = True
+        except Exception:
+            # ffmpeg exited, or the server went away mid track and ffmpeg finishes what it got
+            pass
+        finally:
+            try:
+                await self.__loop.run_in_executor(self.__executor, process.stdin.close)
+            except (OSError, ValueError):
+                pass
+            if not complete:
+                # stopped or failed part way, the server would keep encoding the rest
+                await client.stopTranscode(url)
+
+    def __takeIdle(self, bitrate: int) -> subprocess.Popen:
+        for item in self.__idle:
+            if item[0] == bitrate and item[1].poll() is None:
+                self.__idle.remove(item)
+                return item[1]
+        return None
+
+    # Keeps idle processes ready at the bitrate last asked for, the oldest ones make room
+    def __startRefill(self, bitrate: int):
+        if self.idle <= 0 or (self.__refill and not self.__refill.done()):
+            return
+        self.__refill = self.__loop.create_task(self.__fillIdle(bitrate))
+
+    async def __fillIdle(self, bitrate: int):
+        while sum(1 for b, _ in self.__idle if b == bitrate) < self.idle:
+            try:
+                process = await self.__loop.run_in_executor(self.__executor, self.__spawn, bitrate)
+            except discord.ClientException:
+                return
+            self.__idle.append((bitrate, process))
+            while len(self.__idle) > self.idle:
+                self.__kill(self.__idle.popleft()[1])
+
+    def __kill(self, process: subprocess.Popen):
+        self.__executor.submit(stopProcess, process)
+
+    # Called through cleanup, maybe from the voice client's thread
+    def _release(self, source: PooledFFmpegSource):
+        loop = self.__loop
+        if loop is None or loop.is_closed():
+            stopProcess(source.process)
+            return
+        loop.call_soon_threadsafe(self.__release, source)
+
+    def __release(self, source: PooledFFmpegSource):
+        if source not in self.active:
+            return
+        self.active.discard(source)
+        self.__slots.release()
+        if source.feeder:
+            source.feeder.cancel()
+        self.__kill(source.process)
+
+    # Kills processes that kept a reader waiting longer than stallTimeout, the track then ends like any other
+    # and drops idle processes that exited on their own
+    async def reap(self):
+        while True:
+            await asyncio.sleep(max(1, self.stallTimeout / 4))
+            now = time.monotonic()
+            for source in list(self.active):
+                since = source.waitingSince
+                if since is not None and now - since > self.stallTimeout and source.process.poll() is None:
+                    self.reaped += 1
+                    FFMPEG_REAPED.inc()
+                    source.process.kill()
+            for item in [item for item in self.__idle if item[1].poll() is not None]:
+                self.__idle.remove(item)
+
+    def stats(self) -> dict:
+        return {
+            'active': len(self.active),
+            'idle': len(self.__idle),
+            'spawned': self.spawned,
+            'warm-starts': self.warmStarts,
+            'reaped': self.reaped,
+            'over-budget': self.overBudget()
+        }
+
+    def shutdown(self):
+        for task in (self.__reaper, self.__refill):
+            if task:
+                task.cancel()
+        for source in list(self.active):
+            if source.feeder:
+                source.feeder.cancel()
+            source.process.kill()
+        while self.__idle:
+            self.__idle.popleft()[1].kill()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+def stopProcess(process: subprocess.Popen):
+    if process.poll() is None:
+        process.kill()
+    for pipe in (process.stdin, process.stdout):
+        try:
+            pipe.close()
+        except OSError:
+            pass
+    process.wait()
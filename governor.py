@@ -0,0 +1,116 @@
+import asyncio
+import sys
+import time
+
+from metrics import REGISTRY
+
+RECLAIMED = REGISTRY.counter('jellychord_governor_reclaimed_total', 'Resources reclaimed by the governor', ('kind',))
+
+# Rough size of a queue entry in memory
+def itemBytes(item) -> int:
+    return (sys.getsizeof(item) + sys.getsizeof(item.id) + sys.getsizeof(item.name) + sys.getsizeof(item.artists)
+            + sum(sys.getsizeof(artist) for artist in item.artists))
+
+# Keeps guilds within their share of the bot
+# Queues are capped in entries and estimated bytes, and voice connections that are paused or alone
+# for too long are parked: the voice client disconnects and the queue stays, ready to pick up where it stopped
+class ResourceGovernor():
+    def __init__(self, players, maxQueue: int = 5000, maxQueueBytes: int = 8 << 20, pausedTimeout: float = 600,
+                 aloneTimeout: float = 300, interval: float = 30, reportInterval: float = 3600) -> None:
+        self.players = players
+        self.maxQueue = maxQueue
+        self.maxQueueBytes = maxQueueBytes
+        self.pausedTimeout = pausedTimeout
+        self.aloneTimeout = aloneTimeout
+        self.interval = interval
+        self.reportInterval = reportInterval
+        # reclaimed since the last report
+        self.reclaimed = dict.fromkeys(('paused', 'alone', 'rejected', 'views'), 0)
+        self.totals = dict(self.reclaimed)
+        # guild -> average bytes of the entries admitted to its queue
+        self.__entryBytes = {}
+        # guild -> when it was first seen paused or alone
+        self.__pausedSince = {}
+        self.__aloneSince = {}
+
+    def count(self, kind: str, amount: int = 1):
+        if amount:
+            self.reclaimed[kind] += amount
+            self.totals[kind] += amount
+            RECLAIMED.inc(amount, kind)
+
+    def queueBytes(self, guildId: int) -> int:
+        queue = self.players.queues.get(guildId)
+        return int(len(queue) * self.__entryBytes.get(guildId, 0)) if queue else 0
+
+    # The leading part of items that fits in the guild's queue, the rest is counted as rejected
+    def admit(self, guildId: int, items: list) -> list:
+        if not items:
+            return items
+        queue = self.players.queues.get(guildId)
+        length = len(queue) if queue else 0
+        size = sum(itemBytes(item) for item in items) / len(items)
+        average = self.__entryBytes.get(guildId, size)
+        room = min(self.maxQueue - length, int((self.maxQueueBytes - length * average) // size))
+        room = max(0, min(room, len(items)))
+        if room:
+            self.__entryBytes[guildId] = (average * length + size * room) / (length + room)
+        self.count('rejected', len(items) - room)
+        return items if room == len(items) else items[:room]
+
+    async def run(self):
+        lastReport = time.monotonic()
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+            if self.reportInterval > 0 and time.monotonic() - lastReport >= self.reportInterval:
+                lastReport = time.monotonic()
+                self.report()
+
+    # Parks players paused or alone for longer than their timeout
+    async def check(self):
+        now = time.monotonic()
+        players = self.players
+        for gid in [gid for gid in self.__entryBytes if gid not in players.queues]:
+            del self.__entryBytes[gid]
+        for since in (self.__pausedSince, self.__aloneSince):
+            for gid in [gid for gid in since if gid not in players.players]:
+                del since[gid]
+
+        for gid, player in list(players.players.items()):
+            vc = player.guild.voice_client
+            if not vc or not vc.is_connected():
+                continue
+            state = players.playing.get(gid)
+            if state and state.get('paused'):
+                self.__pausedSince.setdefault(gid, now)
+            else:
+                self.__pausedSince.pop(gid, None)
+            if any(not member.bot for member in vc.channel.members):
+                self.__aloneSince.pop(gid, None)
+            else:
+                self.__aloneSince.setdefault(gid, now)
+
+            if self.pausedTimeout > 0 and now - self.__pausedSince.get(gid, now) >= self.pausedTimeout:
+                kind = 'paused'
+            elif self.aloneTimeout > 0 and now - self.__aloneSince.get(gid, now) >= self.aloneTimeout:
+                kind = 'alone'
+            else:
+                continue
+            self.__pausedSince.pop(gid, None)
+            self.__aloneSince.pop(gid, None)
+            self.count(kind)
+            await players.park(player.guild)
+
+    def report(self):
+        if any(self.reclaimed.values()):
+            print(f'governor: parked {self.reclaimed["paused"]} paused and {self.reclaimed["alone"]} alone voice clients, '
+                  f'rejected {self.reclaimed["rejected"]} queue entries, released {self.reclaimed["views"]} search views',
+                  flush=True)
+        self.reclaimed = dict.fromkeys(self.reclaimed, 0)
+
+    def stats(self) -> dict:
+        return {
+            **self.totals,
+            'queue-bytes': sum(self.queueBytes(gid) for gid in list(self.players.queues))
+        }
@@ -0,0 +1,236 @@
+import random
+
+# marks a slot whose item was removed from the middle of the queue
+_REMOVED = object()
+# a longer journal is cheaper to replace by a rewrite of the whole queue
+JOURNAL_LIMIT = 256
+
+# Play queue for a single guild
+# Items live in a slot array with free space on both ends, so pushing and popping at either end is O(1)
+# Removing from the middle leaves a marker in the slot instead of shifting everything after it,
+# a Fenwick tree counting those markers turns a queue index into a slot in O(log n)
+class GuildQueue():
+    def __init__(self, items = ()) -> None:
+        # bumped on every change, lets observers notice a modified queue without comparing items
+        self.version = 0
+        # changes not yet taken by the state store, None while nothing records them
+        # entries are ('append', items), ('prepend', items), ('popleft', count), ('pop', count),
+        # or a single ('reset',) after a reorder, when only the whole queue describes it
+        self.journal = None
+        self.__build(list(items))
+
+    def __record(self, op: str, arg = None):
+        journal = self.journal
+        if journal is None or (journal and journal[0][0] == 'reset'):
+            return
+        if op == 'reset' or len(journal) >= JOURNAL_LIMIT:
+            journal[:] = [('reset',)]
+        elif op in ('popleft', 'pop') and journal and journal[-1][0] == op:
+            journal[-1] = (op, journal[-1][1] + arg)
+        else:
+            journal.append((op, arg))
+
+    def __build(self, items: list, front: int = 0, back: int = 0):
+        n = len(items)
+        cap = max(16, 2 * (n + front + back))
+        self.__head = front + (cap - n - front - back) // 2
+        self.__tail = self.__head + n
+        self.__slots = [None] * cap
+        self.__slots[self.__head:self.__tail] = items
+        self.__tree = [0] * (cap + 1)
+        self.__removed = 0
+
+    def __mark(self, slot: int, delta: int):
+        i = slot + 1
+        tree = self.__tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def __countRemoved(self, end: int) -> int:
+        i = end
+        res = 0
+        while i > 0:
+            res += self.__tree[i]
+            i -= i & -i
+        return res
+
+    # Slot holding the item at index, index must be in range
+    def __locate(self, index: int) -> int:
+        if not self.__removed:
+            return self.__head + index
+        # find the smallest p where slots [0, p) hold more than target live or empty slots
+        target = self.__head - self.__countRemoved(self.__head) + index + 1
+        tree = self.__tree
+        pos = 0
+        acc = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and nxt - acc - tree[nxt] < target:
+                pos = nxt
+                acc += tree[nxt]
+            step >>= 1
+        return pos
+
+    def __checkIndex(self, index: int) -> int:
+        n = len(self)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('queue index out of range')
+        return index
+
+    def __trim(self):
+        slots = self.__slots
+        while self.__head < self.__tail and slots[self.__head] is _REMOVED:
+            self.__mark(self.__head, -1)
+            self.__removed -= 1
+            slots[self.__head] = None
+            self.__head += 1
+        while self.__head < self.__tail and slots[self.__tail - 1] is _REMOVED:
+            self.__tail -= 1
+            self.__mark(self.__tail, -1)
+            self.__removed -= 1
+            slots[self.__tail] = None
+
+    def __len__(self) -> int:
+        return self.__tail - self.__head - self.__removed
+
+    def __bool__(self) -> bool:
+        return self.__tail > self.__head
+
+    def __iter__(self):
+        slots = self.__slots
+        for i in range(self.__head, self.__tail):
+            item = slots[i]
+            if item is not _REMOVED:
+                yield item
+
+    def __getitem__(self, index: int):
+        return self.__slots[self.__locate(self.__checkIndex(index))]
+
+    def append(self, item):
+        self.version += 1
+        self.__record('append', [item])
+        if self.__tail == len(self.__slots):
+            self.__build(list(self), back=1)
+        self.__slots[self.__tail] = item
+        self.__tail += 1
+
+    def appendleft(self, item):
+        self.version += 1
+        self.__record('prepend', [item])
+        if self.__head == 0:
+            self.__build(list(self), front=1)
+        self.__head -= 1
+        self.__slots[self.__head] = item
+
+    def extend(self, items):
+        self.version += 1
+        items = list(items)
+        self.__record('append', items)
+        if self.__tail + len(items) > len(self.__slots):
+            self.__build(list(self), back=len(items))
+        self.__slots[self.__tail:self.__tail + len(items)] = items
+        self.__tail += len(items)
+
+    # Inserts items at the front, keeping their order
+    def prepend(self, items):
+        self.version += 1
+        items = list(items)
+        self.__record('prepend', items)
+        if self.__head < len(items):
+            self.__build(list(self), front=len(items))
+        self.__slots[self.__head - len(items):self.__head] = items
+        self.__head -= len(items)
+
+    # Inserts items before index, keeping their order
+    # Anywhere but the ends this rebuilds the queue, O(n)
+    def insert(self, index: int, items):
+        self.version += 1
+        items = list(items)
+        if index <= 0:
+            self.prepend(items)
+        elif index >= len(self):
+            self.extend(items)
+        else:
+            self.__record('reset')
+            current = list(self)
+            current[index:index] = items
+            self.__build(current)
+
+    # Position of item, compared by identity, O(n)
+    def index(self, item) -> int:
+        for i, entry in enumerate(self):
+            if entry is item:
+                return i
+        raise ValueError('item is not in queue')
+
+    def popleft(self):
+        self.version += 1
+        if not self:
+            raise IndexError('pop from an empty queue')
+        self.__record('popleft', 1)
+        item = self.__slots[self.__head]
+        self.__slots[self.__head] = None
+        self.__head += 1
+        self.__trim()
+        return item
+
+    def pop(self, index: int = -1):
+        self.version += 1
+        slot = self.__locate(self.__checkIndex(index))
+        item = self.__slots[slot]
+        if slot == self.__head:
+            return self.popleft()
+        if slot == self.__tail - 1:
+            self.__record('pop', 1)
+            self.__tail -= 1
+            self.__slots[slot] = None
+            self.__trim()
+            return item
+
+        self.__record('reset')
+        self.__slots[slot] = _REMOVED
+        self.__mark(slot, 1)
+        self.__removed += 1
+        # compact once markers outnumber items, keeps lookups and page walks bounded
+        if self.__removed > 32 and self.__removed > len(self):
+            self.__build(list(self))
+        return item
+
+    def moveToFront(self, index: int):
+        item = self.pop(index)
+        self.appendleft(item)
+        return item
+
+    def moveToBack(self, index: int):
+        item = self.pop(index)
+        self.append(item)
+        return item
+
+    # Returns up to count items starting from index start
+    def page(self, start: int, count: int) -> list:
+        if start < 0 or start >= len(self) or count <= 0:
+            return []
+        res = []
+        slots = self.__slots
+        slot = self.__locate(start)
+        while slot < self.__tail and len(res) < count:
+            if slots[slot] is not _REMOVED:
+                res.append(slots[slot])
+            slot += 1
+        return res
+
+    def shuffle(self):
+        self.version += 1
+        self.__record('reset')
+        items = list(self)
+        random.shuffle(items)
+        self.__build(items)
+
+    def clear(self):
+        self.version += 1
+        self.__record('reset')
+        self.__build([])
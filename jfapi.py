@@ -1,61 +1,343 @@
 import aiohttp
 import asyncio
 import json
+import re
 import yaml
+import random
+import time
 import urllib.parse
+import uuid
+
+from searchcache import SearchCache
+from metrics import REGISTRY
+
+JF_REQUEST_SECONDS = REGISTRY.histogram('jellychord_jf_request_seconds', 'Latency of Jellyfin requests, retries included', ('endpoint',))
+JF_RESPONSE_BYTES = REGISTRY.counter('jellychord_jf_response_bytes_total', 'Bytes received from Jellyfin', ('endpoint',))
+JF_REQUEST_FAILURES = REGISTRY.counter('jellychord_jf_request_failures_total', 'Failed Jellyfin request attempts', ('endpoint',))
+
+# Only these fields of BaseItemDto are kept, everything else is dropped right after decoding
+class Track():
+    __slots__ = ('id', 'name', 'artists', 'type', 'length')
+
+    def __init__(self, id: str, name: str, artists: tuple[str], type: str, length: int) -> None:
+        self.id = id
+        self.name = name
+        self.artists = artists
+        self.type = type
+        self.length = length
+
+    @classmethod
+    def fromItem(cls, item: dict) -> 'Track':
+        return cls(
+            item['Id'],
+            item.get('Name', ''),
+            tuple(item.get('Artists') or ()),
+            item.get('Type', 'Audio'),
+            (item.get('RunTimeTicks') or 0) // 10000000
+        )
+
+    def __repr__(self) -> str:
+        return f'Track({self.type} {self.id} {self.name!r})'
+
+# Query parameters that keep /Items responses down to the fields used by Track
+# Name, Id, Type, Artists and RunTimeTicks are always returned, so no optional fields are requested
+LEAN_ITEM_PARAMS = {
+    'enableImages': 'false',
+    'enableUserData': 'false',
+    'enableTotalRecordCount': 'false'
+}
+
+# Raised when the server could not be reached after retrying, or the circuit breaker is open
+class JFAPIUnavailable(Exception):
+    pass
+
+# Raised when the server refused a request (4xx), e.g. an item that was deleted or cannot be streamed
+class JFAPIItemError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f'Jellyfin returned {status}: {message}')
+        self.status = status
+
+# Stops sending requests to a failing server for a cooldown period,
+# then lets one request through to probe whether it recovered
+class CircuitBreaker():
+    def __init__(self, threshold: int = 5, cooldown: float = 30) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+
+    def allow(self) -> bool:
+        if self.openedAt is None:
+            return True
+        if time.monotonic() - self.openedAt >= self.cooldown:
+            # half open, the next result decides
+            self.openedAt = time.monotonic()
+            return True
+        return False
+
+    def success(self):
+        self.failures = 0
+        self.openedAt = None
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.openedAt = time.monotonic()
+
+    @property
+    def state(self) -> str:
+        if self.openedAt is None:
+            return 'closed'
+        return 'open' if time.monotonic() - self.openedAt < self.cooldown else 'half-open'
+
+def ewma(average: float, sample: float, weight: float = 0.2) -> float:
+    return sample if not average else average * (1 - weight) + sample * weight
+
+# One server of a replicated Jellyfin deployment
+# outstanding counts requests in flight, streams the transcodes it served recently
+class Backend():
+    def __init__(self, url: str, breaker: CircuitBreaker) -> None:
+        self.url = url.strip('/')
+        self.breaker = breaker
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        # moving average of api response times in seconds
+        self.latency = 0.0
+        # item id -> when one of its stream resources was last requested
+        self.streams = {}
+
+    def available(self) -> bool:
+        return self.breaker.state != 'open'
+
+    def transcodes(self, window: float) -> int:
+        cutoff = time.monotonic() - window
+        for id in [id for id, ts in self.streams.items() if ts < cutoff]:
+            del self.streams[id]
+        return len(self.streams)
+
+    def observe(self, seconds: float):
+        self.latency = ewma(self.latency, seconds)
+
+_STREAM_RE = re.compile(r'/Audio/([^/]+)/')
 
 class JFAPI():
-    def __init__(self, server: str, apikey: str) -> None:
+    # server is one URL or a list of replicas sharing the same library and api key
+    def __init__(self, server: str | list[str], apikey: str, cacheSize: int = 256, cacheTtl: float = 300,
+                 poolSize: int = 100, poolSizePerHost: int = 30, keepalive: float = 30, dnsCacheTtl: int = 300,
+                 timeout: float = 15, retries: int = 2, retryBackoff: float = 0.5,
+                 breakerThreshold: int = 5, breakerCooldown: float = 30,
+                 healthTimeout: float = 5, transcodeWindow: float = 60) -> None:
         self.__apikey = apikey
-        self.__server = server.strip('/')
+        servers = [server] if isinstance(server, str) else list(server)
+        self.backends = [Backend(url, CircuitBreaker(breakerThreshold, breakerCooldown)) for url in servers]
         self._session = None
+        self.searchCache = SearchCache(cacheSize, cacheTtl) if cacheSize > 0 else None
+        self.__poolSize = poolSize
+        self.__poolSizePerHost = poolSizePerHost
+        self.__keepalive = keepalive
+        self.__dnsCacheTtl = dnsCacheTtl
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__retryBackoff = retryBackoff
+        self.__healthTimeout = healthTimeout
+        self.__transcodeWindow = transcodeWindow
+        # moving average of stream resource fetch times in seconds
+        self.streamLatency = 0.0
+        # sent with every stream, the server files its transcodes under this device and a session per stream
+        self.deviceId = f'jellychord-{uuid.uuid4().hex[:12]}'
 
-    def __getEndpointUrl(self, endpoint: str):
-        return f'{self.__server}/{endpoint.strip('/')}'
+    def __getEndpointUrl(self, backend: Backend, endpoint: str):
+        return f'{backend.url}/{endpoint.strip('/')}'
 
     async def __aenter__(self):
-        self._session = aiohttp.ClientSession()
-    
-    async def __aexit__(self):
-        await self._session.close()
+        await self.open()
+        return self
     
-    def __del__(self):
-        try:
-            asyncio.run(self._session.delete())
-        except:
-            pass
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # Opens the connection pool, must be called from the event loop that will use it
+    async def open(self):
+        if self._session and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.__poolSize,
+            limit_per_host=self.__poolSizePerHost,
+            keepalive_timeout=self.__keepalive,
+            ttl_dns_cache=self.__dnsCacheTtl
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.__timeout)
+        )
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
 
     async def checkSession(self):
-        if not self._session:
-            self._session = aiohttp.ClientSession()
+        if not self._session or self._session.closed:
+            await self.open()
+
+    '''
+    Load Balancing
+    '''
+    # Backends to try for an api request, least outstanding requests first
+    # healthy backends with a closed breaker come before the rest, so a request still goes out when all look down
+    def __ranked(self) -> list[Backend]:
+        return sorted(self.backends, key=lambda b: (not (b.healthy and b.available()), b.outstanding, b.requests))
+
+    def __backendOf(self, url: str) -> Backend:
+        for backend in self.backends:
+            if url.startswith(backend.url + '/'):
+                return backend
+        return None
+
+    # One request to one backend, raises what aiohttp raised
+    async def __attempt(self, backend: Backend, url: str, params: dict, headers: dict, endpoint: str) -> bytes:
+        backend.outstanding += 1
+        started = time.perf_counter()
+        try:
+            async with self._session.get(url, params=params, headers=headers) as res:
+                res.raise_for_status()
+                body = await res.read()
+        except aiohttp.ClientResponseError as e:
+            JF_REQUEST_FAILURES.inc(1, endpoint)
+            if e.status < 500:
+                # the server answered, it is up
+                backend.breaker.success()
+            else:
+                backend.breaker.failure()
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            JF_REQUEST_FAILURES.inc(1, endpoint)
+            backend.breaker.failure()
+            raise
+        finally:
+            backend.outstanding -= 1
+        if endpoint == 'stream':
+            self.streamLatency = ewma(self.streamLatency, time.perf_counter() - started)
+        else:
+            backend.observe(time.perf_counter() - started)
+        backend.requests += 1
+        JF_RESPONSE_BYTES.inc(len(body), endpoint)
+        backend.breaker.success()
+        return body
+
+    # GET with retries for server errors, timeouts and connection failures
+    # Client errors (4xx) are raised right away as JFAPIItemError, they will not go away by retrying
+    # API requests fail over to the next backend, stream resources only exist on the backend transcoding them
+    async def __get(self, endpoint: str = None, params: dict = None, headers: dict = None, url: str = None):
+        await self.checkSession()
+        raw = url is not None
+        # stream resources share one label, api calls are labelled by the last path element
+        label = 'stream' if raw else endpoint.strip('/').rsplit('/', 1)[-1]
+        # a URL on none of the backends, e.g. a playlist pointing elsewhere, gets a breaker of its own
+        pinned = (self.__backendOf(url) or Backend(url, CircuitBreaker())) if raw else None
+        error = None
+        with JF_REQUEST_SECONDS.time(label):
+            for attempt in range(self.__retries + 1):
+                tried = False
+                for backend in [pinned] if raw else self.__ranked():
+                    if not backend.breaker.allow():
+                        continue
+                    tried = True
+                    target = url if raw else self.__getEndpointUrl(backend, endpoint)
+                    try:
+                        body = await self.__attempt(backend, target, params, headers, label)
+                        return body if raw else json.loads(body)
+                    except aiohttp.ClientResponseError as e:
+                        if e.status < 500:
+                            raise JFAPIItemError(e.status, e.message) from e
+                        error = e
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        error = e
+                if not tried:
+                    break
+                if attempt < self.__retries:
+                    await asyncio.sleep(self.__retryBackoff * 2 ** attempt * random.uniform(0.5, 1.5))
+        raise JFAPIUnavailable(f'Jellyfin server unavailable: {error or "circuit breaker open"}') from error
+
+    # GET /System/Ping, needs no api key
+    async def ping(self, backend: Backend) -> bool:
+        await self.checkSession()
+        try:
+            async with self._session.get(f'{backend.url}/System/Ping',
+                                         timeout=aiohttp.ClientTimeout(total=self.__healthTimeout)) as res:
+                return res.status < 500
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    # Opens the pool and a connection to every backend, so the first requests do not wait for handshakes
+    async def warmup(self):
+        await self.open()
+        await asyncio.gather(*(self.ping(b) for b in self.backends))
+
+    # Pings every backend each interval, a backend failing its check gets no requests while others are up
+    async def runHealthChecks(self, interval: float = 15):
+        while True:
+            results = await asyncio.gather(*(self.ping(b) for b in self.backends))
+            for backend, up in zip(self.backends, results):
+                if up and not backend.healthy:
+                    backend.breaker.success()
+                backend.healthy = up
+            await asyncio.sleep(interval)
+
+    # Longest a stream resource fetch can take before it fails, every retry and backoff included
+    @property
+    def fetchDeadline(self) -> float:
+        backoff = sum(self.__retryBackoff * 2 ** attempt * 1.5 for attempt in range(self.__retries))
+        return self.__timeout * (self.__retries + 1) + backoff
+
+    # Mean api response time of the backends taking requests
+    def apiLatency(self) -> float:
+        latencies = [b.latency for b in self.backends if b.healthy and b.available() and b.latency]
+        return sum(latencies) / len(latencies) if latencies else 0.0
+
+    def stats(self) -> dict:
+        window = self.__transcodeWindow
+        return {b.url: f'{"up" if b.healthy else "down"} breaker {b.breaker.state} outstanding {b.outstanding} '
+                       f'transcodes {b.transcodes(window)} latency {b.latency * 1000:.0f}ms' for b in self.backends}
 
     # https://api.jellyfin.org/#tag/Search/operation/GetSearchHints
     # GET /Search/Hints
-    async def search(self, term: str, limit: int = None, types:list[str] = []) -> list:
-        await self.checkSession()
+    # Results are served from the search cache when enabled
+    async def search(self, term: str, limit: int = None, types:list[str] = []) -> list[Track]:
+        if self.searchCache is None:
+            return await self.__search(term, limit, types)
+        key = (term.strip().casefold(), limit, tuple(types))
+        return await self.searchCache.get(key, lambda: self.__search(term, limit, types))
+
+    async def __search(self, term: str, limit: int = None, types:list[str] = []) -> list[Track]:
         params = {
             'ApiKey': self.__apikey,
             'searchTerm': term,
-            'recursive': 'true'
+            'recursive': 'true',
+            **LEAN_ITEM_PARAMS
         }
         if limit:
             params['limit'] = limit
         if types:
             params['includeItemTypes'] = ','.join(types)
 
-        async with self._session.get(
-            self.__getEndpointUrl('/Items'),
-            params=params
-        ) as res:
-            return (await res.json())["Items"]
+        res = await self.__get('/Items', params)
+        return [Track.fromItem(item) for item in res["Items"]]
 
     # Gets HLS stream for audio soundtrack with format Opus 16bit 48khz in fMP4 containers
     # Returns URL for use with external player (ffmpeg)
+    # The track is transcoded by the backend with the fewest recent transcodes
     # GET /Audio/{itemId}/main.m3u8
     def getAudioHls(self, id, bitrate):
-        endpoint = self.__getEndpointUrl(f'/Audio/{id}/main.m3u8')
+        window = self.__transcodeWindow
+        candidates = [b for b in self.backends if b.healthy and b.available()] or self.backends
+        backend = min(candidates, key=lambda b: (b.transcodes(window), b.outstanding))
+        endpoint = self.__getEndpointUrl(backend, f'/Audio/{id}/main.m3u8')
         params = {
             'ApiKey': self.__apikey,
+            'DeviceId': self.deviceId,
+            'PlaySessionId': uuid.uuid4().hex,
             'segmentContainer': 'mp4',
             'audioCodec': 'opus',
             'allowAudioStreamCopy': True,
@@ -67,26 +349,89 @@ class JFAPI():
         q = urllib.parse.urlencode(params)
         return endpoint + '?' + q
 
+    # Ends the transcode behind a stream from getAudioHls that is no longer read,
+    # otherwise the server keeps encoding the rest of the track until its own timeout
+    # DELETE /Videos/ActiveEncodings
+    async def stopTranscode(self, url: str):
+        session = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('PlaySessionId')
+        backend = self.__backendOf(url)
+        if not session or not backend or not backend.available():
+            return
+        match = _STREAM_RE.search(url)
+        if match:
+            backend.streams.pop(match.group(1), None)
+        await self.checkSession()
+        params = {'deviceId': self.deviceId, 'playSessionId': session[0]}
+        try:
+            async with self._session.delete(self.__getEndpointUrl(backend, '/Videos/ActiveEncodings'),
+                                            params=params, headers={'X-Emby-Token': self.__apikey}) as res:
+                res.raise_for_status()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            # the server drops it on its own eventually
+            pass
+
+    # Fetches a resource referenced by a stream playlist, e.g. a variant playlist or media segment
+    # A segment counts as a transcode of its backend, playlists are cheap and may be fetched ahead without playing
+    async def fetch(self, url: str) -> bytes:
+        backend = self.__backendOf(url)
+        match = _STREAM_RE.search(url)
+        if backend and match and not urllib.parse.urlsplit(url).path.endswith('.m3u8'):
+            backend.streams[match.group(1)] = time.monotonic()
+        return await self.__get(headers={'X-Emby-Token': self.__apikey}, url=url)
+
     # Gets items by IDs
     # GET /Items
-    async def getItemsByIds(self, ids: list[str]):
-        await self.checkSession()
-        endpoint = self.__getEndpointUrl('/Items')
+    async def getItemsByIds(self, ids: list[str]) -> list[Track]:
         params = {
             'ApiKey': self.__apikey,
-            'ids': ','.join(ids)
+            'ids': ','.join(ids),
+            **LEAN_ITEM_PARAMS
         }
-        async with self._session.get(endpoint, params=params) as res:
-            return (await res.json())['Items']
+        res = await self.__get('/Items', params)
+        return [Track.fromItem(item) for item in res['Items']]
     
-    async def getAlbumTracks(self, albumId: str):
-        await self.checkSession()
-        endpoint = self.__getEndpointUrl('/Items')
+    async def getAlbumTracks(self, albumId: str) -> list[Track]:
+        return [track async for page in self.iterAlbumTracks(albumId) for track in page]
+
+    # Pages through items with StartIndex/Limit, yielding one list per page
+    # GET /Items or any other endpoint returning a BaseItemDtoQueryResult
+    async def iterItems(self, params: dict, pageSize: int = 100, endpoint: str = '/Items'):
+        start = 0
+        while True:
+            pageParams = {
+                'ApiKey': self.__apikey,
+                'startIndex': start,
+                'limit': pageSize,
+                **LEAN_ITEM_PARAMS,
+                **params
+            }
+            res = await self.__get(endpoint, pageParams)
+            page = [Track.fromItem(item) for item in res['Items']]
+            if page:
+                yield page
+            if len(page) < pageSize:
+                return
+            start += len(page)
+
+    async def iterAlbumTracks(self, albumId: str, pageSize: int = 100):
         params = {
-            'ApiKey': self.__apikey,
             'parentId': albumId,
             'sortBy': 'ParentIndexNumber,IndexNumber'
         }
-        async with self._session.get(endpoint, params=params) as res:
-            return (await res.json())['Items']
+        async for page in self.iterItems(params, pageSize):
+            yield page
 
+    # GET /Playlists/{playlistId}/Items
+    async def iterPlaylistTracks(self, playlistId: str, pageSize: int = 100):
+        async for page in self.iterItems({}, pageSize, f'/Playlists/{playlistId}/Items'):
+            yield page
+
+    async def iterArtistTracks(self, artistId: str, pageSize: int = 100):
+        params = {
+            'artistIds': artistId,
+            'includeItemTypes': 'Audio',
+            'recursive': 'true',
+            'sortBy': 'ProductionYear,Album,ParentIndexNumber,IndexNumber'
+        }
+        async for page in self.iterItems(params, pageSize):
+            yield page
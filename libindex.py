@@ -0,0 +1,226 @@
+import asyncio
+import bisect
+import datetime
+import heapq
+import itertools
+import math
+import time
+import unicodedata
+from collections import defaultdict
+
+from jfapi import JFAPI, JFAPIItemError, JFAPIUnavailable, Track
+
+INDEXED_TYPES = ('Audio', 'MusicAlbum')
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c if c.isalnum() else ' ' for c in text if not unicodedata.combining(c))
+
+def trigrams(text: str) -> set[str]:
+    res = set()
+    for word in text.split():
+        word = f' {word} '
+        res.update(word[i:i+3] for i in range(len(word) - 2))
+    return res
+
+# Lookup tables of one version of the index
+# Rebuilds and delta syncs fill new tables off the event loop and swap them in with one assignment,
+# searches keep reading the version they started with
+class IndexData():
+    __slots__ = ('items', 'texts', 'names', 'words', 'trigrams', 'shared')
+
+    def __init__(self) -> None:
+        self.items = {}
+        self.texts = {}
+        self.names = {}
+        # sorted (word, id) pairs
+        self.words = []
+        self.trigrams = defaultdict(set)
+        # trigrams whose posting set still belongs to the version this one was copied from
+        self.shared = set()
+
+    # Copy to apply changes to, posting sets are copied once one of them changes
+    def copy(self) -> 'IndexData':
+        res = IndexData()
+        res.items = dict(self.items)
+        res.texts = dict(self.texts)
+        res.names = dict(self.names)
+        res.words = self.words
+        res.trigrams = defaultdict(set, self.trigrams)
+        res.shared = set(self.trigrams)
+        return res
+
+    def __postings(self, gram: str) -> set[str]:
+        if gram in self.shared:
+            self.shared.discard(gram)
+            self.trigrams[gram] = set(self.trigrams[gram])
+        return self.trigrams[gram]
+
+    # Adds an item, its (word, id) pairs go to words for the caller to merge into the sorted list
+    def add(self, track: Track, words: list):
+        text = normalize(' '.join((track.name, *track.artists)))
+        self.items[track.id] = track
+        self.texts[track.id] = text
+        self.names[track.id] = ' '.join(normalize(track.name).split())
+        for word in set(text.split()):
+            words.append((word, track.id))
+        for gram in trigrams(text):
+            self.__postings(gram).add(track.id)
+
+    # Removes an item, its (word, id) pairs go to stale for the caller to filter out of the sorted list
+    def remove(self, id: str, stale: set):
+        track = self.items.pop(id, None)
+        if not track:
+            return
+        text = self.texts.pop(id)
+        self.names.pop(id)
+        stale.update((word, id) for word in set(text.split()))
+        for gram in trigrams(text):
+            self.__postings(gram).discard(id)
+
+# In-memory index of audio items and albums, matched by word prefixes and trigrams
+# maxCandidates bounds how many items one search scores,
+# fuzzyThreshold is the share of query trigrams an item needs to match a misspelt query
+class LibraryIndex():
+    def __init__(self, maxCandidates: int = 2000, fuzzyThreshold: float = 0.4) -> None:
+        self.ready = False
+        self.lastSync = None
+        self.maxCandidates = maxCandidates
+        self.fuzzyThreshold = fuzzyThreshold
+        self.__data = IndexData()
+
+    def __len__(self) -> int:
+        return len(self.__data.items)
+
+    # Replaces the whole index, safe to call from a worker thread
+    def load(self, tracks: list[Track]):
+        data = IndexData()
+        words = []
+        for track in tracks:
+            data.add(track, words)
+        words.sort()
+        data.words = words
+        self.__data = data
+        self.ready = True
+
+    # Applies added or changed items to a copy of the index and swaps it in, safe to call from a worker thread
+    def update(self, tracks: list[Track]):
+        data = self.__data.copy()
+        stale = set()
+        words = []
+        for track in {track.id: track for track in tracks}.values():
+            data.remove(track.id, stale)
+            data.add(track, words)
+        data.words = [entry for entry in data.words if entry not in stale] if stale else list(data.words)
+        # the list is sorted apart from the new pairs at its end, which the sort merges in
+        data.words.extend(words)
+        data.words.sort()
+        self.__data = data
+
+    @staticmethod
+    def __prefixMatches(data: IndexData, prefix: str, cap: int) -> set[str]:
+        # the word equal to the prefix sorts first, so exact words are taken before longer ones
+        i = bisect.bisect_left(data.words, (prefix, ''))
+        res = set()
+        while i < len(data.words) and data.words[i][0].startswith(prefix) and len(res) < cap:
+            res.add(data.words[i][1])
+            i += 1
+        return res
+
+    # Items holding at least fuzzyThreshold of the query trigrams
+    def __fuzzyMatches(self, data: IndexData, query: str) -> dict[str, float]:
+        grams = [(gram, data.trigrams.get(gram, ())) for gram in trigrams(query)]
+        if not grams:
+            return {}
+        need = max(1, math.ceil(self.fuzzyThreshold * len(grams)))
+        # a match holds at least one of the len - need + 1 rarest trigrams,
+        # so only those posting lists are walked and the common ones are only probed
+        grams.sort(key=lambda g: len(g[1]))
+        candidates = set()
+        for _, ids in grams[:len(grams) - need + 1]:
+            candidates.update(itertools.islice(ids, self.maxCandidates - len(candidates)))
+            if len(candidates) >= self.maxCandidates:
+                break
+        scores = {}
+        for id in candidates:
+            count = sum(1 for _, ids in grams if id in ids)
+            if count >= need:
+                scores[id] = count / len(grams)
+        return scores
+
+    def search(self, term: str, limit: int = 25, types: list[str] = INDEXED_TYPES) -> list[Track]:
+        data = self.__data
+        words = normalize(term).split()
+        query = ' '.join(words)
+        if not words:
+            return []
+
+        # every query word has to start some word of the item
+        # candidates come from the longest word, the others are checked against the item text
+        words.sort(key=len, reverse=True)
+        # short prefixes match a large part of the library, only look at enough of them
+        cap = min(limit * 20, self.maxCandidates) if len(words[0]) < 3 else self.maxCandidates
+        candidates = self.__prefixMatches(data, words[0], cap)
+        if len(words) > 1:
+            candidates = [id for id in candidates
+                          if all(any(w.startswith(word) for w in data.texts[id].split()) for word in words[1:])]
+        scores = {id: 2.0 for id in candidates}
+
+        # fuzzy fallback for typos
+        if not scores:
+            scores = self.__fuzzyMatches(data, query)
+
+        res = []
+        for id, score in scores.items():
+            track = data.items[id]
+            if track.type not in types:
+                continue
+            name = data.names[id]
+            if name == query:
+                score += 2
+            elif name.startswith(query):
+                score += 1
+            res.append((-score, len(track.name), track.name, track))
+        return [r[3] for r in heapq.nsmallest(limit, res, key=lambda r: r[:3])]
+
+    async def build(self, client: JFAPI, pageSize: int = 1000):
+        started = datetime.datetime.now(datetime.timezone.utc)
+        params = {
+            'includeItemTypes': ','.join(INDEXED_TYPES),
+            'recursive': 'true',
+            'sortBy': 'SortName'
+        }
+        tracks = [track async for page in client.iterItems(params, pageSize) for track in page]
+        # searches keep using the current index until the new one is complete
+        await asyncio.to_thread(self.load, tracks)
+        self.lastSync = started
+
+    # Picks up items added or changed since the last sync
+    async def syncChanges(self, client: JFAPI, pageSize: int = 1000):
+        started = datetime.datetime.now(datetime.timezone.utc)
+        params = {
+            'includeItemTypes': ','.join(INDEXED_TYPES),
+            'recursive': 'true',
+            # overlap a little in case the clocks disagree
+            'minDateLastSaved': (self.lastSync - datetime.timedelta(minutes=5)).isoformat()
+        }
+        tracks = [track async for page in client.iterItems(params, pageSize) for track in page]
+        if tracks:
+            # a large import touches much of the word list, keep it off the event loop
+            await asyncio.to_thread(self.update, tracks)
+        self.lastSync = started
+
+    # Builds the index, then keeps it fresh with delta syncs
+    # A periodic full rebuild drops items deleted from the library
+    async def run(self, client: JFAPI, syncInterval: float = 300, rebuildInterval: float = 86400):
+        lastBuild = 0
+        while True:
+            try:
+                if not self.ready or time.monotonic() - lastBuild >= rebuildInterval:
+                    await self.build(client)
+                    lastBuild = time.monotonic()
+                else:
+                    await self.syncChanges(client)
+            except (JFAPIUnavailable, JFAPIItemError):
+                pass
+            await asyncio.sleep(syncInterval)
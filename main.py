@@ -1,86 +1,329 @@
+import time
+# startup phases are timed from here
+STARTED = time.perf_counter()
+
 import discord
 import discord.ext
 import asyncio
 import yaml
-import random
 import datetime
-
-from jfapi import JFAPI
-
+import os
+import sys
+
+from jfapi import JFAPI, JFAPIItemError, JFAPIUnavailable, Track
+from guildqueue import GuildQueue
+from streamhub import StreamHubs
+from segmentcache import SegmentCache
+from libindex import LibraryIndex, INDEXED_TYPES
+from player import Players
+from ffmpegpool import FFmpegPool
+from bitratepolicy import BitratePolicy, DEFAULT_LADDER
+from prefetcher import Prefetcher, WarmPlaylists
+from governor import ResourceGovernor
+from queuepages import QueuePages, pageWindow
+from shards import ShardCoordinator, workerShards, shardOf, recommendedShards
+from metrics import REGISTRY, MetricsServer, PROFILER
+from startup import StartupTimer, CommandRegistry
+
+STARTUP = StartupTimer(STARTED)
+STARTUP.mark('imports')
+# the C loader parses the same documents as yaml.loader.Loader, several times faster
 with open('config.yml', 'r', encoding='utf8') as conffile:
-    config = yaml.load(conffile, yaml.loader.Loader)
-
-JF_APICLIENT = JFAPI(config['jf-server'],config['jf-apikey'])
+    config = yaml.load(conffile, getattr(yaml, 'CLoader', yaml.loader.Loader))
+STARTUP.mark('config')
+
+# In sharded mode this process only supervises the workers, each worker runs this file again
+SHARD_WORKERS = max(1, config.get('shard-workers', 1))
+WORKER = workerShards()
+if SHARD_WORKERS > 1 and not WORKER:
+    shardCount = config.get('shard-count', 0) or recommendedShards(config['discord-token'])
+    ShardCoordinator(SHARD_WORKERS, shardCount, os.path.abspath(__file__)).run()
+    sys.exit()
+
+JF_APICLIENT = JFAPI(config['jf-server'],config['jf-apikey'],
+                     cacheSize=config.get('search-cache-size', 256),
+                     cacheTtl=config.get('search-cache-ttl', 300),
+                     poolSize=config.get('jf-pool-size', 100),
+                     poolSizePerHost=config.get('jf-pool-size-per-host', 30),
+                     keepalive=config.get('jf-keepalive', 30),
+                     dnsCacheTtl=config.get('jf-dns-cache-ttl', 300),
+                     timeout=config.get('jf-timeout', 15),
+                     retries=config.get('jf-retries', 2),
+                     breakerThreshold=config.get('jf-breaker-threshold', 5),
+                     breakerCooldown=config.get('jf-breaker-cooldown', 30),
+                     healthTimeout=config.get('jf-health-timeout', 5))
 LIMIT = max(1, min(config['search-limit'], 25))
 DEBUG = config["enable-debug"]
 if DEBUG:
     DEBUG_SERVER = config["debug-server"]
 PLAYLIST_PAGESIZE = 20
-
-queues = {}
-playing = {}
-
-bot = discord.Bot()
+ENQUEUE_PAGESIZE = max(1, config.get('enqueue-page-size', 100))
+PASSTHROUGH = config.get('opus-passthrough', True)
+SEGMENT_CACHE = None
+if PASSTHROUGH and config.get('segment-cache-size', 0) > 0:
+    cacheDir = config.get('segment-cache-dir', 'cache/segments')
+    cacheSize = config['segment-cache-size'] * 1024 * 1024
+    if WORKER:
+        # every worker keeps its own part of the cache, entries are renamed into place and cannot be shared
+        cacheDir = os.path.join(cacheDir, f'worker-{WORKER[2]}')
+        cacheSize //= SHARD_WORKERS
+    SEGMENT_CACHE = SegmentCache(cacheDir, cacheSize)
+LIBRARY_INDEX = None
+if config.get('library-index', True):
+    LIBRARY_INDEX = LibraryIndex(config.get('library-max-candidates', 2000), config.get('library-fuzzy-threshold', 0.4))
+GAPLESS = config.get('gapless', True)
+GAPLESS_LOOKAHEAD = config.get('gapless-lookahead', 15)
+METRICS_SERVER = None
+if config.get('metrics-port'):
+    # sharded workers listen on consecutive ports
+    METRICS_SERVER = MetricsServer(REGISTRY, config.get('metrics-host', '127.0.0.1'),
+                                   config['metrics-port'] + (WORKER[2] if WORKER else 0))
+STATE_STORE = None
+if config.get('state-file'):
+    # sqlite is only loaded when state is saved
+    from statestore import StateStore
+    STATE_STORE = StateStore(config['state-file'], config.get('state-flush-interval', 5))
+
+# guild id -> background tasks still adding pages of a large enqueue
+enqueueTasks = {}
+
+# Opens and closes the Jellyfin connection pool together with the bot
+# Each worker process opens a pool of its own
+# Commands are registered by CommandRegistry instead of py-cord's sync on every connect
+class JellyChordBot(discord.AutoShardedBot if WORKER else discord.Bot):
+    async def start(self, token: str, *, reconnect: bool = True):
+        # everything local is set up while logging in, connections to Jellyfin are opened on the side
+        self.warmupTask = self.loop.create_task(JF_APICLIENT.warmup())
+        setup = [self.login(token), JF_APICLIENT.open()]
+        if METRICS_SERVER:
+            setup.append(METRICS_SERVER.start())
+        if STATE_STORE:
+            setup.append(asyncio.to_thread(STATE_STORE.open))
+        await asyncio.gather(*setup)
+        STARTUP.mark('login')
+
+        if config.get('jf-health-interval', 15) > 0:
+            self.healthTask = self.loop.create_task(JF_APICLIENT.runHealthChecks(config.get('jf-health-interval', 15)))
+        if LIBRARY_INDEX is not None:
+            self.indexTask = self.loop.create_task(LIBRARY_INDEX.run(
+                JF_APICLIENT,
+                config.get('library-sync-interval', 300),
+                config.get('library-rebuild-interval', 86400)))
+        if PREFETCHER:
+            self.prefetchTask = self.loop.create_task(PREFETCHER.run())
+        self.governorTask = self.loop.create_task(GOVERNOR.run())
+        if STATE_STORE:
+            self.restoreTask = self.loop.create_task(restoreState())
+            self.flushTask = self.loop.create_task(STATE_STORE.run(stateSnapshot))
+        await self.connect(reconnect=reconnect)
+
+    async def on_connect(self):
+        # every shard connects, and again after a reconnect, commands are registered once
+        if hasattr(self, 'commandTask'):
+            return
+        STARTUP.mark('gateway')
+        # only the first worker changes what is registered, the others look the ids up
+        self.commandTask = self.loop.create_task(COMMAND_REGISTRY.register(sync=not WORKER or WORKER[2] == 0))
+        await self.commandTask
+        STARTUP.mark(f'commands {COMMAND_REGISTRY.result}')
+
+    async def on_ready(self):
+        if not hasattr(self, 'readyAt'):
+            self.readyAt = time.perf_counter()
+            STARTUP.mark('ready')
+            print(STARTUP.report(), flush=True)
+
+    async def on_unknown_application_command(self, interaction: discord.Interaction):
+        # registered somewhere else since the ids were cached
+        await COMMAND_REGISTRY.refresh()
+
+    async def close(self):
+        if STATE_STORE and hasattr(self, 'flushTask'):
+            # save before disconnecting, players clear their state when the voice client goes away
+            self.flushTask.cancel()
+            self.restoreTask.cancel()
+            await STATE_STORE.flush(*stateSnapshot())
+            await asyncio.to_thread(STATE_STORE.close)
+        await super().close()
+        PLAYERS.shutdown()
+        if METRICS_SERVER:
+            await METRICS_SERVER.stop()
+        await JF_APICLIENT.close()
+
+if WORKER:
+    bot = JellyChordBot(shard_ids=WORKER[0], shard_count=WORKER[1], auto_sync_commands=False)
+else:
+    bot = JellyChordBot(auto_sync_commands=False)
+COMMAND_REGISTRY = CommandRegistry(bot, config.get('command-cache', 'cache/commands.json'))
+STREAM_HUBS = StreamHubs(bot.loop, config.get('stream-sharing', True), config.get('stream-ring-size', 3000),
+                         readTimeout=JF_APICLIENT.fetchDeadline)
+FFMPEG_POOL = FFmpegPool(max(1, config.get('ffmpeg-max-processes', 16)),
+                         config.get('ffmpeg-idle', 2),
+                         config.get('ffmpeg-stall-timeout', 20),
+                         config.get('ffmpeg-cpu-budget', 0.8),
+                         config.get('ffmpeg-degraded-bitrate', 64000))
+BITRATE_POLICY = None
+if config.get('bitrate-ladder', DEFAULT_LADDER):
+    BITRATE_POLICY = BitratePolicy(JF_APICLIENT, config.get('bitrate-ladder', DEFAULT_LADDER),
+                                   config.get('bitrate-segment-latency', 2),
+                                   config.get('bitrate-jf-latency', 1),
+                                   config.get('bitrate-cpu-load', 0.8),
+                                   config.get('bitrate-hold', 30))
+PREFETCH_DEPTH = config.get('prefetch-depth', 10)
+WARM_PLAYLISTS = WarmPlaylists(config.get('warm-playlist-ttl', 60)) if PREFETCH_DEPTH > 0 else None
+PLAYERS = Players(JF_APICLIENT, STREAM_HUBS, SEGMENT_CACHE, PASSTHROUGH, GAPLESS, GAPLESS_LOOKAHEAD,
+                  max(1, config.get('player-workers', 4)), FFMPEG_POOL, BITRATE_POLICY, WARM_PLAYLISTS)
+queues = PLAYERS.queues
+playing = PLAYERS.playing
+GOVERNOR = ResourceGovernor(PLAYERS,
+                            config.get('queue-max-length', 5000),
+                            config.get('queue-max-memory', 8) * 1024 * 1024,
+                            config.get('idle-paused-timeout', 600),
+                            config.get('idle-alone-timeout', 300),
+                            reportInterval=config.get('governor-report-interval', 3600))
+SEARCH_VIEW_TIMEOUT = config.get('search-view-timeout', 60)
+
+COMMAND_SECONDS = REGISTRY.histogram('jellychord_command_seconds', 'Latency of application commands', ('command', 'status'))
+REGISTRY.gauge('jellychord_ffmpeg_processes', 'Running ffmpeg processes', PLAYERS.ffmpegProcesses)
+REGISTRY.gauge('jellychord_jf_backend_up', 'Jellyfin backends passing health checks',
+               lambda: [((b.url,), int(b.healthy)) for b in JF_APICLIENT.backends], ('backend',))
+REGISTRY.gauge('jellychord_jf_backend_outstanding', 'Requests in flight per Jellyfin backend',
+               lambda: [((b.url,), b.outstanding) for b in JF_APICLIENT.backends], ('backend',))
+if BITRATE_POLICY:
+    REGISTRY.gauge('jellychord_bitrate_step', 'Rungs below the channel bitrate tracks are requested at',
+                   lambda: BITRATE_POLICY.step)
+REGISTRY.gauge('jellychord_players', 'Guilds with an active player', lambda: len(PLAYERS.players))
+REGISTRY.gauge('jellychord_queue_length', 'Tracks queued per guild',
+               lambda: [((gid,), len(queue)) for gid, queue in list(queues.items())], ('guild',))
 
 '''
 Helper Functions
 '''
-async def searchHelper(term: str, limit: int = LIMIT, type:str = None):
+def searchTypes(type: str = None) -> list[str]:
     if type == 'Soundtrack':
-        type = ['Audio']
+        return ['Audio']
     elif type == 'Album':
-        type = ['MusicAlbum']
+        return ['MusicAlbum']
+    elif type == 'Playlist':
+        return ['Playlist']
+    elif type == 'Artist':
+        return ['MusicArtist']
     else:
-        type = ['Audio', 'MusicAlbum']
+        return ['Audio', 'MusicAlbum']
+
+def useLibraryIndex(types: list[str]) -> bool:
+    return LIBRARY_INDEX is not None and LIBRARY_INDEX.ready and all(t in INDEXED_TYPES for t in types)
+
+async def searchHelper(term: str, limit: int = LIMIT, type:str = None):
+    type = searchTypes(type)
+    if useLibraryIndex(type):
+        res = LIBRARY_INDEX.search(term, limit, type)
+        # fall back to the server for items added since the last sync
+        if res:
+            return res
     
     res = await JF_APICLIENT.search(term, limit, type)
     return res
 
-async def playHelperTrack(item: dict, ctx: discord.ApplicationContext, position: str):
-    entry = {
-        "Artists": item["Artists"],
-        "Name": item["Name"],
-        "Id": item['Id'],
-        "Length": item['RunTimeTicks'] // 10000000
-    }
+async def termAutocomplete(ctx: discord.AutocompleteContext):
+    types = searchTypes(ctx.options.get('type'))
+    if not useLibraryIndex(types):
+        return []
+    return [discord.OptionChoice(getTrackString(track, type=True)[:100], track.name[:100])
+            for track in LIBRARY_INDEX.search(ctx.value, 25, types)]
+
+async def playHelperTrack(item: Track, ctx: discord.ApplicationContext, position: str):
     global queues
+    if not GOVERNOR.admit(ctx.guild_id, [item]):
+        await ctx.respond('The queue is full')
+        return
     if not ctx.guild_id in queues:
-        queues[ctx.guild_id] = []
+        queues[ctx.guild_id] = GuildQueue()
     if position == 'last':
-        queues[ctx.guild_id].append(entry)
+        queues[ctx.guild_id].append(item)
     else:
-        queues[ctx.guild_id].insert(0, entry)
+        queues[ctx.guild_id].appendleft(item)
 
     if not ctx.voice_client:
         await startPlayer(ctx)
     elif position == 'now':
         ctx.voice_client.stop()
-
-async def playHelperAlbum(item: dict, ctx: discord.ApplicationContext, position: str):
-    tracks = await JF_APICLIENT.getAlbumTracks(item['Id'])
-    entries = [{
-        "Artists": item["Artists"],
-        "Name": item["Name"],
-        "Id": item['Id'],
-        "Length": item['RunTimeTicks'] // 10000000
-    } for item in tracks]
+    else:
+        PLAYERS.refreshPrepared(ctx.guild_id)
+
+# Enqueues albums, playlists and artists page by page
+# Playback starts as soon as the first page is queued, the rest is added in the background
+async def playHelperCollection(pages, ctx: discord.ApplicationContext, position: str):
+    pages = audioPages(pages)
+    first = GOVERNOR.admit(ctx.guild_id, await anext(pages, None))
+    if not first:
+        await pages.aclose()
+        if first is not None:
+            await ctx.respond('The queue is full')
+        return
 
     global queues
     if not ctx.guild_id in queues:
-        queues[ctx.guild_id] = []
+        queues[ctx.guild_id] = GuildQueue()
     if position == 'last':
-        queues[ctx.guild_id].extend(entries)
+        queues[ctx.guild_id].extend(first)
     else:
-        queues[ctx.guild_id][0:0] = entries
+        queues[ctx.guild_id].prepend(first)
+
+    task = bot.loop.create_task(enqueueRemaining(pages, ctx.guild_id, position, first[-1]))
+    enqueueTasks.setdefault(ctx.guild_id, set()).add(task)
+    task.add_done_callback(lambda t: enqueueTasks.get(ctx.guild_id, set()).discard(t))
     
     if not ctx.voice_client:
         await startPlayer(ctx)
     elif position == 'now':
         ctx.voice_client.stop()
+    else:
+        PLAYERS.refreshPrepared(ctx.guild_id)
+
+async def audioPages(pages):
+    async for page in pages:
+        page = [track for track in page if track.type == 'Audio']
+        if page:
+            yield page
 
-async def playHelperGeneric(item: dict, ctx: discord.ApplicationContext, position: str):
-    if item["Type"] == "MusicAlbum":
-        await playHelperAlbum(item, ctx, position)
+async def enqueueRemaining(pages, guildId: int, position: str, anchor: Track):
+    global queues
+    if position == 'last':
+        async for page in pages:
+            page = GOVERNOR.admit(guildId, page)
+            if not page:
+                await pages.aclose()
+                break
+            if not guildId in queues:
+                queues[guildId] = GuildQueue()
+            queues[guildId].extend(page)
+    else:
+        # the rest has to go right after the first page, insert it in one go
+        rest = GOVERNOR.admit(guildId, [track async for page in pages for track in page])
+        if not rest:
+            return
+        if not guildId in queues:
+            queues[guildId] = GuildQueue()
+        try:
+            index = queues[guildId].index(anchor) + 1
+        except ValueError:
+            index = 0
+        queues[guildId].insert(index, rest)
+
+    PLAYERS.refreshPrepared(guildId)
+
+def cancelEnqueue(guildId: int):
+    for task in enqueueTasks.pop(guildId, ()):
+        task.cancel()
+
+async def playHelperGeneric(item: Track, ctx: discord.ApplicationContext, position: str):
+    if item.type == "MusicAlbum":
+        await playHelperCollection(JF_APICLIENT.iterAlbumTracks(item.id, ENQUEUE_PAGESIZE), ctx, position)
+    elif item.type == "Playlist":
+        await playHelperCollection(JF_APICLIENT.iterPlaylistTracks(item.id, ENQUEUE_PAGESIZE), ctx, position)
+    elif item.type == "MusicArtist":
+        await playHelperCollection(JF_APICLIENT.iterArtistTracks(item.id, ENQUEUE_PAGESIZE), ctx, position)
     else:
         await playHelperTrack(item, ctx, position)
 
@@ -89,56 +332,86 @@ async def startPlayer(ctx: discord.ApplicationContext):
     if not vc:
         av = ctx.author.voice
         if av:
-            vc = await av.channel.connect()
-            await playTrack(ctx.guild)
-
-async def playTrack(guild: discord.Guild):
-    vc = guild.voice_client
-    if vc.paused:
-        vc.resume()
-    else:
-        await asyncio.to_thread(playNextTrack, guild)
-
-def playNextTrack(guild, error=None):
-    vc = guild.voice_client
-    br = vc.channel.bitrate
-    global playing
-    global queues
-    if guild.id in queues:
-        playing[guild.id] = queues[guild.id].pop(0)
-        playing[guild.id]['playtime-offset'] = datetime.timedelta()
-        if not queues[guild.id]: 
-            queues.pop(guild.id)
-        url = JF_APICLIENT.getAudioHls(playing[guild.id]["Id"],br)
-        # use libopus until py-cord 2.7
-        # change to 'copy' after py-cord 2.7 is out
-        audio = discord.FFmpegOpusAudio(url, codec='libopus')
-        audio.read() # remove this line when py-cord 2.7 is out
-        playing[guild.id]['starttime'] = datetime.datetime.now()
-        playing[guild.id]['paused'] = False
-        vc.play(audio, after=lambda e: playNextTrack(guild, e))
-    else:
-        playing.pop(guild.id)
-        asyncio.run_coroutine_threadsafe(vc.disconnect(), vc.loop)
+            await av.channel.connect()
+            PLAYERS.play(ctx.guild)
 
-def getTrackString(item: dict, artistLimit: int = 1, type: bool = False):
+'''
+Persistent State
+'''
+def stateSnapshot():
+    nowPlaying = {gid: (state['track'].id, PLAYERS.elapsed(gid).total_seconds(), state['channel'])
+                  for gid, state in playing.items()}
+    return queues, nowPlaying
+
+# Restores the queues saved before the last shutdown and resumes what was playing
+# Metadata is fetched in bulk while the bot logs in, guilds are restored once the gateway is ready
+async def restoreState(chunkSize: int = 100):
+    owns = (lambda gid: shardOf(gid, WORKER[1]) in WORKER[0]) if WORKER else None
+    saved = await asyncio.to_thread(STATE_STORE.load, owns)
+    try:
+        if not saved:
+            return
+        ids = list(dict.fromkeys(id for state in saved.values() for id in (state['item'], *state['queue']) if id))
+        chunks = [ids[i:i + chunkSize] for i in range(0, len(ids), chunkSize)]
+        try:
+            results = await asyncio.gather(*(JF_APICLIENT.getItemsByIds(chunk) for chunk in chunks))
+        except (JFAPIUnavailable, JFAPIItemError):
+            # the saved state stays on disk for the next start, see the finally below
+            return
+        tracks = {track.id: track for res in results for track in res}
+        await bot.wait_until_ready()
+
+        for gid, state in saved.items():
+            try:
+                await restoreGuild(gid, state, tracks)
+            except Exception as e:
+                # one guild failing to resume must not keep the others from it
+                print(f'could not restore guild {gid}: {e!r}', flush=True)
+    finally:
+        # guilds not restored save state of their own again, their old rows are kept until they do
+        STATE_STORE.abandon(STATE_STORE.pending)
+
+async def restoreGuild(gid: int, state: dict, tracks: dict):
+    items = [tracks[id] for id in state['queue'] if id in tracks]
+    current = tracks.get(state['item'])
+    guild = bot.get_guild(gid)
+    channel = guild.get_channel(state['channel']) if guild and state['channel'] else None
+    resume = current and isinstance(channel, discord.VoiceChannel) and not guild.voice_client
+    if current:
+        items.insert(0, current)
+    items = GOVERNOR.admit(gid, items)
+    if items:
+        if gid not in queues:
+            queues[gid] = GuildQueue()
+        # anything queued while we were restoring goes after the saved queue
+        queues[gid].prepend(items)
+    STATE_STORE.restored(gid)
+    if resume:
+        await channel.connect()
+        PLAYERS.play(guild, state['offset'])
+
+def getTrackString(item: Track, artistLimit: int = 1, type: bool = False):
 
     if not type:
         res = ''
-    elif item["Type"] == "MusicAlbum":
+    elif item.type == "MusicAlbum":
         res = 'Album: '
+    elif item.type == "Playlist":
+        res = 'Playlist: '
+    elif item.type == "MusicArtist":
+        res = 'Artist: '
     else:
         res = 'Track: '
 
-    if len(item["Artists"]) > artistLimit:
+    if len(item.artists) > artistLimit:
         res += 'Various Artists'
-    elif item["Artists"]:
-        res += ','.join(item["Artists"])
+    elif item.artists:
+        res += ','.join(item.artists)
     
-    if item["Artists"]:
+    if item.artists:
         res += ' - '
     
-    res += item["Name"]
+    res += item.name
     return res
 
 def formatTimeSecs(secs: int, force_hrs: bool = False) -> str:
@@ -151,11 +424,17 @@ def formatTimeSecs(secs: int, force_hrs: bool = False) -> str:
     else:
         return f'{m:02d}:{s:02d}'
 
+QUEUE_PAGES = QueuePages(queues, getTrackString, PLAYLIST_PAGESIZE)
+PREFETCHER = None
+if PREFETCH_DEPTH > 0:
+    PREFETCHER = Prefetcher(JF_APICLIENT, PLAYERS, WARM_PLAYLISTS, PREFETCH_DEPTH,
+                            max(1, config.get('prefetch-concurrency', 2)), onChange=QUEUE_PAGES.invalidate)
+
 '''
 Discord View Related
 '''
 class searchDropdown(discord.ui.Select):
-    def __init__(self, items: list[dict], ctx: discord.ApplicationContext, when: str):
+    def __init__(self, items: list[Track], ctx: discord.ApplicationContext, when: str):
         super(searchDropdown, self).__init__()
         self.ctx = ctx
         self.when = when
@@ -168,31 +447,42 @@ class searchDropdown(discord.ui.Select):
             self.add_option(label = label, value = str(i))
     
     async def callback(self, interaction: discord.Interaction):
-        await interaction.response.edit_message(content=f'Playing {getTrackString(self.items[int(self._selected_values[0])], type=True)}',view=None)
-        await playHelperGeneric(self.items[int(self._selected_values[0])], self.ctx, self.when)
+        item = self.items[int(self._selected_values[0])]
+        self.release()
+        await interaction.response.edit_message(content=f'Playing {getTrackString(item, type=True)}',view=None)
+        await playHelperGeneric(item, self.ctx, self.when)
+
+    # Lets go of the search results once the view is done with them
+    def release(self):
+        if self.items is not None:
+            self.items = None
+            GOVERNOR.count('views')
+        if self.view:
+            self.view.stop()
 
 async def onSearchViewTimeout(self: discord.ui.View):
+    for item in self.children:
+        if isinstance(item, searchDropdown):
+            item.release()
     self.disable_all_items()
     await self.message.edit("Selection timed out.", view=None)
 
 class listDropdown(discord.ui.Select):
-    def __init__(self, pages: int):
+    def __init__(self):
         super(listDropdown, self).__init__()
         self.max_values = 1
         self.min_values = 1
-        self.update_options(pages)
+        self.window = None
     
     async def callback(self, interaction: discord.Interaction):
-        pages = len(queues[interaction.guild_id])//PLAYLIST_PAGESIZE+1
-        page = int(self._selected_values[0])-1
-        tracks = queues[interaction.guild_id][page*PLAYLIST_PAGESIZE:page*PLAYLIST_PAGESIZE+PLAYLIST_PAGESIZE]
-        strs = [f'{i+page*PLAYLIST_PAGESIZE+1}. {getTrackString(tracks[i])}' for i in range(len(tracks))]
-        self.view.page = page
-        self.view.updateItems(pages)
-        await interaction.response.edit_message(content=f'Tracks in playlist:\n{"\n".join(strs)}\nPage: {page+1}/{pages}', view=self.view)
+        await self.view.show(interaction, int(self._selected_values[0])-1)
     
-    def update_options(self, pages):
-        self.options = [discord.SelectOption(label=str(i+1)) for i in range(min(pages, 25))]
+    # Offers the pages around the current one, so queues longer than 25 pages can still be jumped through
+    def update_options(self, page, pages):
+        window = pageWindow(page, pages)
+        if window != self.window:
+            self.window = window
+            self.options = [discord.SelectOption(label=str(i+1)) for i in window]
 
 class listPrevButton(discord.ui.Button):
     def __init__(self):
@@ -200,13 +490,7 @@ class listPrevButton(discord.ui.Button):
         self.label = '◁'
 
     async def callback(self, interaction: discord.Interaction):
-        pages = len(queues[interaction.guild_id])//PLAYLIST_PAGESIZE+1
-        self.view.page -= 1
-        page = self.view.page
-        tracks = queues[interaction.guild_id][page*PLAYLIST_PAGESIZE:page*PLAYLIST_PAGESIZE+PLAYLIST_PAGESIZE]
-        strs = [f'{i+page*PLAYLIST_PAGESIZE+1}. {getTrackString(tracks[i])}' for i in range(len(tracks))]
-        self.view.updateItems(pages)
-        await interaction.response.edit_message(content=f'Tracks in playlist:\n{"\n".join(strs)}\nPage: {page+1}/{pages}', view=self.view)
+        await self.view.show(interaction, self.view.page - 1)
 
 class listNextButton(discord.ui.Button):
     def __init__(self):
@@ -214,13 +498,7 @@ class listNextButton(discord.ui.Button):
         self.label = '▷'
 
     async def callback(self, interaction: discord.Interaction):
-        pages = len(queues[interaction.guild_id])//PLAYLIST_PAGESIZE+1
-        self.view.page += 1
-        page = self.view.page
-        tracks = queues[interaction.guild_id][page*PLAYLIST_PAGESIZE:page*PLAYLIST_PAGESIZE+PLAYLIST_PAGESIZE]
-        strs = [f'{i+page*PLAYLIST_PAGESIZE+1}. {getTrackString(tracks[i])}' for i in range(len(tracks))]
-        self.view.updateItems(pages)
-        await interaction.response.edit_message(content=f'Tracks in playlist:\n{"\n".join(strs)}\nPage: {page+1}/{pages}', view=self.view)
+        await self.view.show(interaction, self.view.page + 1)
 
 
 class listRefreshButton(discord.ui.Button):
@@ -229,31 +507,32 @@ class listRefreshButton(discord.ui.Button):
         self.label = '⟳'
     
     async def callback(self, interaction: discord.Interaction):
-        pages = len(queues[interaction.guild_id])//PLAYLIST_PAGESIZE+1
-        page = self.view.page
-        tracks = queues[interaction.guild_id][page*PLAYLIST_PAGESIZE:page*PLAYLIST_PAGESIZE+PLAYLIST_PAGESIZE]
-        strs = [f'{i+page*PLAYLIST_PAGESIZE+1}. {getTrackString(tracks[i])}' for i in range(len(tracks))]
-        self.view.updateItems(pages)
-        await interaction.response.edit_message(content=f'Tracks in playlist:\n{"\n".join(strs)}\nPage: {page+1}/{pages}', view=self.view)
+        await self.view.show(interaction, self.view.page)
 
 
 class listView(discord.ui.View):
     def __init__(self, pages: int):
         super(listView, self).__init__()
         self.page = 0
-        self.selection = listDropdown(pages)
+        self.selection = listDropdown()
         self.prevButton = listPrevButton()
         self.nextButton = listNextButton()
-        self.prevButton.disabled = True
         self.add_item(self.prevButton)
         self.add_item(listRefreshButton())
         self.add_item(self.nextButton)
         self.add_item(self.selection)
+        self.updateItems(pages)
     
     def updateItems(self, pages):
         self.prevButton.disabled = self.page == 0
-        self.nextButton.disabled = self.page == pages - 1
-        self.selection.update_options(pages)
+        self.nextButton.disabled = self.page >= pages - 1
+        self.selection.update_options(self.page, pages)
+
+    async def show(self, interaction: discord.Interaction, page: int):
+        pages = QUEUE_PAGES.count(interaction.guild_id)
+        self.page = max(0, min(page, pages - 1))
+        self.updateItems(pages)
+        await interaction.response.edit_message(content=QUEUE_PAGES.render(interaction.guild_id, self.page), view=self)
     
     async def on_timeout(self):
         self.disable_all_items()
@@ -261,6 +540,34 @@ class listView(discord.ui.View):
 '''
 Bot Commands
 '''
+def observeCommand(ctx: discord.ApplicationContext, status: str):
+    started = getattr(ctx, 'metricsStarted', None)
+    if started is not None:
+        COMMAND_SECONDS.observe(time.perf_counter() - started, ctx.command.qualified_name, status)
+        if PREFETCHER:
+            PREFETCHER.commandFinished()
+
+@bot.event
+async def on_application_command(ctx: discord.ApplicationContext):
+    ctx.metricsStarted = time.perf_counter()
+    # background prefetching waits until commands are done
+    if PREFETCHER:
+        PREFETCHER.commandStarted()
+
+@bot.event
+async def on_application_command_completion(ctx: discord.ApplicationContext):
+    observeCommand(ctx, 'ok')
+
+@bot.event
+async def on_application_command_error(ctx: discord.ApplicationContext, error: discord.DiscordException):
+    observeCommand(ctx, 'error')
+    if isinstance(getattr(error, 'original', error), JFAPIUnavailable):
+        await ctx.respond('Jellyfin server is unavailable, please try again later')
+    elif isinstance(getattr(error, 'original', error), JFAPIItemError):
+        await ctx.respond('Jellyfin could not find that item')
+    else:
+        await discord.Bot.on_application_command_error(bot, ctx, error)
+
 if DEBUG:
     cmdgrp = bot.create_group(config['command-group'], guild_ids=[DEBUG_SERVER])
 else:
@@ -268,8 +575,8 @@ else:
 
 @cmdgrp.command()
 async def search(ctx: discord.ApplicationContext, 
-                 term: discord.Option(str),
-                 type: discord.Option(str, choices=['Soundtrack', 'Album'], required=False),
+                 term: discord.Option(str, autocomplete=termAutocomplete),
+                 type: discord.Option(str, choices=['Soundtrack', 'Album', 'Playlist', 'Artist'], required=False),
                  when: discord.Option(str, choices=['now', 'next', 'last'], required=False) = 'last'):
     
     await ctx.defer(invisible=True)
@@ -279,7 +586,7 @@ async def search(ctx: discord.ApplicationContext,
     elif not ctx.author.voice and not ctx.voice_client:
         await ctx.respond('You are not in any voice channel')
     else:
-        view = discord.ui.View()
+        view = discord.ui.View(timeout=SEARCH_VIEW_TIMEOUT)
         view.on_timeout = onSearchViewTimeout
         view.add_item(searchDropdown(res, ctx, when))
 
@@ -287,8 +594,8 @@ async def search(ctx: discord.ApplicationContext,
 
 @cmdgrp.command()
 async def play(ctx: discord.ApplicationContext,
-               term: discord.Option(str),
-               type: discord.Option(str, choices=['Soundtrack', 'Album'], required=False),
+               term: discord.Option(str, autocomplete=termAutocomplete),
+               type: discord.Option(str, choices=['Soundtrack', 'Album', 'Playlist', 'Artist'], required=False),
                when: discord.Option(str, choices=['now', 'next', 'last'], required=False) = 'last'):
     
     await ctx.defer(invisible=True)
@@ -313,21 +620,17 @@ async def skip(ctx: discord.ApplicationContext):
 @cmdgrp.command()
 async def nowplaying(ctx: discord.ApplicationContext):
     if ctx.guild_id in playing:
-        track = playing[ctx.guild_id]
-        td = track['playtime-offset']
-        if not playing[ctx.guild_id]['paused']:
-            td += datetime.datetime.now() - track['starttime']
-        length = track["Length"]
-        await ctx.respond(f'Currently Playing: {getTrackString(track)} {formatTimeSecs(td.seconds, length >= 3600)}/{formatTimeSecs(length)}')
+        state = playing[ctx.guild_id]
+        td = PLAYERS.elapsed(ctx.guild_id)
+        length = state['track'].length
+        await ctx.respond(f'Currently Playing: {getTrackString(state["track"])} {formatTimeSecs(td.seconds, length >= 3600)}/{formatTimeSecs(length)}')
     else:
         await ctx.respond('Not Currently Playing')
 
 @cmdgrp.command()
 async def queue(ctx: discord.ApplicationContext):
     if ctx.guild_id in queues:
-        tracks = queues[ctx.guild_id]
-        strs = [f'{i}. {getTrackString(tracks[i])}' for i in range(min(len(tracks), PLAYLIST_PAGESIZE))]
-        await ctx.respond(f'Tracks in playlist:\n{"\n".join(strs)}\nPage: 1/{len(tracks)//PLAYLIST_PAGESIZE+1}', view=listView(len(tracks)//PLAYLIST_PAGESIZE+1))
+        await ctx.respond(QUEUE_PAGES.render(ctx.guild_id, 0), view=listView(QUEUE_PAGES.count(ctx.guild_id)))
     else:
         await ctx.respond('Empty Queue')
 
@@ -379,6 +682,8 @@ async def stop(ctx: discord.ApplicationContext):
         global queues
         if ctx.guild_id in queues:
             queues.pop(ctx.guild_id)
+        cancelEnqueue(ctx.guild_id)
+        PLAYERS.discardPrepared(ctx.guild_id)
         ctx.voice_client.stop()
     else:
         await ctx.respond('Not connected to any voice channel')
@@ -390,7 +695,8 @@ async def shuffle(ctx: discord.ApplicationContext):
         await ctx.respond('Playlist is empty')
     else:
         await ctx.respond('Shuffling playlist')
-        random.shuffle(queues[ctx.guild_id])
+        queues[ctx.guild_id].shuffle()
+        PLAYERS.refreshPrepared(ctx.guild_id)
 
 @cmdgrp.command()
 async def remove(ctx: discord.ApplicationContext,
@@ -404,6 +710,7 @@ async def remove(ctx: discord.ApplicationContext,
         item = queues[ctx.guild_id].pop(index-1)
         if not queues[ctx.guild_id]:
             queues.pop(ctx.guild_id)
+        PLAYERS.refreshPrepared(ctx.guild_id)
         await ctx.respond(f'Deleted track: {getTrackString(item)}')
 
 @cmdgrp.command()
@@ -415,8 +722,8 @@ async def promote(ctx: discord.ApplicationContext,
     elif len(queues[ctx.guild_id]) < index:
         await ctx.respond('Specified index does not exist')
     else:
-        item = queues[ctx.guild_id].pop(index-1)
-        queues[ctx.guild_id].insert(0, item)
+        item = queues[ctx.guild_id].moveToFront(index-1)
+        PLAYERS.refreshPrepared(ctx.guild_id)
         await ctx.respond(f'Promoted track to the front: {getTrackString(item)}')
 
 @cmdgrp.command()
@@ -428,8 +735,8 @@ async def demote(ctx: discord.ApplicationContext,
     elif len(queues[ctx.guild_id]) < index:
         await ctx.respond('Specified index does not exist')
     else:
-        item = queues[ctx.guild_id].pop(index-1)
-        queues[ctx.guild_id].append(item)
+        item = queues[ctx.guild_id].moveToBack(index-1)
+        PLAYERS.refreshPrepared(ctx.guild_id)
         await ctx.respond(f'Promoted track to the front: {getTrackString(item)}')
 
 @cmdgrp.command()
@@ -441,8 +748,8 @@ async def playnow(ctx: discord.ApplicationContext,
     elif len(queues[ctx.guild_id]) < index:
         await ctx.respond('Specified index does not exist')
     else:
-        item = queues[ctx.guild_id].pop(index-1)
-        queues[ctx.guild_id].insert(0, item)
+        item = queues[ctx.guild_id].moveToFront(index-1)
+        PLAYERS.discardPrepared(ctx.guild_id)
         await ctx.respond(f'Now playing track: {getTrackString(item)}')
         ctx.voice_client.stop()
 
@@ -454,6 +761,8 @@ async def clear(ctx: discord.ApplicationContext):
     else:
         await ctx.respond('Playlist cleared')
         queues.pop(ctx.guild_id)
+        cancelEnqueue(ctx.guild_id)
+        PLAYERS.discardPrepared(ctx.guild_id)
 
 '''
 Debug Commands
@@ -477,5 +786,33 @@ if DEBUG:
             await ctx.respond(f'Playing {getTrackString(res[0], type=True)}')
             await playHelperGeneric(res[0], ctx, when)
 
+    @dbgcmd.command()
+    async def cachestats(ctx: discord.ApplicationContext):
+        lines = []
+        for name, cache in (('Search cache', JF_APICLIENT.searchCache), ('Segment cache', SEGMENT_CACHE),
+                            ('Stream hubs', STREAM_HUBS), ('State store', STATE_STORE), ('Queue pages', QUEUE_PAGES),
+                            ('ffmpeg pool', FFMPEG_POOL), ('Jellyfin', JF_APICLIENT), ('Bitrate policy', BITRATE_POLICY),
+                            ('Prefetcher', PREFETCHER), ('Governor', GOVERNOR)):
+            if cache is None:
+                lines.append(f'{name}: disabled')
+            else:
+                lines.append(f'{name}: ' + ', '.join(f'{k}: {v}' for k, v in cache.stats().items()))
+        await ctx.respond('\n'.join(lines))
 
+    @dbgcmd.command()
+    async def profile(ctx: discord.ApplicationContext,
+                      action: discord.Option(str, choices=['start', 'stop', 'report'])):
+        if action == 'start':
+            PROFILER.start()
+            await ctx.respond('Profiler started')
+            return
+        if action == 'stop':
+            PROFILER.stop()
+        lines = [f'{count / max(PROFILER.samples, 1):.1%} {" <- ".join(stack[:3])}' for count, stack in PROFILER.report()]
+        report = '\n'.join(lines) or 'No samples'
+        state = 'running' if PROFILER.running else 'stopped'
+        await ctx.respond(f'Profiler {state}, {PROFILER.samples} samples\n```\n{report[:1800]}\n```')
+
+
+STARTUP.mark('setup')
 bot.run(config['discord-token'])
\ No newline at end of file
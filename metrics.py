@@ -0,0 +1,203 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labelText(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + '}'
+
+class Counter():
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.__values = collections.defaultdict(float)
+        self.__lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labels):
+        with self.__lock:
+            self.__values[labels] += amount
+
+    def render(self) -> list[str]:
+        with self.__lock:
+            values = list(self.__values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_labelText(self.labels, k)} {v}' for k, v in values)
+        return lines
+
+class Histogram():
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per bucket counts..., +Inf count, sum]
+        self.__values = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            row = self.__values.get(labels)
+            if row is None:
+                row = self.__values[labels] = [0] * (len(self.buckets) + 2)
+            row[i] += 1
+            row[-1] += value
+
+    # Times the block and records it, e.g. with HIST.time('search'):
+    def time(self, *labels) -> '_Timer':
+        return _Timer(self, labels)
+
+    def render(self) -> list[str]:
+        with self.__lock:
+            values = [(k, list(v)) for k, v in self.__values.items()]
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        for labels, row in values:
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), row):
+                total += count
+                lines.append(f'{self.name}_bucket{_labelText(names, (*labels, bound))} {total}')
+            lines.append(f'{self.name}_sum{_labelText(self.labels, labels)} {row[-1]}')
+            lines.append(f'{self.name}_count{_labelText(self.labels, labels)} {total}')
+        return lines
+
+class _Timer():
+    def __init__(self, histogram: Histogram, labels: tuple) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+# Value read when scraped, fn returns a number or a list of (label values, number)
+class Gauge():
+    def __init__(self, name: str, help: str, fn, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labels = labels
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        value = self.fn()
+        if self.labels:
+            lines.extend(f'{self.name}{_labelText(self.labels, k)} {v}' for k, v in value)
+        else:
+            lines.append(f'{self.name} {value}')
+        return lines
+
+class Registry():
+    def __init__(self) -> None:
+        self.__metrics = {}
+
+    def __add(self, metric):
+        self.__metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self.__add(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self.__add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name: str, help: str, fn, labels: tuple = ()) -> Gauge:
+        return self.__add(Gauge(name, help, fn, labels))
+
+    # Prometheus text exposition format
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.__metrics.values()):
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+# Serves the registry on /metrics for Prometheus to scrape
+class MetricsServer():
+    def __init__(self, registry: Registry, host: str = '127.0.0.1', port: int = 9108) -> None:
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.__runner = None
+
+    async def __handle(self, request):
+        from aiohttp import web
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    # aiohttp.web is only imported when the server is enabled
+    async def start(self):
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_get('/metrics', self.__handle)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.__runner:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+# Samples the stacks of all threads at a fixed interval and counts identical stacks
+# Cheap enough to leave running for a while on a live bot, nothing is collected while stopped
+class SamplingProfiler():
+    def __init__(self, interval: float = 0.005, depth: int = 8) -> None:
+        self.interval = interval
+        self.depth = depth
+        self.samples = 0
+        self.__stacks = collections.Counter()
+        self.__thread = None
+        self.__stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.__stacks.clear()
+        self.samples = 0
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        own = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame and len(stack) < self.depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.__stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    # Most sampled stacks, innermost frame first
+    def report(self, limit: int = 10) -> list[tuple[int, tuple]]:
+        return self.__stacks.most_common(limit)
+
+PROFILER = SamplingProfiler()
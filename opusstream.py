@@ -0,0 +1,349 @@
+import asyncio
+import collections
+import re
+import struct
+import urllib.parse
+
+# Discord expects 20ms Opus packets, 960 samples at 48khz
+FRAME_SAMPLES = 960
+SAMPLE_RATE = 48000
+
+class UnsupportedStream(Exception):
+    pass
+
+'''
+HLS Playlists
+'''
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+def parseAttributes(line: str) -> dict:
+    return {k: v.strip('"') for k, v in _ATTR_RE.findall(line.split(':', 1)[1])}
+
+class Playlist():
+    def __init__(self, text: str, baseUrl: str) -> None:
+        self.url = baseUrl
+        self.variants = []
+        self.segments = []
+        # seconds of each segment from #EXTINF, None where a segment has none
+        self.durations = []
+        self.init = None
+        self.ended = False
+        self.targetDuration = 6
+        self.mediaSequence = 0
+
+        streamInf = None
+        duration = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('#EXT-X-STREAM-INF'):
+                streamInf = parseAttributes(line)
+            elif line.startswith('#EXT-X-MAP'):
+                self.init = urllib.parse.urljoin(baseUrl, parseAttributes(line)['URI'])
+            elif line.startswith('#EXT-X-TARGETDURATION'):
+                self.targetDuration = float(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-MEDIA-SEQUENCE'):
+                self.mediaSequence = int(line.split(':', 1)[1])
+            elif line.startswith('#EXT-X-ENDLIST'):
+                self.ended = True
+            elif line.startswith('#EXTINF'):
+                duration = float(line.split(':', 1)[1].split(',', 1)[0])
+            elif line.startswith('#'):
+                continue
+            elif streamInf is not None:
+                self.variants.append((streamInf, urllib.parse.urljoin(baseUrl, line)))
+                streamInf = None
+            else:
+                self.segments.append(urllib.parse.urljoin(baseUrl, line))
+                self.durations.append(duration)
+                duration = None
+
+    # Index of the segment playing seconds into the stream, and how far into that segment it is
+    # Without durations to go by the stream has to be read from the first segment
+    def locate(self, seconds: float) -> tuple[int, float]:
+        if None in self.durations:
+            return 0, seconds
+        for i, duration in enumerate(self.durations):
+            if seconds < duration:
+                return i, seconds
+            seconds -= duration
+        return len(self.segments), 0
+
+async def loadPlaylist(client, url: str) -> Playlist:
+    text = (await client.fetch(url)).decode('utf8')
+    return Playlist(text, url)
+
+# Follows a master playlist to its highest bandwidth variant
+# Returns the media playlist and the attributes of the variant chosen, empty without a master playlist
+async def resolvePlaylist(client, url: str) -> tuple[Playlist, dict]:
+    playlist = await loadPlaylist(client, url)
+    if not playlist.variants:
+        return playlist, {}
+    attrs, url = max(playlist.variants, key=lambda v: int(v[0].get('BANDWIDTH', 0)))
+    return await loadPlaylist(client, url), attrs
+
+# Yields the init segment, if any, and then every media segment in order starting at first
+# Live playlists are reloaded until they end
+async def iterSegments(client, playlist: Playlist, first: int = 0):
+    if playlist.init:
+        yield await client.fetch(playlist.init)
+
+    seen = playlist.mediaSequence + len(playlist.segments)
+    segments = collections.deque(playlist.segments[first:])
+    while True:
+        if not segments:
+            if playlist.ended:
+                break
+            # live playlist, wait for more segments
+            await asyncio.sleep(playlist.targetDuration / 2)
+            playlist = await loadPlaylist(client, playlist.url)
+            new = playlist.mediaSequence + len(playlist.segments) - seen
+            if new > 0:
+                segments.extend(playlist.segments[-new:])
+                seen += new
+            continue
+        yield await client.fetch(segments.popleft())
+
+'''
+Fragmented MP4
+'''
+def iterBoxes(data, start: int = 0, end: int = None):
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield kind, pos, pos + header, pos + size
+        pos += size
+
+def findBox(data, path: list[bytes], start: int = 0, end: int = None):
+    for kind, _, bodyStart, bodyEnd in iterBoxes(data, start, end):
+        if kind == path[0]:
+            if len(path) == 1:
+                return bodyStart, bodyEnd
+            res = findBox(data, path[1:], bodyStart, bodyEnd)
+            if res:
+                return res
+    return None
+
+# Like findBox, for boxes a well formed segment always has
+def requireBox(data, path: list[bytes], start: int = 0, end: int = None):
+    res = findBox(data, path, start, end)
+    if not res:
+        raise UnsupportedStream(f'{b"/".join(path).decode(errors="replace")} box missing')
+    return res
+
+# Demuxes Opus packets out of fMP4 segments fed in order, the init segment first
+# A malformed segment raises UnsupportedStream like any other stream that cannot be played
+class OpusDemuxer():
+    def __init__(self) -> None:
+        self.trackId = None
+        self.timescale = SAMPLE_RATE
+        self.defaultDuration = 0
+        self.defaultSize = 0
+
+    def feed(self, data) -> list[tuple[bytes, int]]:
+        packets = []
+        try:
+            for kind, pos, bodyStart, bodyEnd in iterBoxes(data):
+                if kind == b'moov':
+                    self.__parseMoov(data, bodyStart, bodyEnd)
+                elif kind == b'moof':
+                    if self.trackId is None:
+                        raise UnsupportedStream('media fragment before init segment')
+                    packets.extend(self.__parseMoof(data, pos, bodyStart, bodyEnd))
+        except (struct.error, IndexError, ZeroDivisionError) as e:
+            # a field reaching past the end of its box, or a zero timescale
+            raise UnsupportedStream(f'truncated box: {e}') from e
+        return packets
+
+    def __parseMoov(self, data, start: int, end: int):
+        for kind, _, trakStart, trakEnd in iterBoxes(data, start, end):
+            if kind != b'trak':
+                continue
+            hdlr = findBox(data, [b'mdia', b'hdlr'], trakStart, trakEnd)
+            if not hdlr or data[hdlr[0] + 8:hdlr[0] + 12] != b'soun':
+                continue
+            stsd = findBox(data, [b'mdia', b'minf', b'stbl', b'stsd'], trakStart, trakEnd)
+            codec = bytes(data[stsd[0] + 12:stsd[0] + 16]) if stsd else None
+            if codec != b'Opus':
+                raise UnsupportedStream(f'audio codec is {codec}')
+
+            tkhd = requireBox(data, [b'tkhd'], trakStart, trakEnd)
+            version = data[tkhd[0]]
+            self.trackId = struct.unpack_from('>I', data, tkhd[0] + (20 if version else 12))[0]
+            mdhd = requireBox(data, [b'mdia', b'mdhd'], trakStart, trakEnd)
+            version = data[mdhd[0]]
+            self.timescale = struct.unpack_from('>I', data, mdhd[0] + (20 if version else 12))[0]
+            break
+        else:
+            raise UnsupportedStream('no audio track')
+
+        mvex = findBox(data, [b'mvex'], start, end)
+        if mvex:
+            for kind, _, trexStart, _ in iterBoxes(data, mvex[0], mvex[1]):
+                if kind == b'trex' and struct.unpack_from('>I', data, trexStart + 4)[0] == self.trackId:
+                    self.defaultDuration, self.defaultSize = struct.unpack_from('>II', data, trexStart + 12)
+
+    def __parseMoof(self, data, moofPos: int, start: int, end: int) -> list[tuple[bytes, int]]:
+        packets = []
+        for kind, _, trafStart, trafEnd in iterBoxes(data, start, end):
+            if kind != b'traf':
+                continue
+            tfhd = requireBox(data, [b'tfhd'], trafStart, trafEnd)
+            flags = struct.unpack_from('>I', data, tfhd[0])[0] & 0xffffff
+            trackId = struct.unpack_from('>I', data, tfhd[0] + 4)[0]
+            if trackId != self.trackId:
+                continue
+            pos = tfhd[0] + 8
+            base = moofPos
+            duration = self.defaultDuration
+            size = self.defaultSize
+            if flags & 0x1:
+                base = struct.unpack_from('>Q', data, pos)[0]
+                pos += 8
+            if flags & 0x2:
+                pos += 4
+            if flags & 0x8:
+                duration = struct.unpack_from('>I', data, pos)[0]
+                pos += 4
+            if flags & 0x10:
+                size = struct.unpack_from('>I', data, pos)[0]
+
+            offset = base
+            for kind, _, trunStart, _ in iterBoxes(data, trafStart, trafEnd):
+                if kind != b'trun':
+                    continue
+                flags = struct.unpack_from('>I', data, trunStart)[0] & 0xffffff
+                count = struct.unpack_from('>I', data, trunStart + 4)[0]
+                pos = trunStart + 8
+                if flags & 0x1:
+                    offset = base + struct.unpack_from('>i', data, pos)[0]
+                    pos += 4
+                if flags & 0x4:
+                    pos += 4
+                for _ in range(count):
+                    sampleDuration = duration
+                    sampleSize = size
+                    if flags & 0x100:
+                        sampleDuration = struct.unpack_from('>I', data, pos)[0]
+                        pos += 4
+                    if flags & 0x200:
+                        sampleSize = struct.unpack_from('>I', data, pos)[0]
+                        pos += 4
+                    if flags & 0x400:
+                        pos += 4
+                    if flags & 0x800:
+                        pos += 4
+                    packets.append((bytes(data[offset:offset + sampleSize]), sampleDuration * SAMPLE_RATE // self.timescale))
+                    offset += sampleSize
+        return packets
+
+'''
+Stream
+'''
+# Opus HLS stream from Jellyfin, demuxed without ffmpeg
+# With a segment cache, complete streams are stored on first play and later plays are read from disk
+# resolved is (playlist, attrs) when the playlist was already fetched
+# offset starts the stream that many seconds in, segments before it are not fetched
+class OpusHlsStream():
+    def __init__(self, client, url: str, cache = None, cacheKey: tuple = None, resolved: tuple = None,
+                 offset: float = 0) -> None:
+        self.__client = client
+        self.__url = url
+        self.__resolved = resolved
+        self.__offset = offset
+        # set while segments are fetched from the server and the stream has not ended
+        self.__transcoding = False
+        self.__cache = cache
+        self.__cacheKey = cacheKey
+        self.__segments = None
+        self.__demuxer = OpusDemuxer()
+
+    # Reads up to the first media segment and returns its packets
+    # Raises UnsupportedStream if the server did not send 20ms Opus in fMP4
+    async def open(self) -> list[bytes]:
+        maps = None
+        if self.__cache and self.__cacheKey:
+            maps = await asyncio.to_thread(self.__cache.lookup, *self.__cacheKey)
+        if maps is not None:
+            # reading from disk is cheap, the offset is skipped by demuxing
+            self.__segments = self.__cachedSegments(maps)
+            into = self.__offset
+        else:
+            playlist, attrs = self.__resolved or await resolvePlaylist(self.__client, self.__url)
+            if 'CODECS' in attrs and 'opus' not in attrs['CODECS'].lower():
+                raise UnsupportedStream(f'stream codecs are {attrs["CODECS"]}')
+            first, into = playlist.locate(self.__offset) if self.__offset else (0, 0)
+            self.__segments = self.__networkSegments(playlist, first)
+        # packets of the first segment fetched that lie before the offset
+        skip = round(into * SAMPLE_RATE / FRAME_SAMPLES)
+
+        packets = []
+        try:
+            while not packets:
+                packets = self.__demuxer.feed(await anext(self.__segments))
+                # without a moov up front this is not fMP4, e.g. MPEG-TS segments
+                if self.__demuxer.trackId is None:
+                    raise UnsupportedStream('stream does not start with an fMP4 init segment')
+                dropped = min(skip, len(packets))
+                packets = packets[dropped:]
+                skip -= dropped
+        except StopAsyncIteration:
+            pass
+        except BaseException:
+            await self.close()
+            raise
+        if any(duration != FRAME_SAMPLES for _, duration in packets[:-1]):
+            await self.close()
+            raise UnsupportedStream('stream does not use 20ms frames')
+        return [packet for packet, _ in packets]
+
+    # Yields the packets of each remaining segment
+    async def packets(self):
+        async for data in self.__segments:
+            yield [packet for packet, _ in self.__demuxer.feed(data)]
+
+    async def close(self):
+        if self.__segments:
+            await self.__segments.aclose()
+        if self.__transcoding:
+            self.__transcoding = False
+            await self.__client.stopTranscode(self.__url)
+
+    async def __cachedSegments(self, maps: list):
+        try:
+            for data in maps:
+                yield data
+                data.close()
+        finally:
+            for data in maps:
+                data.close()
+
+    async def __networkSegments(self, playlist: Playlist, first: int = 0):
+        self.__transcoding = True
+        writer = None
+        # only a stream read from its first segment is complete enough to cache
+        if self.__cache and self.__cacheKey and playlist.ended and not first:
+            writer = await asyncio.to_thread(self.__cache.writer, *self.__cacheKey)
+        try:
+            async for data in iterSegments(self.__client, playlist, first):
+                if writer:
+                    await asyncio.to_thread(writer.add, data)
+                yield data
+            self.__transcoding = False
+
+            if writer:
+                await asyncio.to_thread(writer.commit)
+                writer = None
+        finally:
+            if writer:
+                await asyncio.to_thread(writer.abort)
@@ -0,0 +1,275 @@
+import asyncio
+import datetime
+import time
+
+import discord
+
+from jfapi import JFAPI, JFAPIItemError, JFAPIUnavailable, Track
+from guildqueue import GuildQueue
+from opusstream import OpusHlsStream, UnsupportedStream
+from ffmpegpool import FFmpegPool
+from bitratepolicy import BitratePolicy
+from metrics import REGISTRY
+
+SOURCE_OPEN_SECONDS = REGISTRY.histogram('jellychord_source_open_seconds',
+                                         'Time from requesting a track until its first audio packet is ready', ('kind',))
+TRACK_START_SECONDS = REGISTRY.histogram('jellychord_track_start_seconds',
+                                         'Time from taking a track off the queue until it plays', ('prepared',))
+
+# Errors that make one track unplayable, the player moves on to the next one
+# the demuxer reports malformed segments as UnsupportedStream
+TRACK_ERRORS = (JFAPIUnavailable, JFAPIItemError, UnsupportedStream, discord.ClientException)
+
+# Drives playback for one guild as a task on the event loop
+# The voice client's after callback only sets an event, queue and state changes all happen on the loop
+class GuildPlayer():
+    def __init__(self, players: 'Players', guild: discord.Guild, offset: float = 0) -> None:
+        self.players = players
+        self.guild = guild
+        # seconds into the first track to start at, used when resuming after a restart
+        self.offset = offset
+        self.trackEnded = asyncio.Event()
+        self.task = None
+        # (queue entry, primed audio source) for the track after the current one
+        self.prepared = None
+        self.prepareTask = None
+        # queue entry the prepare task is opening right now
+        self.preparing = None
+        self.prepareWindow = False
+
+    async def run(self):
+        queues = self.players.queues
+        playing = self.players.playing
+        gid = self.guild.id
+        try:
+            while True:
+                vc = self.guild.voice_client
+                if not vc or not vc.is_connected() or gid not in queues:
+                    break
+                track = queues[gid].popleft()
+                started = time.perf_counter()
+                if not queues[gid]:
+                    queues.pop(gid)
+                offset, self.offset = self.offset, 0
+                playing[gid] = {'track': track, 'playtime-offset': datetime.timedelta(seconds=offset),
+                                'channel': vc.channel.id}
+                self.cancelPrepare()
+
+                audio = None if offset else self.takePrepared(track)
+                prepared = 'yes' if audio else 'no'
+                if not audio:
+                    try:
+                        audio = await self.players.createAudioSource(track, vc.channel.bitrate, offset)
+                    except TRACK_ERRORS:
+                        # skip a track that cannot be opened instead of stopping the whole queue
+                        continue
+                if not vc.is_connected():
+                    audio.cleanup()
+                    break
+
+                playing[gid]['starttime'] = datetime.datetime.now()
+                playing[gid]['paused'] = False
+                self.trackEnded.clear()
+                loop = asyncio.get_running_loop()
+                vc.play(audio, after=lambda e: loop.call_soon_threadsafe(self.trackEnded.set))
+                TRACK_START_SECONDS.observe(time.perf_counter() - started, prepared)
+                self.schedulePrepare(track.length - offset - self.players.lookahead)
+                await self.trackEnded.wait()
+        finally:
+            self.cancelPrepare()
+            self.discardPrepared()
+            playing.pop(gid, None)
+            self.players.players.pop(gid, None)
+            vc = self.guild.voice_client
+            if vc and vc.is_connected():
+                await vc.disconnect()
+
+    '''
+    Gapless Playback
+    The source for the head of the queue is opened and primed shortly before the current track ends,
+    so the track change only has to swap it in
+    '''
+    def takePrepared(self, entry: Track):
+        item = self.prepared
+        self.prepared = None
+        if not item:
+            return None
+        if item[0] is entry:
+            return item[1]
+        item[1].cleanup()
+        return None
+
+    def discardPrepared(self):
+        if self.prepared:
+            self.prepared[1].cleanup()
+            self.prepared = None
+
+    def cancelPrepare(self):
+        self.prepareWindow = False
+        if self.prepareTask:
+            self.prepareTask.cancel()
+            self.prepareTask = None
+        self.preparing = None
+
+    def schedulePrepare(self, delay: float):
+        if not self.players.gapless:
+            return
+        if self.prepareTask:
+            self.prepareTask.cancel()
+        self.preparing = None
+        self.prepareTask = asyncio.get_running_loop().create_task(self.prepareNextTrack(max(0, delay)))
+
+    async def prepareNextTrack(self, delay: float):
+        await asyncio.sleep(delay)
+        self.prepareWindow = True
+        queue = self.players.queues.get(self.guild.id)
+        entry = queue[0] if queue else None
+        vc = self.guild.voice_client
+        if not vc or not entry or (self.prepared and self.prepared[0] is entry):
+            return
+
+        self.preparing = entry
+        try:
+            audio = await self.players.createAudioSource(entry, vc.channel.bitrate)
+        except TRACK_ERRORS:
+            # the track change will try again
+            return
+        finally:
+            if self.prepareTask is asyncio.current_task():
+                self.preparing = None
+        queue = self.players.queues.get(self.guild.id)
+        if queue and queue[0] is entry and not self.prepared:
+            self.prepared = (entry, audio)
+        else:
+            # queue head changed while we were preparing
+            audio.cleanup()
+
+    # Call after anything that may change the head of the queue
+    # drops a stale prepared source, and rebuilds it if we are already inside the look-ahead window
+    def refreshPrepared(self):
+        queue = self.players.queues.get(self.guild.id)
+        entry = queue[0] if queue else None
+        if self.prepared and self.prepared[0] is entry:
+            return
+        self.discardPrepared()
+        # the head is already being opened, starting over would open it twice
+        if entry is not None and entry is self.preparing:
+            return
+        if entry and self.prepareWindow:
+            self.schedulePrepare(0)
+
+# Players of all guilds, together with the queues and now playing state they work on
+class Players():
+    def __init__(self, client: JFAPI, hubs = None, segmentCache = None, passthrough: bool = True,
+                 gapless: bool = True, lookahead: float = 15, workers: int = 4, ffmpeg: FFmpegPool = None,
+                 policy: BitratePolicy = None, playlists = None) -> None:
+        self.client = client
+        self.hubs = hubs
+        self.segmentCache = segmentCache
+        self.passthrough = passthrough
+        self.gapless = gapless
+        self.lookahead = lookahead
+        self.queues = {}
+        self.playing = {}
+        self.players = {}
+        # guild id -> (queue entry, offset) of the track playing when the guild was parked
+        self.parked = {}
+        # transcodes tracks the server does not send as Opus
+        self.ffmpeg = ffmpeg or FFmpegPool()
+        # picks the bitrate below the channel's, None requests the channel bitrate
+        self.policy = policy
+        # playlists resolved ahead by the prefetcher
+        self.playlists = playlists
+        # bounds how many sources are opened at once across all guilds
+        self.__slots = asyncio.Semaphore(workers)
+
+    # Starts the player task for a guild, or resumes it if paused
+    # offset skips into the first track
+    def play(self, guild: discord.Guild, offset: float = 0):
+        vc = guild.voice_client
+        if vc and vc.paused:
+            vc.resume()
+            return
+        player = self.players.get(guild.id)
+        if not player or player.task.done():
+            # continue a parked track if it is still up next
+            entry, parkedOffset = self.parked.pop(guild.id, (None, 0))
+            queue = self.queues.get(guild.id)
+            if not offset and queue and queue[0] is entry:
+                offset = parkedOffset
+            player = GuildPlayer(self, guild, offset)
+            self.players[guild.id] = player
+            player.task = asyncio.get_running_loop().create_task(player.run())
+
+    # Disconnects the guild's voice client but keeps its queue
+    # the current track goes back to the front, and play() later starts it where it stopped
+    async def park(self, guild: discord.Guild):
+        state = self.playing.get(guild.id)
+        if state:
+            if guild.id not in self.queues:
+                self.queues[guild.id] = GuildQueue()
+            self.queues[guild.id].appendleft(state['track'])
+            self.parked[guild.id] = (state['track'], self.elapsed(guild.id).total_seconds())
+        vc = guild.voice_client
+        if vc:
+            await vc.disconnect(force=True)
+
+    def refreshPrepared(self, guildId: int):
+        player = self.players.get(guildId)
+        if player:
+            player.refreshPrepared()
+
+    def discardPrepared(self, guildId: int):
+        player = self.players.get(guildId)
+        if player:
+            player.discardPrepared()
+
+    # Time played of the current track
+    def elapsed(self, guildId: int) -> datetime.timedelta:
+        state = self.playing[guildId]
+        td = state['playtime-offset']
+        if not state.get('paused', True):
+            td += datetime.datetime.now() - state['starttime']
+        return td
+
+    # Number of ffmpeg processes still running
+    def ffmpegProcesses(self) -> int:
+        return self.ffmpeg.running()
+
+    # Bitrate the next track in a channel with this bitrate would be requested at
+    def targetBitrate(self, bitrate: int) -> int:
+        return self.policy.rung(bitrate) if self.policy else bitrate
+
+    # bitrate is the channel's, the policy may ask the server for less
+    async def createAudioSource(self, item: Track, bitrate: int, offset: float = 0) -> discord.AudioSource:
+        if self.policy:
+            bitrate = self.policy.choose(bitrate)
+        warmed = self.playlists.take((item.id, bitrate)) if self.playlists else None
+        if warmed:
+            url, resolved = warmed[0], warmed[1:]
+        else:
+            url, resolved = self.client.getAudioHls(item.id, bitrate), None
+        started = time.perf_counter()
+        async with self.__slots:
+            if self.passthrough:
+                key = (item.id, bitrate)
+                stream = OpusHlsStream(self.client, url, self.segmentCache, key, resolved, offset)
+                try:
+                    # joins the stream if another guild is already playing this track
+                    listener = await self.hubs.listen(key, stream, share=not offset)
+                except UnsupportedStream:
+                    # server did not send Opus, let ffmpeg transcode it
+                    pass
+                else:
+                    SOURCE_OPEN_SECONDS.observe(time.perf_counter() - started, 'passthrough')
+                    return listener
+            # under CPU pressure ask the server for less, so there is less to encode
+            degraded = self.ffmpeg.bitrate(bitrate)
+            if degraded != bitrate:
+                url, resolved = self.client.getAudioHls(item.id, degraded), None
+            audio = await self.ffmpeg.open(self.client, url, degraded, offset, resolved)
+            SOURCE_OPEN_SECONDS.observe(time.perf_counter() - started, 'ffmpeg')
+            return audio
+
+    def shutdown(self):
+        self.ffmpeg.shutdown()
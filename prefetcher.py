@@ -0,0 +1,201 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from jfapi import JFAPIItemError, JFAPIUnavailable
+from opusstream import resolvePlaylist
+from metrics import REGISTRY
+
+PREFETCH_JOBS = REGISTRY.counter('jellychord_prefetch_jobs_total', 'Background prefetch jobs run', ('kind',))
+
+# Resolved HLS playlists fetched ahead of playback, keyed by (item id, bitrate)
+# Taken once by whoever opens the track, entries older than ttl are not used
+class WarmPlaylists():
+    def __init__(self, ttl: float = 60, size: int = 256) -> None:
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        # key -> (fetched at, url, playlist, attrs)
+        self.__items = OrderedDict()
+
+    # Seconds since key was warmed, infinite when it was not
+    def age(self, key) -> float:
+        item = self.__items.get(key)
+        return time.monotonic() - item[0] if item else float('inf')
+
+    def put(self, key, url: str, playlist, attrs: dict):
+        self.__items[key] = (time.monotonic(), url, playlist, attrs)
+        self.__items.move_to_end(key)
+        while len(self.__items) > self.size:
+            self.__items.popitem(last=False)
+
+    # (url, playlist, attrs), or None when nothing fresh was warmed
+    def take(self, key) -> tuple:
+        item = self.__items.pop(key, None)
+        if item is None or time.monotonic() - item[0] >= self.ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return item[1:]
+
+    def stats(self) -> dict:
+        return {'entries': len(self.__items), 'hits': self.hits, 'misses': self.misses}
+
+# Watches the head of every guild's queue and does the work the next tracks will need before they need it
+# metadata of the next depth entries is refreshed in batches, the playlist of the next track is resolved
+# within half the warm ttl of the player needing it, so it is still fresh when taken
+# Jobs wait while interactive commands run, so they only use the gaps between them
+class Prefetcher():
+    def __init__(self, client, players, playlists: WarmPlaylists, depth: int = 10, concurrency: int = 2,
+                 interval: float = 1, refreshAfter: float = 600, onChange = None) -> None:
+        self.client = client
+        self.players = players
+        self.playlists = playlists
+        self.depth = depth
+        self.concurrency = concurrency
+        self.interval = interval
+        self.refreshAfter = refreshAfter
+        # called after queue entries were updated in place
+        self.onChange = onChange
+        # longest a job waits for commands to finish
+        self.maxDelay = 2
+        self.updated = 0
+        self.__jobs = asyncio.Queue()
+        self.__pending = set()
+        # guild -> (queue id, version) last scanned
+        self.__seen = {}
+        # item id -> when its metadata was last fetched
+        self.__fresh = OrderedDict()
+        self.__commands = 0
+        self.__quiet = asyncio.Event()
+        self.__quiet.set()
+
+    def commandStarted(self):
+        self.__commands += 1
+        self.__quiet.clear()
+
+    def commandFinished(self):
+        self.__commands = max(0, self.__commands - 1)
+        if not self.__commands:
+            self.__quiet.set()
+
+    async def run(self):
+        workers = [asyncio.get_running_loop().create_task(self.__worker()) for _ in range(self.concurrency)]
+        try:
+            while True:
+                self.scan()
+                await asyncio.sleep(self.interval)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    # Queues metadata jobs for guilds whose queue changed since the last scan,
+    # and playlist jobs for guilds that will soon need the next track
+    def scan(self):
+        queues = self.players.queues
+        for gid, queue in list(queues.items()):
+            stamp = (id(queue), queue.version)
+            if self.__seen.get(gid) != stamp:
+                self.__seen[gid] = stamp
+                self.__submit(('metadata', gid))
+            if self.__warmKey(gid):
+                self.__submit(('playlist', gid))
+        for gid in [gid for gid in self.__seen if gid not in queues]:
+            del self.__seen[gid]
+
+    def __submit(self, job: tuple):
+        if job not in self.__pending:
+            self.__pending.add(job)
+            self.__jobs.put_nowait(job)
+
+    async def __worker(self):
+        while True:
+            job = await self.__jobs.get()
+            # changes from now on queue the job again
+            self.__pending.discard(job)
+            try:
+                await asyncio.wait_for(self.__quiet.wait(), self.maxDelay)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                if job[0] == 'metadata':
+                    await self.refreshMetadata(job[1])
+                else:
+                    await self.warmPlaylist(job[1])
+            except (JFAPIUnavailable, JFAPIItemError):
+                pass
+            PREFETCH_JOBS.inc(1, job[0])
+
+    async def refreshMetadata(self, guildId: int, chunkSize: int = 100):
+        queue = self.players.queues.get(guildId)
+        if not queue:
+            return
+        now = time.monotonic()
+        entries = [e for e in queue.page(0, self.depth) if now - self.__fresh.get(e.id, -self.refreshAfter) >= self.refreshAfter]
+        ids = list(dict.fromkeys(e.id for e in entries))
+        if not ids:
+            return
+        chunks = [ids[i:i + chunkSize] for i in range(0, len(ids), chunkSize)]
+        results = await asyncio.gather(*(self.client.getItemsByIds(chunk) for chunk in chunks))
+        tracks = {track.id: track for res in results for track in res}
+
+        changed = False
+        for entry in entries:
+            track = tracks.get(entry.id)
+            if track and (entry.name, entry.artists, entry.length) != (track.name, track.artists, track.length):
+                # in place, the player and queue views hold on to the entry itself
+                entry.name, entry.artists, entry.length = track.name, track.artists, track.length
+                changed = True
+                self.updated += 1
+        for id in ids:
+            self.__fresh[id] = now
+            self.__fresh.move_to_end(id)
+        while len(self.__fresh) > 4096:
+            self.__fresh.popitem(last=False)
+        if changed and self.onChange:
+            self.onChange()
+
+    # (item id, bitrate) of the queue head when its playlist should be fetched now, otherwise None
+    # that is once the current track is within half the ttl of its end, or of gapless playback opening the next,
+    # and no fresh copy was warmed yet
+    def __warmKey(self, guildId: int) -> tuple:
+        queue = self.players.queues.get(guildId)
+        player = self.players.players.get(guildId)
+        state = self.players.playing.get(guildId)
+        # nothing to do while paused, or once gapless playback is opening the next track itself
+        if not queue or not player or not state or state.get('paused', True) or player.prepareWindow:
+            return None
+        vc = player.guild.voice_client
+        if not vc or not vc.is_connected():
+            return None
+        remaining = state['track'].length - self.players.elapsed(guildId).total_seconds()
+        if self.players.gapless:
+            remaining -= self.players.lookahead
+        if remaining > self.playlists.ttl / 2:
+            return None
+        key = (queue[0].id, self.players.targetBitrate(vc.channel.bitrate))
+        # played from disk, the playlist is not fetched
+        if self.players.segmentCache is not None and key in self.players.segmentCache:
+            return None
+        if self.playlists.age(key) <= self.playlists.ttl / 2:
+            return None
+        return key
+
+    # Resolves the playlist of the queue head at the bitrate it will be opened at
+    async def warmPlaylist(self, guildId: int):
+        key = self.__warmKey(guildId)
+        if not key:
+            return
+        url = self.client.getAudioHls(*key)
+        playlist, attrs = await resolvePlaylist(self.client, url)
+        self.playlists.put(key, url, playlist, attrs)
+
+    def stats(self) -> dict:
+        return {
+            'guilds': len(self.__seen),
+            'pending': self.__jobs.qsize(),
+            'updated': self.updated,
+            'commands': self.__commands,
+            **{f'playlists-{k}': v for k, v in self.playlists.stats().items()}
+        }
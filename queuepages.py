@@ -0,0 +1,92 @@
+import weakref
+from collections import OrderedDict
+
+# Page numbers offered around the current page when there are more than fit in one dropdown
+# Close pages one by one, further ones in growing steps, so any page is a few jumps away
+JUMP_STEPS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def pageWindow(page: int, pages: int, size: int = 25) -> list[int]:
+    if pages <= size:
+        return list(range(pages))
+    res = {0, page, pages - 1}
+    res.update(p for step in JUMP_STEPS for p in (page - step, page + step) if 0 <= p < pages)
+    near = 1
+    while len(res) < size:
+        for p in (page - near, page + near):
+            if 0 <= p < pages and len(res) < size:
+                res.add(p)
+        near += 1
+    return sorted(res)
+
+# Renders pages of guild queues for the queue view
+# Display strings are cached per item, and rendered pages per queue until the entries on them change
+class QueuePages():
+    def __init__(self, queues: dict, formatter, pageSize: int = 20, lineCacheSize: int = 4096) -> None:
+        self.queues = queues
+        self.formatter = formatter
+        self.pageSize = pageSize
+        self.lineCacheSize = lineCacheSize
+        self.hits = 0
+        self.misses = 0
+        # item id -> display string
+        self.__lines = OrderedDict()
+        # queue -> {page: (queue version, entries, rendered rows)}, goes away with the queue
+        self.__pages = weakref.WeakKeyDictionary()
+
+    def count(self, guildId: int) -> int:
+        queue = self.queues.get(guildId)
+        return max(1, -(-len(queue) // self.pageSize)) if queue else 1
+
+    def __line(self, item) -> str:
+        line = self.__lines.get(item.id)
+        if line is None:
+            line = self.formatter(item)
+            self.__lines[item.id] = line
+            if len(self.__lines) > self.lineCacheSize:
+                self.__lines.popitem(last=False)
+        else:
+            self.__lines.move_to_end(item.id)
+        return line
+
+    def __rows(self, guildId: int, page: int) -> str:
+        queue = self.queues[guildId]
+        cache = self.__pages.setdefault(queue, {})
+        cached = cache.get(page)
+        if cached and cached[0] == queue.version:
+            self.hits += 1
+            return cached[2]
+
+        start = page * self.pageSize
+        entries = tuple(queue.page(start, self.pageSize))
+        # the queue changed, but maybe not on this page
+        if cached and len(cached[1]) == len(entries) and all(a is b for a, b in zip(cached[1], entries)):
+            self.hits += 1
+            cache[page] = (queue.version, entries, cached[2])
+            return cached[2]
+
+        self.misses += 1
+        rows = '\n'.join(f'{start + i + 1}. {self.__line(item)}' for i, item in enumerate(entries))
+        cache[page] = (queue.version, entries, rows)
+        return rows
+
+    # Message content for a page of the guild's queue
+    def render(self, guildId: int, page: int) -> str:
+        if guildId not in self.queues:
+            return 'Empty Queue'
+        pages = self.count(guildId)
+        page = max(0, min(page, pages - 1))
+        return f'Tracks in playlist:\n{self.__rows(guildId, page)}\nPage: {page+1}/{pages}'
+
+    # Forgets everything rendered, for when items changed in place
+    def invalidate(self):
+        self.__lines.clear()
+        self.__pages = weakref.WeakKeyDictionary()
+
+    def stats(self) -> dict:
+        return {
+            'queues': len(self.__pages),
+            'pages': sum(len(p) for p in list(self.__pages.values())),
+            'lines': len(self.__lines),
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# Bounded TTL + LRU cache for search results
+# Concurrent lookups of the same key share a single in-flight request
+class SearchCache():
+    def __init__(self, maxsize: int = 256, ttl: float = 300) -> None:
+        self.maxsize = max(1, maxsize)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.__entries = OrderedDict()
+        self.__inflight = {}
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    async def get(self, key, fetch):
+        entry = self.__entries.get(key)
+        if entry:
+            if entry[0] > time.monotonic():
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return list(entry[1])
+            self.__entries.pop(key)
+            self.expirations += 1
+
+        task = self.__inflight.get(key)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(self.__load(key, fetch))
+            self.__inflight[key] = task
+
+        # shield so a cancelled caller does not cancel the request for everyone else
+        return list(await asyncio.shield(task))
+
+    async def __load(self, key, fetch):
+        try:
+            res = await fetch()
+            self.__store(key, res)
+            return res
+        finally:
+            self.__inflight.pop(key, None)
+
+    def __store(self, key, value):
+        self.__entries[key] = (time.monotonic() + self.ttl, value)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self):
+        self.__entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.__entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'inflight': len(self.__inflight)
+        }
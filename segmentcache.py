@@ -0,0 +1,144 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+
+MANIFEST = 'manifest.json'
+
+# On-disk cache of stream segments, one directory per (item id, bitrate)
+# Entries are written to a temporary directory and renamed into place once complete,
+# so a crash never leaves a partial entry that looks valid
+# Methods do blocking disk io, call them from a worker thread
+class SegmentCache():
+    def __init__(self, path: str, maxBytes: int) -> None:
+        self.path = path
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__size = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.__scan()
+
+    def __scan(self):
+        found = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            manifest = os.path.join(entry, MANIFEST)
+            # leftover from an interrupted write, a temporary directory may already hold its manifest
+            if name.startswith('.tmp-') or not os.path.isfile(manifest):
+                shutil.rmtree(entry, ignore_errors=True)
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            found.append((os.path.getmtime(manifest), name, size))
+        for _, name, size in sorted(found):
+            self.__entries[name] = size
+            self.__size += size
+        self.__evict()
+
+    @staticmethod
+    def key(itemId: str, bitrate: int) -> str:
+        return hashlib.sha256(f'{itemId}:{bitrate}'.encode()).hexdigest()
+
+    # Whether (item id, bitrate) is cached, without touching the disk
+    def __contains__(self, key: tuple) -> bool:
+        with self.__lock:
+            return self.key(*key) in self.__entries
+
+    # Returns the cached segments in order as memory maps, or None on a miss
+    def lookup(self, itemId: str, bitrate: int) -> list[mmap.mmap] | None:
+        key = self.key(itemId, bitrate)
+        with self.__lock:
+            if key not in self.__entries:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+        entry = os.path.join(self.path, key)
+        try:
+            with open(os.path.join(entry, MANIFEST), 'r', encoding='utf8') as f:
+                files = json.load(f)
+            maps = []
+            for name in files:
+                with open(os.path.join(entry, name), 'rb') as f:
+                    maps.append(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            os.utime(os.path.join(entry, MANIFEST))
+        except (OSError, ValueError):
+            # evicted or damaged underneath us
+            self.__remove(key)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return maps
+
+    def writer(self, itemId: str, bitrate: int) -> 'SegmentWriter':
+        return SegmentWriter(self, self.key(itemId, bitrate))
+
+    def _commit(self, key: str, tmpdir: str, size: int):
+        entry = os.path.join(self.path, key)
+        with self.__lock:
+            if key in self.__entries:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                return
+            os.replace(tmpdir, entry)
+            self.__entries[key] = size
+            self.__size += size
+            self.__evict()
+
+    def __remove(self, key: str):
+        with self.__lock:
+            size = self.__entries.pop(key, None)
+            if size is not None:
+                self.__size -= size
+        shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    def __evict(self):
+        while self.__size > self.maxBytes and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            self.evictions += 1
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.__entries),
+            'bytes': self.__size,
+            'maxbytes': self.maxBytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+class SegmentWriter():
+    def __init__(self, cache: SegmentCache, key: str) -> None:
+        self.__cache = cache
+        self.__key = key
+        self.__files = []
+        self.__size = 0
+        self.__tmpdir = os.path.join(cache.path, f'.tmp-{key}-{uuid.uuid4().hex}')
+        os.makedirs(self.__tmpdir)
+
+    def add(self, data: bytes):
+        name = f'{len(self.__files):05d}.mp4'
+        with open(os.path.join(self.__tmpdir, name), 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__files.append(name)
+        self.__size += len(data)
+
+    def commit(self):
+        manifest = json.dumps(self.__files).encode()
+        with open(os.path.join(self.__tmpdir, MANIFEST), 'wb') as f:
+            f.write(manifest)
+            f.flush()
+            os.fsync(f.fileno())
+        self.__cache._commit(self.__key, self.__tmpdir, self.__size + len(manifest))
+
+    def abort(self):
+        shutil.rmtree(self.__tmpdir, ignore_errors=True)
@@ -0,0 +1,109 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+# Environment variables telling a worker process which shards it owns
+ENV_SHARDS = 'JELLYCHORD_SHARDS'
+ENV_SHARD_COUNT = 'JELLYCHORD_SHARD_COUNT'
+ENV_WORKER = 'JELLYCHORD_WORKER'
+
+# Shard ids, shard count and worker index of this process, None when not running as a worker
+def workerShards() -> tuple[list[int], int, int] | None:
+    if ENV_SHARDS not in os.environ:
+        return None
+    shards = [int(s) for s in os.environ[ENV_SHARDS].split(',')]
+    return shards, int(os.environ[ENV_SHARD_COUNT]), int(os.environ.get(ENV_WORKER, 0))
+
+# Discord routes every guild to one shard, so a guild always lands on the same worker
+def shardOf(guildId: int, shardCount: int) -> int:
+    return (guildId >> 22) % shardCount
+
+# Shard count Discord recommends for the bot
+# GET /gateway/bot
+def recommendedShards(token: str) -> int:
+    req = urllib.request.Request('https://discord.com/api/v10/gateway/bot',
+                                 headers={'Authorization': f'Bot {token}', 'User-Agent': 'jellychord'})
+    with urllib.request.urlopen(req, timeout=15) as res:
+        return json.load(res)['shards']
+
+# Runs the bot as several worker processes, each connecting its own range of gateway shards
+# Workers that exit are started again, with a backoff that grows while they keep failing
+class ShardCoordinator():
+    def __init__(self, workers: int, shardCount: int, script: str, restartBackoff: float = 5,
+                 maxBackoff: float = 300, stableAfter: float = 600) -> None:
+        self.workers = min(workers, shardCount)
+        self.shardCount = shardCount
+        self.script = script
+        self.restartBackoff = restartBackoff
+        self.maxBackoff = maxBackoff
+        self.stableAfter = stableAfter
+        self.__procs = {}
+        self.__started = {}
+        self.__backoff = {}
+        self.__restartAt = {}
+        self.__stopping = False
+
+    # Splits the shards into contiguous ranges, one per worker
+    def assign(self) -> list[list[int]]:
+        base, extra = divmod(self.shardCount, self.workers)
+        res = []
+        start = 0
+        for i in range(self.workers):
+            end = start + base + (1 if i < extra else 0)
+            res.append(list(range(start, end)))
+            start = end
+        return res
+
+    def __spawn(self, worker: int, shards: list[int]):
+        env = dict(os.environ)
+        env[ENV_SHARDS] = ','.join(map(str, shards))
+        env[ENV_SHARD_COUNT] = str(self.shardCount)
+        env[ENV_WORKER] = str(worker)
+        # own session, so a ctrl-c reaches only the coordinator and workers are stopped in order
+        self.__procs[worker] = subprocess.Popen([sys.executable, self.script], env=env, start_new_session=True)
+        self.__started[worker] = time.monotonic()
+        print(f'worker {worker} started with shards {shards[0]}-{shards[-1]} of {self.shardCount}', flush=True)
+
+    def __stop(self, *args):
+        self.__stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGTERM, self.__stop)
+        assignment = self.assign()
+        for worker, shards in enumerate(assignment):
+            self.__spawn(worker, shards)
+
+        while not self.__stopping:
+            time.sleep(1)
+            now = time.monotonic()
+            for worker, shards in enumerate(assignment):
+                proc = self.__procs.get(worker)
+                if proc and proc.poll() is None:
+                    continue
+                if proc:
+                    # crashed right away again, wait longer before the next attempt
+                    if now - self.__started[worker] < self.stableAfter:
+                        self.__backoff[worker] = min(self.__backoff.get(worker, self.restartBackoff / 2) * 2, self.maxBackoff)
+                    else:
+                        self.__backoff[worker] = self.restartBackoff
+                    self.__restartAt[worker] = now + self.__backoff[worker]
+                    self.__procs[worker] = None
+                    print(f'worker {worker} exited with {proc.returncode}, restarting in {self.__backoff[worker]:.0f}s', flush=True)
+                elif now >= self.__restartAt[worker] and not self.__stopping:
+                    self.__spawn(worker, shards)
+
+        for proc in self.__procs.values():
+            if proc and proc.poll() is None:
+                proc.send_signal(signal.SIGINT)
+        for proc in self.__procs.values():
+            if proc:
+                try:
+                    proc.wait(30)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
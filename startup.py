@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import time
+
+# Wall time of each startup phase, from process start until the gateway is ready
+class StartupTimer():
+    def __init__(self, started: float = None) -> None:
+        self.started = time.perf_counter() if started is None else started
+        self.last = self.started
+        self.phases = []
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self) -> str:
+        phases = ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in self.phases)
+        return f'startup: {phases}, total {self.last - self.started:.2f}s'
+
+# Registers application commands without syncing them when they did not change
+# The ids Discord gave the commands are kept next to a hash of their schema,
+# a start with the same schema only binds the ids and sends nothing
+class CommandRegistry():
+    def __init__(self, bot, path: str) -> None:
+        self.bot = bot
+        self.path = path
+        self.result = None
+
+    def schemaHash(self) -> str:
+        schema = [(cmd.to_dict(), cmd.guild_ids) for cmd in self.bot.pending_application_commands]
+        schema.sort(key=lambda c: (c[0]['name'], c[1] or []))
+        data = json.dumps([self.bot.application_id, schema], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+    def load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, digest: str):
+        commands = [{'id': cmd.id, 'name': cmd.name, 'type': cmd.type, 'guilds': cmd.guild_ids}
+                    for cmd in self.bot.pending_application_commands if cmd.id]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            json.dump({'hash': digest, 'commands': commands}, f)
+        os.replace(tmp, self.path)
+
+    # Points interactions with these ids at the local commands, the same way a sync does
+    def bind(self, registered: list[dict]):
+        for item in registered:
+            guilds = item['guilds']
+            for cmd in self.bot.pending_application_commands:
+                if cmd.name != item['name'] or cmd.type != item.get('type', cmd.type):
+                    continue
+                if (guilds is None and cmd.guild_ids is None) or (guilds and cmd.guild_ids and guilds[0] in cmd.guild_ids):
+                    cmd.id = item['id']
+                    self.bot._application_commands[cmd.id] = cmd
+                    break
+
+    # Looks the registered ids up without changing anything, for workers that do not sync
+    async def fetch(self) -> list[dict]:
+        http = self.bot.http
+        appId = self.bot.application_id
+        registered = [{**i, 'guilds': None} for i in await http.get_global_commands(appId)]
+        guilds = {g for cmd in self.bot.pending_application_commands for g in cmd.guild_ids or ()}
+        for guild in guilds:
+            for i in await http.get_guild_commands(appId, guild):
+                registered.append({**i, 'guilds': [guild]})
+        return registered
+
+    # sync: whether this process may change what is registered with Discord
+    async def register(self, sync: bool = True):
+        digest = self.schemaHash()
+        cached = self.load()
+        if cached and cached.get('hash') == digest:
+            self.bind(cached['commands'])
+            self.result = 'unchanged'
+        elif sync:
+            await self.bot.sync_commands()
+            self.save(digest)
+            self.result = 'synced'
+        else:
+            self.bind(await self.fetch())
+            self.result = 'fetched'
+
+    # A command id we do not know, the cached ids are stale
+    async def refresh(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.bind(await self.fetch())
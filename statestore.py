@@ -0,0 +1,197 @@
+import asyncio
+import os
+import sqlite3
+import threading
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS queue_items (
+    guild INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (guild, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS playing (
+    guild INTEGER PRIMARY KEY,
+    item TEXT NOT NULL,
+    offset REAL NOT NULL,
+    channel INTEGER
+);
+'''
+
+# Write-behind store for guild queues and now playing state, kept in SQLite in WAL mode
+# Changes are picked up by a periodic flush and written in one transaction,
+# commands and the player never wait on the disk
+# Queue rows are kept in step with the journal of each GuildQueue, positions only need to be ordered,
+# so taking the head deletes one row, appending or prepending inserts rows past either end,
+# and only reorders rewrite a guild's rows
+# Methods not marked async do blocking disk io, call them from a worker thread
+class StateStore():
+    def __init__(self, path: str, flushInterval: float = 5) -> None:
+        self.path = path
+        self.flushInterval = flushInterval
+        self.flushes = 0
+        self.rowsWritten = 0
+        self.__db = None
+        self.__lock = threading.Lock()
+        # guild id -> queue whose journal this store drains, its rows were written from it
+        self.__savedQueues = {}
+        # guild id -> [first, end) positions of its rows, for guilds written since the last load
+        self.__bounds = {}
+        self.__savedPlaying = set()
+        # guilds loaded from disk but not restored yet, their rows are left alone
+        self.pending = set()
+
+    def open(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # sharded workers share the file, wait for each other's write transactions
+        db = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        db.execute('PRAGMA journal_mode=WAL')
+        # WAL keeps the database consistent with NORMAL, a crash can only lose the last flush
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        self.__db = db
+
+    def close(self):
+        with self.__lock:
+            if self.__db:
+                self.__db.close()
+                self.__db = None
+
+    # Returns guild id -> {'queue': [item ids], 'item': now playing id, 'offset': seconds, 'channel': voice channel id}
+    # owns filters the guilds this process is responsible for, the rest are never read or written
+    def load(self, owns = None) -> dict:
+        res = {}
+        with self.__lock:
+            for guild, item in self.__db.execute('SELECT guild, item FROM queue_items ORDER BY guild, position'):
+                if owns and not owns(guild):
+                    continue
+                res.setdefault(guild, {'queue': [], 'item': None, 'offset': 0, 'channel': None})['queue'].append(item)
+            for guild, item, offset, channel in self.__db.execute('SELECT guild, item, offset, channel FROM playing'):
+                if owns and not owns(guild):
+                    continue
+                state = res.setdefault(guild, {'queue': [], 'item': None, 'offset': 0, 'channel': None})
+                state.update(item=item, offset=offset, channel=channel)
+        self.pending = set(res)
+        self.__savedQueues = {guild: None for guild in res}
+        self.__bounds = {}
+        self.__savedPlaying = {guild for guild, state in res.items() if state['item']}
+        return res
+
+    # Applies queue changes as row changes, returns how many rows were inserted
+    def __apply(self, db, guild: int, ops: list, bounds: dict) -> int:
+        inserted = 0
+        first, end = bounds.get(guild, (0, 0))
+        for op, arg in ops:
+            if op == 'reset':
+                db.execute('DELETE FROM queue_items WHERE guild = ?', (guild,))
+                first, end = 0, 0
+                op = 'append'
+            if op == 'append':
+                db.executemany('INSERT INTO queue_items (guild, position, item) VALUES (?, ?, ?)',
+                               ((guild, end + i, item) for i, item in enumerate(arg)))
+                end += len(arg)
+                inserted += len(arg)
+            elif op == 'prepend':
+                first -= len(arg)
+                db.executemany('INSERT INTO queue_items (guild, position, item) VALUES (?, ?, ?)',
+                               ((guild, first + i, item) for i, item in enumerate(arg)))
+                inserted += len(arg)
+            elif op == 'popleft':
+                first = min(first + arg, end)
+                db.execute('DELETE FROM queue_items WHERE guild = ? AND position < ?', (guild, first))
+            elif op == 'pop':
+                end = max(end - arg, first)
+                db.execute('DELETE FROM queue_items WHERE guild = ? AND position >= ?', (guild, end))
+        bounds[guild] = (first, end)
+        return inserted
+
+    def __write(self, queues: dict, deleted: list, playing: dict, stopped: list):
+        bounds = dict(self.__bounds)
+        inserted = 0
+        with self.__lock:
+            db = self.__db
+            db.execute('BEGIN')
+            try:
+                for guild in deleted:
+                    db.execute('DELETE FROM queue_items WHERE guild = ?', (guild,))
+                    bounds.pop(guild, None)
+                for guild, ops in queues.items():
+                    inserted += self.__apply(db, guild, ops, bounds)
+                db.executemany('DELETE FROM playing WHERE guild = ?', ((guild,) for guild in stopped))
+                db.executemany('INSERT OR REPLACE INTO playing (guild, item, offset, channel) VALUES (?, ?, ?, ?)',
+                               ((guild, *row) for guild, row in playing.items()))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+        self.__bounds = bounds
+        self.flushes += 1
+        self.rowsWritten += inserted + len(playing)
+
+    # Writes the queue changes since the last flush and the offsets of everything playing
+    # A queue seen for the first time is written whole, from then on only its journal is
+    # playing maps guild id -> (item id, offset seconds, voice channel id)
+    async def flush(self, queues: dict, playing: dict):
+        changed = {}
+        for guild, queue in list(queues.items()):
+            if guild in self.pending:
+                continue
+            if self.__savedQueues.get(guild) is not queue:
+                queue.journal = []
+                changed[guild] = [('reset', [track.id for track in queue])]
+                self.__savedQueues[guild] = queue
+            elif queue.journal:
+                ops, queue.journal = queue.journal, []
+                if ops[0][0] == 'reset':
+                    changed[guild] = [('reset', [track.id for track in queue])]
+                else:
+                    changed[guild] = [(op, [track.id for track in arg] if op in ('append', 'prepend') else arg)
+                                      for op, arg in ops]
+        deleted = [guild for guild in self.__savedQueues if guild not in queues and guild not in self.pending]
+        playing = {guild: row for guild, row in playing.items() if guild not in self.pending}
+        stopped = [guild for guild in self.__savedPlaying if guild not in playing and guild not in self.pending]
+        if not changed and not deleted and not playing and not stopped:
+            return
+
+        try:
+            await asyncio.to_thread(self.__write, changed, deleted, playing, stopped)
+        except BaseException:
+            # the journal entries taken are gone, these queues are written whole next time
+            for guild in changed:
+                self.__savedQueues[guild] = None
+            raise
+        for guild in deleted:
+            queue = self.__savedQueues.pop(guild, None)
+            if queue is not None:
+                queue.journal = None
+        self.__savedPlaying = set(playing) | (self.__savedPlaying & self.pending)
+
+    # Marks a guild as restored, its state is written again from the next flush on
+    def restored(self, guild: int):
+        self.pending.discard(guild)
+        self.__savedQueues[guild] = None
+
+    # Stops holding back guilds that were not restored, e.g. because the server was down
+    # their saved rows are left as they are until the guild writes state of its own
+    def abandon(self, guilds):
+        for guild in list(guilds):
+            self.pending.discard(guild)
+            self.__savedQueues.pop(guild, None)
+            self.__bounds.pop(guild, None)
+            self.__savedPlaying.discard(guild)
+
+    async def run(self, snapshot):
+        while True:
+            await asyncio.sleep(self.flushInterval)
+            try:
+                await self.flush(*snapshot())
+            except sqlite3.Error:
+                # the next flush retries, queues whose changes were lost are written whole
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'flushes': self.flushes,
+            'rows-written': self.rowsWritten,
+            'pending-restore': len(self.pending)
+        }
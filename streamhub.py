@@ -0,0 +1,187 @@
+import asyncio
+import collections
+import threading
+
+import discord
+
+from opusstream import OpusHlsStream
+
+# One Opus stream shared by every guild playing the same (item id, bitrate)
+# Packets are kept in a ring so listeners that join late can start from the beginning,
+# the ring grows past its size while a listener still needs older packets
+# the hub stops fetching once its last listener leaves
+class StreamHub():
+    def __init__(self, hubs: 'StreamHubs', key: tuple) -> None:
+        self.key = key
+        self.__hubs = hubs
+        self.__packets = collections.deque()
+        self.__base = 0
+        self.__cond = threading.Condition()
+        self.__listeners = set()
+        self.__done = False
+        self.__closed = False
+        self.__task = None
+        self.ready = hubs.loop.create_future()
+
+    # Opens the stream and keeps fetching it in a task of the hub,
+    # so one listener being cancelled does not end it for the others
+    # joined listeners get the error if opening fails
+    def start(self, stream: OpusHlsStream):
+        self.__task = self.__hubs.loop.create_task(self.__run(stream))
+
+    async def __run(self, stream: OpusHlsStream):
+        try:
+            self.__push(await stream.open())
+        except BaseException as e:
+            self.__hubs._forget(self)
+            with self.__cond:
+                self.__done = True
+            if isinstance(e, asyncio.CancelledError):
+                # only cancelled once every listener left
+                self.ready.cancel()
+                raise
+            self.ready.set_exception(e)
+            # mark retrieved in case every listener went away
+            self.ready.exception()
+            return
+        self.ready.set_result(None)
+        await self.__produce(stream)
+
+    async def __produce(self, stream: OpusHlsStream):
+        try:
+            async for packets in stream.packets():
+                # pace on the listener furthest ahead
+                while self.__ahead() > self.__hubs.buffer:
+                    await asyncio.sleep(0.1)
+                self.__push(packets)
+        finally:
+            with self.__cond:
+                self.__done = True
+                self.__cond.notify_all()
+            await stream.close()
+
+    def __ahead(self) -> int:
+        with self.__cond:
+            end = self.__base + len(self.__packets)
+            return end - max((listener.cursor for listener in self.__listeners), default=end)
+
+    def __push(self, packets: list[bytes]):
+        with self.__cond:
+            self.__packets.extend(packets)
+            # packets a listener has yet to read stay, so a paused guild resumes where it stopped
+            # the governor parks guilds paused for long, which bounds how much one can hold
+            end = self.__base + len(self.__packets)
+            needed = min((listener.cursor for listener in self.__listeners), default=end)
+            while len(self.__packets) > self.__hubs.ringSize and self.__base < needed:
+                self.__packets.popleft()
+                self.__base += 1
+            self.__cond.notify_all()
+
+    # Returns None once the beginning of the stream has left the ring
+    def join(self) -> 'HubListener':
+        with self.__cond:
+            if self.__base or self.__closed:
+                return None
+            listener = HubListener(self)
+            self.__listeners.add(listener)
+            return listener
+
+    def _leave(self, listener: 'HubListener'):
+        with self.__cond:
+            self.__listeners.discard(listener)
+            if self.__listeners or self.__closed:
+                return
+            self.__closed = True
+            self.__done = True
+            self.__packets.clear()
+            self.__cond.notify_all()
+        self.__hubs._forget(self)
+        if self.__task and not self.__hubs.loop.is_closed():
+            self.__hubs.loop.call_soon_threadsafe(self.__task.cancel)
+
+    def _read(self, listener: 'HubListener') -> bytes:
+        with self.__cond:
+            self.__cond.wait_for(lambda: listener.cursor < self.__base + len(self.__packets) or self.__done,
+                                 self.__hubs.readTimeout)
+            listener.cursor = max(listener.cursor, self.__base)
+            index = listener.cursor - self.__base
+            if index >= len(self.__packets):
+                return b''
+            listener.cursor += 1
+            return self.__packets[index]
+
+    @property
+    def listeners(self) -> int:
+        return len(self.__listeners)
+
+class HubListener(discord.AudioSource):
+    def __init__(self, hub: StreamHub) -> None:
+        self.hub = hub
+        self.cursor = 0
+        self.__left = False
+
+    def read(self) -> bytes:
+        return self.hub._read(self)
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self):
+        if not self.__left:
+            self.__left = True
+            self.hub._leave(self)
+
+# Registry of running hubs
+# With sharing disabled every listener gets a hub of its own
+# readTimeout is how long a read waits for the next packet before ending the track,
+# it should outlast a segment fetch with all its retries
+class StreamHubs():
+    def __init__(self, loop: asyncio.AbstractEventLoop, share: bool = True, ringSize: int = 3000,
+                 buffer: int = 500, readTimeout: float = 10) -> None:
+        self.loop = loop
+        self.share = share
+        self.ringSize = max(ringSize, buffer)
+        self.buffer = buffer
+        self.readTimeout = readTimeout
+        self.__hubs = {}
+        self.__lock = threading.Lock()
+
+    # Joins the hub for key, or starts one with the given stream
+    # Pass share=False for a stream opened at an offset, other listeners need the beginning
+    # Must be called on the event loop
+    async def listen(self, key: tuple, stream: OpusHlsStream, share: bool = True) -> HubListener:
+        share = share and self.share
+        with self.__lock:
+            hub = self.__hubs.get(key) if share else None
+            listener = hub.join() if hub else None
+            if not listener:
+                hub = StreamHub(self, key)
+                listener = hub.join()
+                if share:
+                    self.__hubs[key] = hub
+                hub.start(stream)
+                stream = None
+
+        try:
+            if stream:
+                # the stream passed in was not needed
+                await stream.close()
+            await asyncio.shield(hub.ready)
+        except BaseException:
+            listener.cleanup()
+            raise
+        return listener
+
+    def _forget(self, hub: StreamHub):
+        with self.__lock:
+            if self.__hubs.get(hub.key) is hub:
+                self.__hubs.pop(hub.key)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            hubs = list(self.__hubs.values())
+        return {
+            'hubs': len(hubs),
+            'listeners': sum(hub.listeners for hub in hubs),
+            'shared': sum(1 for hub in hubs if hub.listeners > 1)
+        }
@@ -0,0 +1,249 @@
+'''
+Benchmarks for the hot paths, against a stand-in Jellyfin server and a fake voice client
+Run from the repository root:
+    python -m tests.benchmark [--tracks 5000] [--latency 0.002] [--out results.json]
+Prints one JSON document, keep it to compare between commits
+'''
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+
+from guildqueue import GuildQueue
+from jfapi import JFAPI
+from libindex import LibraryIndex
+from player import Players
+from segmentcache import SegmentCache
+from streamhub import StreamHubs
+from tests.fakejellyfin import FakeJellyfin, WORDS
+from tests.fakevoice import FakeGuild, FakeVoiceClient, FakeChannel
+
+def summarize(values: list[float]) -> dict:
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'mean-ms': statistics.fmean(values) * 1000,
+        'p50-ms': values[len(values) // 2] * 1000,
+        'p95-ms': values[min(len(values) - 1, int(len(values) * 0.95))] * 1000,
+        'max-ms': values[-1] * 1000
+    }
+
+def searchTerms(count: int, seed: int = 2) -> list[str]:
+    rng = random.Random(seed)
+    terms = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.4:
+            # typing in progress, what autocomplete sees
+            word = rng.choice(WORDS)
+            terms.append(word[:rng.randint(1, len(word))])
+        elif kind < 0.8:
+            terms.append(' '.join(rng.sample(WORDS, 2)))
+        else:
+            # typo
+            word = list(rng.choice(WORDS))
+            word[rng.randrange(len(word))] = 'x'
+            terms.append(''.join(word))
+    return terms
+
+async def benchSearch(client: JFAPI, cachedClient: JFAPI, queries: int) -> dict:
+    index = LibraryIndex()
+    started = time.perf_counter()
+    await index.build(client)
+    buildTime = time.perf_counter() - started
+
+    terms = searchTerms(queries)
+    started = time.perf_counter()
+    for term in terms:
+        index.search(term, 25)
+    indexTime = time.perf_counter() - started
+
+    serverTerms = terms[:max(1, queries // 10)]
+    started = time.perf_counter()
+    for term in serverTerms:
+        await client.search(term, 25, ['Audio', 'MusicAlbum'])
+    serverTime = time.perf_counter() - started
+
+    # the same few terms over and over, like repeated autocomplete
+    cachedTerms = [serverTerms[i % 10] for i in range(len(serverTerms))]
+    started = time.perf_counter()
+    await asyncio.gather(*(cachedClient.search(term, 25, ['Audio', 'MusicAlbum']) for term in cachedTerms))
+    cachedTime = time.perf_counter() - started
+
+    return {
+        'index-items': len(index),
+        'index-build-s': buildTime,
+        'index-queries-per-s': len(terms) / indexTime,
+        'server-queries-per-s': len(serverTerms) / serverTime,
+        'cached-queries-per-s': len(cachedTerms) / cachedTime,
+        'cache': cachedClient.searchCache.stats()
+    }
+
+# Same paging as playHelperCollection, playback can start once the first page is queued
+async def benchEnqueue(client: JFAPI, albumId: str, pageSize: int) -> dict:
+    queue = GuildQueue()
+    started = time.perf_counter()
+    firstPage = None
+    async for page in client.iterAlbumTracks(albumId, pageSize):
+        queue.extend(page)
+        if firstPage is None:
+            firstPage = time.perf_counter() - started
+    return {
+        'tracks': len(queue),
+        'page-size': pageSize,
+        'first-page-ms': firstPage * 1000,
+        'total-ms': (time.perf_counter() - started) * 1000
+    }
+
+def benchQueue(size: int, ops: int, seed: int = 3) -> dict:
+    rng = random.Random(seed)
+    queue = GuildQueue(range(size))
+    timings = {}
+    names = ('append', 'popleft', 'pop-middle', 'promote', 'demote', 'getitem', 'page', 'insert-middle')
+    for name in names:
+        timings[name] = 0.0
+    counts = dict.fromkeys(names, 0)
+
+    for i in range(ops):
+        name = names[i % len(names)]
+        n = len(queue)
+        started = time.perf_counter()
+        if name == 'append':
+            queue.append(i)
+        elif name == 'popleft':
+            queue.popleft()
+        elif name == 'pop-middle':
+            queue.pop(rng.randrange(n))
+        elif name == 'promote':
+            queue.moveToFront(rng.randrange(n))
+        elif name == 'demote':
+            queue.moveToBack(rng.randrange(n))
+        elif name == 'getitem':
+            queue[rng.randrange(n)]
+        elif name == 'page':
+            queue.page(rng.randrange(n), 20)
+        elif name == 'insert-middle':
+            # rebuilds the queue, run it less often than the rest
+            if i % (len(names) * 16) != len(names) - 1:
+                continue
+            queue.insert(n // 2, [i])
+        timings[name] += time.perf_counter() - started
+        counts[name] += 1
+    return {
+        'size': size,
+        'ops': ops,
+        'us-per-op': {name: timings[name] / counts[name] * 1e6 for name in names if counts[name]}
+    }
+
+async def benchFirstAudio(client: JFAPI, trackIds: list[str], cacheDir: str) -> dict:
+    loop = asyncio.get_running_loop()
+    res = {}
+    for name, cache in (('cold', None), ('segment-cache', SegmentCache(cacheDir, 1 << 30))):
+        players = Players(client, StreamHubs(loop), cache, gapless=False)
+        delays = []
+        for id in trackIds:
+            track = (await client.getItemsByIds([id]))[0]
+            if cache is not None:
+                # play it once all the way so the second open is served from disk
+                audio = await players.createAudioSource(track, 64000)
+                while await asyncio.to_thread(audio.read):
+                    pass
+                audio.cleanup()
+            started = time.perf_counter()
+            audio = await players.createAudioSource(track, 64000)
+            await asyncio.to_thread(audio.read)
+            delays.append(time.perf_counter() - started)
+            audio.cleanup()
+        players.shutdown()
+        res[name] = summarize(delays)
+    return res
+
+async def benchTransitions(client: JFAPI, trackIds: list[str], gapless: bool, lookahead: float) -> dict:
+    loop = asyncio.get_running_loop()
+    players = Players(client, StreamHubs(loop), None, gapless=gapless, lookahead=lookahead)
+    guild = FakeGuild(1, FakeVoiceClient(FakeChannel(1, 64000)))
+    players.queues[guild.id] = GuildQueue(await client.getItemsByIds(trackIds))
+    started = time.perf_counter()
+    players.play(guild)
+    await players.players[guild.id].task
+    players.shutdown()
+    vc = guild.voice_client
+    return {
+        'tracks': len(trackIds),
+        'gapless': gapless,
+        # from asking the player to start until the first packet went out
+        'time-to-first-audio-ms': (vc.packets[0][1] - started) * 1000 if vc.packets else None,
+        'play-to-packet': summarize(vc.firstPacketDelays()),
+        'gap': summarize(vc.gaps()),
+        'wall-s': time.perf_counter() - started
+    }
+
+def gitRevision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args) -> dict:
+    library = FakeJellyfin(args.tracks, latency=args.latency, trackSeconds=args.track_seconds)
+    album = FakeJellyfin(args.album_size, albumSize=args.album_size, latency=args.latency)
+    await library.start()
+    await album.start()
+    client = JFAPI(library.url, 'benchmark', cacheSize=0)
+    cachedClient = JFAPI(library.url, 'benchmark')
+    albumClient = JFAPI(album.url, 'benchmark', cacheSize=0)
+    trackIds = [id for id, item in library.items.items() if item['Type'] == 'Audio']
+    try:
+        with tempfile.TemporaryDirectory() as cacheDir:
+            res = {
+                'revision': gitRevision(),
+                'python': platform.python_version(),
+                'settings': vars(args),
+                'search': await benchSearch(client, cachedClient, args.queries),
+                'enqueue': await benchEnqueue(albumClient, next(iter(album.albums)), args.page_size),
+                'queue': benchQueue(args.queue_size, args.queue_ops),
+                'first-audio': await benchFirstAudio(client, trackIds[:args.audio_tracks], cacheDir),
+                'transitions': [
+                    await benchTransitions(client, trackIds[:args.transition_tracks], False, args.lookahead),
+                    await benchTransitions(client, trackIds[:args.transition_tracks], True, args.lookahead)
+                ],
+                'requests': library.requests + album.requests
+            }
+    finally:
+        for c in (client, cachedClient, albumClient):
+            await c.close()
+        await library.stop()
+        await album.stop()
+    return res
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JellyChord hot paths against a fake Jellyfin server')
+    parser.add_argument('--tracks', type=int, default=5000, help='tracks in the synthetic library')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds added to every server response')
+    parser.add_argument('--track-seconds', type=float, default=2, help='length of every synthetic track')
+    parser.add_argument('--queries', type=int, default=2000, help='searches against the library index')
+    parser.add_argument('--album-size', type=int, default=1000, help='tracks in the album enqueued')
+    parser.add_argument('--page-size', type=int, default=100, help='enqueue page size')
+    parser.add_argument('--queue-size', type=int, default=10000, help='entries in the queue mutated')
+    parser.add_argument('--queue-ops', type=int, default=20000, help='queue operations to time')
+    parser.add_argument('--audio-tracks', type=int, default=10, help='tracks opened for time to first audio')
+    parser.add_argument('--transition-tracks', type=int, default=4, help='tracks played back to back')
+    parser.add_argument('--lookahead', type=float, default=1, help='gapless look-ahead in seconds')
+    parser.add_argument('--out', help='also write the results to this file')
+    args = parser.parse_args()
+
+    res = json.dumps(asyncio.run(run(args)), indent=2)
+    print(res)
+    if args.out:
+        with open(args.out, 'w', encoding='utf8') as f:
+            f.write(res)
+
+if __name__ == '__main__':
+    main()
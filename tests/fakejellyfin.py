@@ -0,0 +1,154 @@
+import asyncio
+import random
+import struct
+
+from aiohttp import web
+
+from opusstream import FRAME_SAMPLES, SAMPLE_RATE
+
+WORDS = ('night', 'river', 'summer', 'echo', 'light', 'dream', 'fire', 'blue', 'road', 'heart', 'storm',
+         'gold', 'shadow', 'ocean', 'city', 'silver', 'winter', 'moon', 'wild', 'glass', 'dance', 'home')
+
+'''
+Fragmented MP4 with Opus audio
+Just enough structure for OpusDemuxer, the packets are not real Opus
+'''
+def box(kind: bytes, body: bytes) -> bytes:
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+def fullBox(kind: bytes, version: int, flags: int, body: bytes) -> bytes:
+    return box(kind, struct.pack('>I', (version << 24) | flags) + body)
+
+def initSegment(trackId: int = 1) -> bytes:
+    tkhd = fullBox(b'tkhd', 0, 3, struct.pack('>III', 0, 0, trackId) + bytes(68))
+    mdhd = fullBox(b'mdhd', 0, 0, struct.pack('>IIII', 0, 0, SAMPLE_RATE, 0) + bytes(4))
+    hdlr = fullBox(b'hdlr', 0, 0, struct.pack('>I4s', 0, b'soun') + bytes(13))
+    stsd = fullBox(b'stsd', 0, 0, struct.pack('>I', 1) + box(b'Opus', bytes(28)))
+    trak = box(b'trak', tkhd + box(b'mdia', mdhd + hdlr + box(b'minf', box(b'stbl', stsd))))
+    mvex = box(b'mvex', fullBox(b'trex', 0, 0, struct.pack('>IIIII', trackId, 1, FRAME_SAMPLES, 0, 0)))
+    return box(b'ftyp', b'iso6') + box(b'moov', trak + mvex)
+
+def mediaSegment(packets: list[bytes], sequence: int, trackId: int = 1) -> bytes:
+    def moof(dataOffset: int) -> bytes:
+        # default-base-is-moof, sizes per sample
+        tfhd = fullBox(b'tfhd', 0, 0x020000, struct.pack('>I', trackId))
+        trun = fullBox(b'trun', 0, 0x201, struct.pack('>Ii', len(packets), dataOffset)
+                       + b''.join(struct.pack('>I', len(p)) for p in packets))
+        return box(b'moof', fullBox(b'mfhd', 0, 0, struct.pack('>I', sequence)) + box(b'traf', tfhd + trun))
+    size = len(moof(0))
+    return moof(size + 8) + box(b'mdat', b''.join(packets))
+
+# Stand-in for the Jellyfin endpoints JFAPI uses, serving a generated library
+# Every track streams as Opus in fMP4, latency is added to each response
+class FakeJellyfin():
+    def __init__(self, tracks: int = 5000, albumSize: int = 12, trackSeconds: float = 4,
+                 segmentSeconds: float = 1, latency: float = 0, seed: int = 1) -> None:
+        self.latency = latency
+        self.trackSeconds = trackSeconds
+        self.segmentSeconds = segmentSeconds
+        self.requests = 0
+        self.items = {}
+        self.albums = {}
+        rng = random.Random(seed)
+        for i in range(0, tracks, albumSize):
+            albumId = f'album{i // albumSize:05d}'
+            artist = f'{rng.choice(WORDS).title()} {rng.choice(WORDS).title()}'
+            self.items[albumId] = {
+                'Id': albumId,
+                'Name': ' '.join(rng.choice(WORDS) for _ in range(2)).title(),
+                'Type': 'MusicAlbum',
+                'Artists': [artist]
+            }
+            self.albums[albumId] = []
+            for j in range(i, min(i + albumSize, tracks)):
+                trackId = f'track{j:06d}'
+                self.items[trackId] = {
+                    'Id': trackId,
+                    'Name': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(),
+                    'Type': 'Audio',
+                    'Artists': [artist],
+                    'RunTimeTicks': int(trackSeconds * 10000000)
+                }
+                self.albums[albumId].append(self.items[trackId])
+        self.__init = initSegment()
+        packets = int(segmentSeconds * SAMPLE_RATE / FRAME_SAMPLES)
+        self.__segments = [mediaSegment([bytes([0xfc, i % 256]) + bytes(60) for _ in range(packets)], i + 1)
+                           for i in range(self.segmentCount)]
+        self.__runner = None
+        self.url = None
+        # PlaySessionIds of transcodes stopped through DELETE /Videos/ActiveEncodings
+        self.stopped = []
+
+    @property
+    def segmentCount(self) -> int:
+        return max(1, round(self.trackSeconds / self.segmentSeconds))
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(middlewares=[self.__delay])
+        app.router.add_get('/Items', self.__getItems)
+        app.router.add_get('/Audio/{id}/main.m3u8', self.__getPlaylist)
+        app.router.add_get('/Audio/{id}/init.mp4', self.__getInit)
+        app.router.add_get('/Audio/{id}/{segment}.mp4', self.__getSegment)
+        app.router.add_delete('/Videos/ActiveEncodings', self.__deleteEncodings)
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, host, port).start()
+        port = self.__runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        if self.__runner:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    @web.middleware
+    async def __delay(self, request: web.Request, handler):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    async def __getItems(self, request: web.Request) -> web.Response:
+        q = request.query
+        if 'ids' in q:
+            items = [self.items[id] for id in q['ids'].split(',') if id in self.items]
+        elif 'parentId' in q:
+            items = self.albums.get(q['parentId'], [])
+        else:
+            items = list(self.items.values())
+        if 'includeItemTypes' in q:
+            types = q['includeItemTypes'].split(',')
+            items = [item for item in items if item['Type'] in types]
+        if 'searchTerm' in q:
+            term = q['searchTerm'].casefold()
+            items = [item for item in items if term in item['Name'].casefold()]
+        start = int(q.get('startIndex', 0))
+        limit = int(q['limit']) if 'limit' in q else len(items)
+        return web.json_response({'Items': items[start:start + limit]})
+
+    async def __getPlaylist(self, request: web.Request) -> web.Response:
+        if request.match_info['id'] not in self.items:
+            raise web.HTTPNotFound()
+        lines = ['#EXTM3U', '#EXT-X-VERSION:7', f'#EXT-X-TARGETDURATION:{int(self.segmentSeconds + 0.999)}',
+                 '#EXT-X-MEDIA-SEQUENCE:0', '#EXT-X-PLAYLIST-TYPE:VOD', '#EXT-X-MAP:URI="init.mp4"']
+        for i in range(self.segmentCount):
+            lines.append(f'#EXTINF:{self.segmentSeconds:.3f},')
+            lines.append(f'seg{i}.mp4')
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines), content_type='application/vnd.apple.mpegurl')
+
+    async def __deleteEncodings(self, request: web.Request) -> web.Response:
+        if 'deviceId' not in request.query or 'playSessionId' not in request.query:
+            raise web.HTTPBadRequest()
+        self.stopped.append(request.query['playSessionId'])
+        return web.Response(status=204)
+
+    async def __getInit(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.__init, content_type='video/mp4')
+
+    async def __getSegment(self, request: web.Request) -> web.Response:
+        index = int(request.match_info['segment'].removeprefix('seg'))
+        if not 0 <= index < len(self.__segments):
+            raise web.HTTPNotFound()
+        return web.Response(body=self.__segments[index], content_type='video/mp4')
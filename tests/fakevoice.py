@@ -0,0 +1,96 @@
+import threading
+import time
+
+import discord
+
+class FakeChannel():
+    def __init__(self, id: int = 1, bitrate: int = 64000) -> None:
+        self.id = id
+        self.bitrate = bitrate
+
+# Plays sources like discord.VoiceClient, reading one packet per frame on a thread of its own
+# Every packet read is timestamped so tests can see when audio started and how long the gaps were
+class FakeVoiceClient():
+    def __init__(self, channel: FakeChannel = None, frameLength: float = 0.02) -> None:
+        self.channel = channel or FakeChannel()
+        self.frameLength = frameLength
+        self.paused = False
+        # (track number, perf_counter) of every packet sent
+        self.packets = []
+        # (track number, perf_counter) of every play call
+        self.starts = []
+        self.__connected = True
+        self.__thread = None
+        self.__stop = threading.Event()
+        self.__track = 0
+
+    def is_connected(self) -> bool:
+        return self.__connected
+
+    def is_playing(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive() and not self.paused
+
+    def play(self, source: discord.AudioSource, *, after=None):
+        if self.__thread and self.__thread.is_alive():
+            raise discord.ClientException('Already playing audio.')
+        self.__track += 1
+        self.starts.append((self.__track, time.perf_counter()))
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(source, after, self.__track), daemon=True)
+        self.__thread.start()
+
+    def __run(self, source: discord.AudioSource, after, track: int):
+        error = None
+        try:
+            deadline = time.perf_counter()
+            while not self.__stop.is_set():
+                if self.paused:
+                    time.sleep(self.frameLength)
+                    deadline = time.perf_counter()
+                    continue
+                data = source.read()
+                if not data:
+                    break
+                self.packets.append((track, time.perf_counter()))
+                deadline += self.frameLength
+                time.sleep(max(0, deadline - time.perf_counter()))
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+        if after:
+            after(error)
+
+    def stop(self):
+        self.__stop.set()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    async def disconnect(self, *, force: bool = False):
+        self.__connected = False
+        self.stop()
+
+    # Seconds from each play call to the first packet of that track
+    def firstPacketDelays(self) -> list[float]:
+        first = {}
+        for track, ts in self.packets:
+            first.setdefault(track, ts)
+        return [first[track] - ts for track, ts in self.starts if track in first]
+
+    # Silence between the last packet of one track and the first packet of the next, minus one frame
+    def gaps(self) -> list[float]:
+        last = {}
+        first = {}
+        for track, ts in self.packets:
+            first.setdefault(track, ts)
+            last[track] = ts
+        return [max(0, first[t + 1] - last[t] - self.frameLength) for t in sorted(last) if t + 1 in first]
+
+class FakeGuild():
+    def __init__(self, id: int = 1, voice_client: FakeVoiceClient = None) -> None:
+        self.id = id
+        self.voice_client = voice_client or FakeVoiceClient()
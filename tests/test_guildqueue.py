@@ -0,0 +1,116 @@
+import random
+
+import pytest
+
+from guildqueue import GuildQueue
+
+# Applies the same random operations to a GuildQueue and a list and compares them after each step
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_list(seed):
+    rng = random.Random(seed)
+    initial = list(range(rng.randint(0, 50)))
+    queue = GuildQueue(initial)
+    model = list(initial)
+    counter = len(initial)
+    for _ in range(1000):
+        op = rng.choice(('append', 'appendleft', 'extend', 'prepend', 'insert', 'popleft', 'pop',
+                         'popmid', 'moveToFront', 'moveToBack', 'page'))
+        if op in ('append', 'appendleft'):
+            getattr(queue, op)(counter)
+            if op == 'append':
+                model.append(counter)
+            else:
+                model.insert(0, counter)
+            counter += 1
+        elif op in ('extend', 'prepend', 'insert'):
+            items = list(range(counter, counter + rng.randint(0, 40)))
+            counter += len(items)
+            if op == 'extend':
+                queue.extend(items)
+                model.extend(items)
+            elif op == 'prepend':
+                queue.prepend(items)
+                model[0:0] = items
+            else:
+                index = rng.randint(-2, len(model) + 2)
+                queue.insert(index, items)
+                index = min(max(index, 0), len(model))
+                model[index:index] = items
+        elif not model:
+            with pytest.raises(IndexError):
+                queue.popleft()
+            with pytest.raises(IndexError):
+                queue.pop()
+        elif op == 'popleft':
+            assert queue.popleft() == model.pop(0)
+        elif op == 'pop':
+            assert queue.pop() == model.pop()
+        elif op == 'popmid':
+            index = rng.randrange(-len(model), len(model))
+            assert queue.pop(index) == model.pop(index)
+        elif op == 'moveToFront':
+            index = rng.randrange(len(model))
+            model.insert(0, model.pop(index))
+            assert queue.moveToFront(index) == model[0]
+        elif op == 'moveToBack':
+            index = rng.randrange(len(model))
+            model.append(model.pop(index))
+            assert queue.moveToBack(index) == model[-1]
+        else:
+            start = rng.randint(-1, len(model) + 1)
+            count = rng.randint(0, 30)
+            expected = model[start:start + count] if start >= 0 else []
+            assert queue.page(start, count) == expected
+
+        assert len(queue) == len(model)
+        assert bool(queue) == bool(model)
+        assert list(queue) == model
+        if model:
+            index = rng.randrange(-len(model), len(model))
+            assert queue[index] == model[index]
+
+def test_out_of_range():
+    queue = GuildQueue([1, 2, 3])
+    with pytest.raises(IndexError):
+        queue[3]
+    with pytest.raises(IndexError):
+        queue.pop(-4)
+    assert queue[-3] == 1
+
+def test_index_and_version():
+    a, b = object(), object()
+    queue = GuildQueue([a, b])
+    version = queue.version
+    assert queue.index(b) == 1
+    queue.shuffle()
+    assert queue.version > version and set(map(id, queue)) == {id(a), id(b)}
+    queue.clear()
+    with pytest.raises(ValueError):
+        queue.index(a)
+
+# Middle removals leave markers until they outnumber the items and the queue compacts
+def test_middle_removals():
+    model = list(range(200))
+    queue = GuildQueue(model)
+    rng = random.Random(1)
+    while len(model) > 2:
+        index = rng.randrange(1, len(model) - 1)
+        assert queue.pop(index) == model.pop(index)
+        assert queue.page(len(model) // 2, 5) == model[len(model) // 2:len(model) // 2 + 5]
+    assert list(queue) == model
+
+# The journal lists end changes as they happen and collapses to a reset on a reorder
+def test_journal():
+    queue = GuildQueue(['a', 'b', 'c'])
+    queue.append('x')
+    assert queue.journal is None
+    queue.journal = []
+    queue.popleft()
+    queue.popleft()
+    queue.extend(['d', 'e'])
+    queue.appendleft('f')
+    queue.pop()
+    assert queue.journal == [('popleft', 2), ('append', ['d', 'e']), ('prepend', ['f']), ('pop', 1)]
+    queue.pop(1)
+    queue.append('g')
+    assert queue.journal == [('reset',)]
@@ -0,0 +1,101 @@
+import asyncio
+import urllib.parse
+
+import pytest
+
+import jfapi
+from jfapi import CircuitBreaker, JFAPI
+from tests.fakejellyfin import FakeJellyfin
+
+class Clock():
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    res = Clock()
+    monkeypatch.setattr(jfapi.time, 'monotonic', res)
+    return res
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=30)
+    for _ in range(2):
+        breaker.failure()
+        assert breaker.state == 'closed' and breaker.allow()
+    breaker.failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+
+def test_breaker_half_open_probe(clock):
+    breaker = CircuitBreaker(threshold=1, cooldown=30)
+    breaker.failure()
+    clock.now += 29
+    assert not breaker.allow()
+    clock.now += 1
+    assert breaker.state == 'half-open'
+    # one probe goes through, the others wait for its result
+    assert breaker.allow()
+    assert not breaker.allow()
+    # a failed probe opens the breaker for another cooldown
+    breaker.failure()
+    clock.now += 29
+    assert breaker.state == 'open'
+    clock.now += 1
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == 'closed' and breaker.failures == 0
+    assert breaker.allow()
+
+def test_success_resets_failures(clock):
+    breaker = CircuitBreaker(threshold=2)
+    breaker.failure()
+    breaker.success()
+    breaker.failure()
+    assert breaker.state == 'closed'
+
+# Two addresses of one fake server stand in for two replicas
+def test_transcodes_counted_from_segment_fetches():
+    async def main():
+        server = FakeJellyfin(tracks=2, trackSeconds=1, segmentSeconds=1)
+        await server.start()
+        port = server.url.rsplit(':', 1)[1]
+        first, second = f'http://127.0.0.1:{port}', f'http://localhost:{port}'
+        try:
+            async with JFAPI([first, second], 'key') as api:
+                url = api.getAudioHls('track000000', 64000)
+                assert url.startswith(first)
+                # choosing a backend or warming its playlist does not count as a transcode
+                assert api.getAudioHls('track000001', 64000).startswith(first)
+                await api.fetch(url)
+                assert api.backends[0].transcodes(60) == 0
+                await api.fetch(f'{first}/Audio/track000000/seg0.mp4')
+                assert api.backends[0].transcodes(60) == 1
+                assert api.getAudioHls('track000001', 64000).startswith(second)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+# Each stream gets its own play session, stopping it ends that transcode and frees the backend
+def test_stop_transcode():
+    async def main():
+        server = FakeJellyfin(tracks=1, trackSeconds=1, segmentSeconds=1)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                first, second = api.getAudioHls('track000000', 64000), api.getAudioHls('track000000', 64000)
+                session = urllib.parse.parse_qs(urllib.parse.urlsplit(first).query)['PlaySessionId'][0]
+                assert session not in second
+                await api.fetch(f'{url}/Audio/track000000/seg0.mp4')
+                assert api.backends[0].transcodes(60) == 1
+                await api.stopTranscode(first)
+                assert server.stopped == [session]
+                assert api.backends[0].transcodes(60) == 0
+                # urls without a session are left alone
+                await api.stopTranscode(f'{url}/Audio/track000000/main.m3u8')
+                assert server.stopped == [session]
+        finally:
+            await server.stop()
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+import asyncio
+import datetime
+
+from jfapi import JFAPI, Track
+from libindex import LibraryIndex
+from tests.fakejellyfin import FakeJellyfin
+
+def track(id: str, name: str, artists: tuple[str] = (), type: str = 'Audio') -> Track:
+    return Track(id, name, artists, type, 180)
+
+def index(*tracks: Track, **kwargs) -> LibraryIndex:
+    res = LibraryIndex(**kwargs)
+    res.load(list(tracks))
+    return res
+
+def ids(tracks: list[Track]) -> list[str]:
+    return [t.id for t in tracks]
+
+def test_prefix_and_ranking():
+    lib = index(track('1', 'Night Drive'), track('2', 'Night'), track('3', 'Summer Nights', ('Echo',)),
+                track('4', 'Night', type='MusicAlbum'))
+    assert ids(lib.search('night', types=['Audio'])) == ['2', '1', '3']
+    assert ids(lib.search('nig ec')) == ['3']
+    assert set(ids(lib.search('NIGHT'))) == {'1', '2', '3', '4'}
+    assert lib.search('   ') == []
+
+def test_accents_and_punctuation():
+    lib = index(track('1', 'Café del Mar'), track('2', "Don't Stop"))
+    assert ids(lib.search('cafe')) == ['1']
+    assert ids(lib.search('don t')) == ['2']
+
+def test_typos():
+    lib = index(track('1', 'Night'), track('2', 'River'))
+    assert ids(lib.search('nigth')) == ['1']
+    assert index(track('1', 'Night'), fuzzyThreshold=0.5).search('nigth') == []
+
+def test_candidates_are_bounded():
+    tracks = [track(str(i), f'Lovely Song {i}') for i in range(500)] + [track('x', 'Love')]
+    lib = index(*tracks, maxCandidates=50)
+    res = lib.search('love', 10)
+    assert len(res) == 10
+    # exact words sort first in the word list, so the exact name makes it into the candidates
+    assert res[0].id == 'x'
+
+def test_update_replaces_items():
+    lib = index(track('1', 'Old Name'))
+    lib.update([track('1', 'New Name'), track('2', 'Other')])
+    assert lib.search('old') == []
+    assert ids(lib.search('new')) == ['1']
+    assert len(lib) == 2
+
+# Builds from the fake server through JFAPI, the same path the sync task takes
+def test_build_from_server():
+    async def main():
+        server = FakeJellyfin(tracks=300, albumSize=12)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                lib = LibraryIndex()
+                assert not lib.ready
+                await lib.build(api, pageSize=50)
+                assert lib.ready and lib.lastSync
+                assert len(lib) == len(server.items)
+                res = lib.search('night', 25, ['Audio'])
+                assert res and all('night' in ' '.join((t.name, *t.artists)).casefold() for t in res)
+                assert lib.search('nigth', 25)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+# Searches during a rebuild see the old index until the new one is swapped in
+def test_load_swaps_whole_index():
+    lib = index(track('1', 'Before'))
+    old = lib.search('before')
+    lib.load([track('2', 'After')])
+    assert ids(old) == ['1']
+    assert lib.search('before') == [] and ids(lib.search('after')) == ['2']
+
+# A delta sync changes a copy, the version a search already holds stays as it was
+def test_update_copies_on_write():
+    lib = index(track('1', 'Night Drive'), track('2', 'River'))
+    before = lib._LibraryIndex__data
+    lib.update([track('1', 'Morning Drive'), track('3', 'Nightfall')])
+    assert 'nig' in before.trigrams and '1' in before.trigrams['nig']
+    assert ('night', '1') in before.words and '3' not in before.items
+    assert ids(lib.search('drive')) == ['1'] and ids(lib.search('night')) == ['3']
+    assert ids(lib.search('nigthfall')) == ['3']
+    # the same tables as loading everything at once
+    fresh = index(track('1', 'Morning Drive'), track('2', 'River'), track('3', 'Nightfall'))
+    assert lib._LibraryIndex__data.words == fresh._LibraryIndex__data.words
+
+def test_sync_changes_from_server():
+    async def main():
+        server = FakeJellyfin(tracks=120, albumSize=12)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                lib = LibraryIndex()
+                lib.load([track('old', 'Gone Soon')])
+                lib.lastSync = datetime.datetime.now(datetime.timezone.utc)
+                await lib.syncChanges(api, pageSize=50)
+                assert len(lib) == len(server.items) + 1
+                assert ids(lib.search('gone')) == ['old']
+        finally:
+            await server.stop()
+    asyncio.run(main())
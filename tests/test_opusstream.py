@@ -0,0 +1,171 @@
+import asyncio
+import struct
+
+import pytest
+
+from opusstream import FRAME_SAMPLES, OpusDemuxer, OpusHlsStream, Playlist, UnsupportedStream, resolvePlaylist
+from tests.fakejellyfin import initSegment, mediaSegment
+
+MASTER = '''#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=64000,CODECS="opus"
+low/main.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=128000,CODECS="opus"
+high/main.m3u8
+'''
+
+MEDIA = '''#EXTM3U
+#EXT-X-TARGETDURATION:3
+#EXT-X-MEDIA-SEQUENCE:5
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:3.000,
+seg0.mp4
+#EXTINF:3.000,
+seg1.mp4
+#EXT-X-ENDLIST
+'''
+
+# Serves fixed bodies by URL in place of JFAPI
+class FakeClient():
+    def __init__(self, resources: dict) -> None:
+        self.resources = resources
+        self.fetched = []
+        self.stopped = []
+
+    async def fetch(self, url: str) -> bytes:
+        self.fetched.append(url)
+        res = self.resources[url]
+        return res.encode() if isinstance(res, str) else res
+
+    async def stopTranscode(self, url: str):
+        self.stopped.append(url)
+
+def packets(count: int, tag: int) -> list[bytes]:
+    return [bytes([0xfc, tag, i]) for i in range(count)]
+
+def test_media_playlist():
+    playlist = Playlist(MEDIA, 'http://jf/Audio/1/main.m3u8?ApiKey=k')
+    assert playlist.init == 'http://jf/Audio/1/init.mp4'
+    assert playlist.segments == ['http://jf/Audio/1/seg0.mp4', 'http://jf/Audio/1/seg1.mp4']
+    assert playlist.ended and playlist.targetDuration == 3 and playlist.mediaSequence == 5
+    assert not playlist.variants
+
+def test_resolve_picks_highest_bandwidth():
+    client = FakeClient({'http://jf/a/master.m3u8': MASTER, 'http://jf/a/high/main.m3u8': MEDIA})
+    playlist, attrs = asyncio.run(resolvePlaylist(client, 'http://jf/a/master.m3u8'))
+    assert attrs == {'BANDWIDTH': '128000', 'CODECS': 'opus'}
+    assert playlist.url == 'http://jf/a/high/main.m3u8'
+    assert playlist.init == 'http://jf/a/high/init.mp4'
+
+def test_demux_packets():
+    demuxer = OpusDemuxer()
+    assert demuxer.feed(initSegment(3)) == []
+    assert demuxer.trackId == 3
+    first, second = packets(4, 1), packets(2, 2)
+    # two fragments in one segment
+    res = demuxer.feed(mediaSegment(first, 1, 3) + mediaSegment(second, 2, 3))
+    assert [p for p, _ in res] == first + second
+    assert all(duration == FRAME_SAMPLES for _, duration in res)
+
+def test_demux_skips_other_tracks():
+    demuxer = OpusDemuxer()
+    demuxer.feed(initSegment(1))
+    assert demuxer.feed(mediaSegment(packets(3, 1), 1, trackId=2)) == []
+
+def test_demux_rejects_fragment_before_init():
+    with pytest.raises(UnsupportedStream):
+        OpusDemuxer().feed(mediaSegment(packets(1, 1), 1))
+
+def test_demux_rejects_other_codecs():
+    init = initSegment().replace(b'Opus', b'mp4a')
+    with pytest.raises(UnsupportedStream):
+        OpusDemuxer().feed(init)
+
+# Missing boxes and fields cut short fail like any other unplayable stream
+def test_demux_rejects_malformed_boxes():
+    with pytest.raises(UnsupportedStream):
+        OpusDemuxer().feed(initSegment().replace(b'tkhd', b'free'))
+    demuxer = OpusDemuxer()
+    demuxer.feed(initSegment())
+    segment = bytearray(mediaSegment(packets(3, 1), 1))
+    # a trun claiming more samples than the segment holds
+    count = segment.index(b'trun') + 8
+    segment[count:count + 4] = struct.pack('>I', 1000)
+    with pytest.raises(UnsupportedStream):
+        demuxer.feed(bytes(segment))
+
+def stream(segments: list[bytes]) -> tuple[OpusHlsStream, FakeClient]:
+    base = 'http://jf/Audio/1/'
+    resources = {base + 'main.m3u8': MEDIA, base + 'init.mp4': segments[0]}
+    resources.update({f'{base}seg{i}.mp4': data for i, data in enumerate(segments[1:])})
+    client = FakeClient(resources)
+    return OpusHlsStream(client, base + 'main.m3u8'), client
+
+def test_stream_reads_all_segments():
+    async def main():
+        first, second = packets(5, 1), packets(5, 2)
+        source, _ = stream([initSegment(), mediaSegment(first, 1), mediaSegment(second, 2)])
+        assert await source.open() == first
+        assert [page async for page in source.packets()] == [second]
+        await source.close()
+    asyncio.run(main())
+
+# A stream closed part way stops its transcode, one read to the end leaves the finished job alone
+def test_stream_close_stops_transcode():
+    async def main():
+        segments = [initSegment(), mediaSegment(packets(5, 1), 1), mediaSegment(packets(5, 2), 2)]
+        source, client = stream(segments)
+        await source.open()
+        await source.close()
+        assert client.stopped == ['http://jf/Audio/1/main.m3u8']
+
+        source, client = stream(segments)
+        await source.open()
+        assert [page async for page in source.packets()]
+        await source.close()
+        assert client.stopped == []
+
+        # never opened, nothing was transcoded
+        source, client = stream(segments)
+        await source.close()
+        assert client.stopped == []
+    asyncio.run(main())
+
+# MPEG-TS or other non-fMP4 segments carry no moov, open must fail instead of reading the whole stream
+def test_stream_without_init_segment():
+    async def main():
+        ts = bytes([0x47]) + bytes(187)
+        source, client = stream([ts, ts, ts])
+        with pytest.raises(UnsupportedStream):
+            await source.open()
+        assert client.fetched == ['http://jf/Audio/1/main.m3u8', 'http://jf/Audio/1/init.mp4']
+    asyncio.run(main())
+
+def test_stream_codec_attribute():
+    async def main():
+        master = MASTER.replace('opus', 'mp4a.40.2')
+        client = FakeClient({'http://jf/a/master.m3u8': master, 'http://jf/a/high/main.m3u8': MEDIA})
+        with pytest.raises(UnsupportedStream):
+            await OpusHlsStream(client, 'http://jf/a/master.m3u8').open()
+    asyncio.run(main())
+
+def test_segment_durations():
+    playlist = Playlist(MEDIA, 'http://jf/Audio/1/main.m3u8')
+    assert playlist.durations == [3.0, 3.0]
+    assert playlist.locate(0) == (0, 0)
+    assert playlist.locate(4.5) == (1, 1.5)
+    assert playlist.locate(7) == (2, 0)
+    bare = Playlist(MEDIA.replace('#EXTINF:3.000,\n', '', 1), 'http://jf/Audio/1/main.m3u8')
+    assert bare.locate(4.5) == (0, 4.5)
+
+# Resuming part way into a track fetches the segment holding the offset and no earlier one
+def test_stream_offset_skips_segments():
+    async def main():
+        first, second = packets(5, 1), packets(5, 2)
+        base = 'http://jf/Audio/1/'
+        client = FakeClient({base + 'main.m3u8': MEDIA, base + 'init.mp4': initSegment(),
+                             base + 'seg0.mp4': mediaSegment(first, 1), base + 'seg1.mp4': mediaSegment(second, 2)})
+        source = OpusHlsStream(client, base + 'main.m3u8', offset=3.04)
+        assert await source.open() == second[2:]
+        assert base + 'seg0.mp4' not in client.fetched
+        assert [page async for page in source.packets()] == []
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+import asyncio
+
+from guildqueue import GuildQueue
+from jfapi import JFAPI, JFAPIItemError, Track
+from player import GuildPlayer, Players
+from streamhub import StreamHubs
+from tests.fakejellyfin import FakeJellyfin
+from tests.fakevoice import FakeChannel, FakeGuild, FakeVoiceClient
+
+def test_fetch_raises_item_error():
+    async def main():
+        server = FakeJellyfin(tracks=1, trackSeconds=1, segmentSeconds=1)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key', retries=0) as api:
+                try:
+                    await api.fetch(f'{url}/Audio/track000000/seg9.mp4')
+                except JFAPIItemError as e:
+                    assert e.status == 404
+                else:
+                    assert False, 'no error raised'
+                assert api.backends[0].breaker.state == 'closed'
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+# A deleted item in the queue is skipped, the tracks after it still play
+def test_player_skips_unplayable_tracks():
+    async def main():
+        server = FakeJellyfin(tracks=2, trackSeconds=0.2, segmentSeconds=0.1)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key', retries=0) as api:
+                players = Players(api, StreamHubs(asyncio.get_running_loop()), gapless=False)
+                tracks = await api.getItemsByIds(['track000000', 'track000001'])
+                missing = Track('deleted', 'Deleted', (), 'Audio', 1)
+                guild = FakeGuild(1, FakeVoiceClient(FakeChannel(1, 64000), frameLength=0.001))
+                players.queues[guild.id] = GuildQueue([missing, tracks[0], missing, tracks[1]])
+                players.play(guild)
+                await asyncio.wait_for(players.players[guild.id].task, 10)
+                players.shutdown()
+                assert [track for track, _ in guild.voice_client.starts] == [1, 2]
+                assert len(guild.voice_client.packets) == 2 * 10
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+# Resuming mid track opens the segment holding the offset instead of reading up to it
+def test_resume_offset():
+    async def main():
+        server = FakeJellyfin(tracks=1, trackSeconds=1, segmentSeconds=0.2)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                players = Players(api, StreamHubs(asyncio.get_running_loop()), gapless=False)
+                track = (await api.getItemsByIds(['track000000']))[0]
+                requests = server.requests
+                audio = await players.createAudioSource(track, 64000, 0.5)
+                # playlist, init and the third segment
+                assert server.requests - requests == 3
+                packets = await asyncio.to_thread(lambda: list(iter(audio.read, b'')))
+                assert len(packets) == 25
+                audio.cleanup()
+                players.shutdown()
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+# Parking a guild mid track ends the server transcode of the track it was playing
+def test_park_stops_transcode():
+    async def main():
+        # longer than the hub reads ahead, so the track is still transcoding when parked
+        server = FakeJellyfin(tracks=1, trackSeconds=60, segmentSeconds=1)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                hubs = StreamHubs(asyncio.get_running_loop())
+                players = Players(api, hubs, gapless=False)
+                guild = FakeGuild(1, FakeVoiceClient(FakeChannel(1, 64000)))
+                players.queues[guild.id] = GuildQueue(await api.getItemsByIds(['track000000']))
+                players.play(guild)
+                while not guild.voice_client.packets:
+                    await asyncio.sleep(0.01)
+                await players.park(guild)
+                for _ in range(100):
+                    if server.stopped:
+                        break
+                    await asyncio.sleep(0.02)
+                assert len(server.stopped) == 1
+                players.shutdown()
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+class FakeSource():
+    def __init__(self) -> None:
+        self.cleaned = False
+
+    def cleanup(self):
+        self.cleaned = True
+
+# Queue changes that keep the head while it is being prepared must not open it again
+def test_refresh_keeps_running_prepare():
+    async def main():
+        players = Players(None, gapless=True)
+        opens = []
+        async def createAudioSource(track, bitrate, offset=0):
+            opens.append(track.id)
+            await asyncio.sleep(0.05)
+            return FakeSource()
+        players.createAudioSource = createAudioSource
+        guild = FakeGuild(1, FakeVoiceClient(FakeChannel(1, 64000)))
+        player = GuildPlayer(players, guild)
+        head, other = Track('next', 'Next', (), 'Audio', 60), Track('other', 'Other', (), 'Audio', 60)
+        players.queues[guild.id] = GuildQueue([head])
+        player.schedulePrepare(0)
+        await asyncio.sleep(0.01)
+        players.queues[guild.id].append(other)
+        player.refreshPrepared()
+        await asyncio.sleep(0.1)
+        assert opens == ['next'] and player.prepared[0] is head
+
+        # a new head is opened in place of the old one
+        players.queues[guild.id].appendleft(other)
+        player.refreshPrepared()
+        await asyncio.sleep(0.1)
+        assert opens == ['next', 'other'] and player.prepared[0] is other
+    asyncio.run(main())
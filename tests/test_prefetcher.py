@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+
+from guildqueue import GuildQueue
+from jfapi import JFAPI
+from player import GuildPlayer, Players
+from prefetcher import Prefetcher, WarmPlaylists
+from segmentcache import SegmentCache
+from streamhub import StreamHubs
+from tests.fakejellyfin import FakeJellyfin
+from tests.fakevoice import FakeChannel, FakeGuild, FakeVoiceClient
+
+# A guild playing its first track elapsed seconds in, with the second one up next
+def playing(players: Players, tracks: list, elapsed: float, paused: bool = False) -> GuildPlayer:
+    guild = FakeGuild(1, FakeVoiceClient(FakeChannel(1, 64000)))
+    player = GuildPlayer(players, guild)
+    players.players[guild.id] = player
+    players.queues[guild.id] = GuildQueue(tracks[1:])
+    players.playing[guild.id] = {'track': tracks[0], 'playtime-offset': datetime.timedelta(seconds=elapsed),
+                                 'starttime': datetime.datetime.now(), 'paused': paused, 'channel': 1}
+    return player
+
+def run(test, ttl: float = 60, gapless: bool = False, cache: SegmentCache = None):
+    async def main():
+        server = FakeJellyfin(tracks=2, trackSeconds=120, segmentSeconds=60)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key') as api:
+                playlists = WarmPlaylists(ttl)
+                players = Players(api, StreamHubs(asyncio.get_running_loop()), cache, gapless=gapless,
+                                  lookahead=15, playlists=playlists)
+                prefetcher = Prefetcher(api, players, playlists)
+                tracks = await api.getItemsByIds(['track000000', 'track000001'])
+                await test(server, players, prefetcher, playlists, tracks)
+        finally:
+            await server.stop()
+    asyncio.run(main())
+
+def test_not_warmed_long_before_the_end():
+    async def test(server, players, prefetcher, playlists, tracks):
+        playing(players, tracks, 30)
+        requests = server.requests
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) == float('inf')
+        assert server.requests == requests
+    run(test)
+
+def test_warmed_near_the_end():
+    async def test(server, players, prefetcher, playlists, tracks):
+        playing(players, tracks, 100)
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) < 1
+        # fresh, not fetched again
+        requests = server.requests
+        await prefetcher.warmPlaylist(1)
+        assert server.requests == requests
+        url, playlist, attrs = playlists.take((tracks[1].id, 64000))
+        assert playlist.segments and tracks[1].id in url
+    run(test)
+
+def test_gapless_warms_ahead_of_the_lookahead():
+    async def test(server, players, prefetcher, playlists, tracks):
+        player = playing(players, tracks, 80)
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) < 1
+        # once gapless playback is preparing the next track it is left alone
+        playlists.take((tracks[1].id, 64000))
+        player.prepareWindow = True
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) == float('inf')
+    run(test, gapless=True)
+
+def test_rewarmed_when_going_stale():
+    async def test(server, players, prefetcher, playlists, tracks):
+        playing(players, tracks, 119.9)
+        await prefetcher.warmPlaylist(1)
+        requests = server.requests
+        await asyncio.sleep(0.15)
+        await prefetcher.warmPlaylist(1)
+        assert server.requests > requests
+        assert playlists.age((tracks[1].id, 64000)) < 0.1
+    run(test, ttl=0.2)
+
+def test_paused_and_cached_tracks_are_skipped(tmp_path):
+    cache = SegmentCache(str(tmp_path), 1 << 20)
+    async def test(server, players, prefetcher, playlists, tracks):
+        playing(players, tracks, 100, paused=True)
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) == float('inf')
+
+        playing(players, tracks, 100)
+        writer = cache.writer(tracks[1].id, 64000)
+        writer.add(b'segment')
+        writer.commit()
+        requests = server.requests
+        await prefetcher.warmPlaylist(1)
+        assert playlists.age((tracks[1].id, 64000)) == float('inf')
+        assert server.requests == requests
+    run(test, cache=cache)
+
+def test_scan_submits_due_guilds():
+    async def test(server, players, prefetcher, playlists, tracks):
+        playing(players, tracks, 30)
+        prefetcher.scan()
+        # only the metadata job, the playlist is not due
+        assert prefetcher.stats()['pending'] == 1
+        players.playing[1]['playtime-offset'] = datetime.timedelta(seconds=100)
+        prefetcher.scan()
+        assert prefetcher.stats()['pending'] == 2
+    run(test)
@@ -0,0 +1,68 @@
+import asyncio
+
+from jfapi import JFAPI
+from searchcache import SearchCache
+from tests.fakejellyfin import FakeJellyfin
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_hit_returns_a_copy():
+    async def main():
+        cache = SearchCache(4, 60)
+        calls = []
+        async def fetch():
+            calls.append(1)
+            return [1, 2, 3]
+        first = await cache.get('a', fetch)
+        first.append(4)
+        assert await cache.get('a', fetch) == [1, 2, 3]
+        assert len(calls) == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+    run(main())
+
+def test_concurrent_lookups_coalesce():
+    async def main():
+        cache = SearchCache(4, 60)
+        calls = []
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return ['x']
+        results = await asyncio.gather(*(cache.get('k', fetch) for _ in range(5)))
+        assert results == [['x']] * 5
+        assert len(calls) == 1
+        assert cache.coalesced == 4
+    run(main())
+
+def test_lru_eviction_and_expiry():
+    async def main():
+        cache = SearchCache(2, 60)
+        async def fetch():
+            return []
+        for key in 'abc':
+            await cache.get(key, fetch)
+        assert len(cache) == 2 and cache.evictions == 1
+        expired = SearchCache(2, 0)
+        await expired.get('a', fetch)
+        await expired.get('a', fetch)
+        assert expired.expirations == 1 and expired.hits == 0
+    run(main())
+
+# An empty cache is falsy, JFAPI.search must still go through it
+def test_jfapi_search_uses_empty_cache():
+    async def main():
+        server = FakeJellyfin(tracks=50, albumSize=10)
+        url = await server.start()
+        try:
+            async with JFAPI(url, 'key', cacheSize=8) as api:
+                assert len(api.searchCache) == 0
+                first = await api.search('night', 10, ['Audio'])
+                requests = server.requests
+                second = await api.search('  NIGHT ', 10, ['Audio'])
+                assert [t.id for t in first] == [t.id for t in second]
+                assert server.requests == requests
+                assert api.searchCache.hits == 1
+        finally:
+            await server.stop()
+    run(main())
@@ -0,0 +1,100 @@
+import asyncio
+import os
+
+import pytest
+
+from opusstream import OpusHlsStream, UnsupportedStream
+from segmentcache import MANIFEST, SegmentCache
+from tests.fakejellyfin import initSegment, mediaSegment
+from tests.test_opusstream import MEDIA, FakeClient
+
+def write(cache: SegmentCache, itemId: str, segments: list[bytes]):
+    writer = cache.writer(itemId, 128000)
+    for data in segments:
+        writer.add(data)
+    writer.commit()
+
+def read(cache: SegmentCache, itemId: str) -> list[bytes] | None:
+    maps = cache.lookup(itemId, 128000)
+    if maps is None:
+        return None
+    res = [bytes(m) for m in maps]
+    for m in maps:
+        m.close()
+    return res
+
+def test_commit_and_lookup(tmp_path):
+    cache = SegmentCache(str(tmp_path), 1 << 20)
+    assert read(cache, 'a') is None
+    write(cache, 'a', [b'init', b'one', b'two'])
+    assert read(cache, 'a') == [b'init', b'one', b'two']
+    assert cache.lookup('a', 64000) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert os.listdir(tmp_path) == [SegmentCache.key('a', 128000)]
+
+def test_abort_leaves_nothing(tmp_path):
+    cache = SegmentCache(str(tmp_path), 1 << 20)
+    writer = cache.writer('a', 128000)
+    writer.add(b'data')
+    writer.abort()
+    assert os.listdir(tmp_path) == []
+    assert read(cache, 'a') is None
+
+def test_eviction(tmp_path):
+    cache = SegmentCache(str(tmp_path), 2000)
+    for itemId in 'abc':
+        write(cache, itemId, [bytes(800)])
+    assert read(cache, 'a') is None
+    assert read(cache, 'c') == [bytes(800)]
+    assert cache.evictions == 1
+
+def test_rescan(tmp_path):
+    cache = SegmentCache(str(tmp_path), 1 << 20)
+    write(cache, 'a', [b'kept'])
+    # interrupted before the manifest was written
+    cache.writer('b', 128000).add(b'partial')
+    # interrupted between the manifest and the rename
+    cache.writer('c', 128000).add(b'orphan')
+    tmpdir = next(name for name in os.listdir(tmp_path) if name.startswith(f'.tmp-{SegmentCache.key("c", 128000)}'))
+    open(os.path.join(tmp_path, tmpdir, MANIFEST), 'w').write('["00000.mp4"]')
+    # plain directory without a manifest
+    os.makedirs(tmp_path / 'stray')
+
+    reopened = SegmentCache(str(tmp_path), 1 << 20)
+    assert os.listdir(tmp_path) == [SegmentCache.key('a', 128000)]
+    assert read(reopened, 'a') == [b'kept']
+    assert reopened.stats()['entries'] == 1
+
+def test_unsupported_stream_is_not_cached(tmp_path):
+    async def main():
+        cache = SegmentCache(str(tmp_path), 1 << 20)
+        ts = bytes([0x47]) + bytes(187)
+        base = 'http://jf/Audio/1/'
+        client = FakeClient({base + 'main.m3u8': MEDIA, base + 'init.mp4': ts,
+                             base + 'seg0.mp4': ts, base + 'seg1.mp4': ts})
+        source = OpusHlsStream(client, base + 'main.m3u8', cache, ('1', 128000))
+        with pytest.raises(UnsupportedStream):
+            await source.open()
+        assert os.listdir(tmp_path) == []
+        assert read(cache, '1') is None
+    asyncio.run(main())
+
+def test_stream_is_cached_once_complete(tmp_path):
+    async def main():
+        cache = SegmentCache(str(tmp_path), 1 << 20)
+        base = 'http://jf/Audio/1/'
+        segments = [initSegment(), mediaSegment([b'\xfc\x01'], 1), mediaSegment([b'\xfc\x02'], 2)]
+        client = FakeClient({base + 'main.m3u8': MEDIA, base + 'init.mp4': segments[0],
+                             base + 'seg0.mp4': segments[1], base + 'seg1.mp4': segments[2]})
+        source = OpusHlsStream(client, base + 'main.m3u8', cache, ('1', 128000))
+        assert await source.open() == [b'\xfc\x01']
+        assert read(cache, '1') is None
+        assert [page async for page in source.packets()] == [[b'\xfc\x02']]
+        assert read(cache, '1') == segments
+
+        cached = OpusHlsStream(client, base + 'main.m3u8', cache, ('1', 128000))
+        fetched = len(client.fetched)
+        assert await cached.open() == [b'\xfc\x01']
+        assert [page async for page in cached.packets()] == [[b'\xfc\x02']]
+        assert len(client.fetched) == fetched
+    asyncio.run(main())
@@ -0,0 +1,141 @@
+import asyncio
+import random
+
+from guildqueue import GuildQueue
+from jfapi import Track
+from statestore import StateStore
+
+def track(id: str) -> Track:
+    return Track(id, id, (), 'Audio', 180)
+
+def store(tmp_path) -> StateStore:
+    res = StateStore(str(tmp_path / 'state.db'))
+    res.open()
+    return res
+
+def test_round_trip(tmp_path):
+    async def main():
+        first = store(tmp_path)
+        assert first.load() == {}
+        queues = {1: GuildQueue([track('a'), track('b')]), 2: GuildQueue([track('c')])}
+        await first.flush(queues, {1: ('x', 12.5, 100)})
+        first.close()
+
+        second = store(tmp_path)
+        saved = second.load()
+        assert saved == {1: {'queue': ['a', 'b'], 'item': 'x', 'offset': 12.5, 'channel': 100},
+                         2: {'queue': ['c'], 'item': None, 'offset': 0, 'channel': None}}
+        assert second.pending == {1, 2}
+        assert second.load(lambda guild: guild == 2) == {2: saved[2]}
+        second.close()
+    asyncio.run(main())
+
+def test_unchanged_queues_are_not_rewritten(tmp_path):
+    async def main():
+        db = store(tmp_path)
+        db.load()
+        queues = {1: GuildQueue([track('a')])}
+        await db.flush(queues, {})
+        await db.flush(queues, {})
+        assert db.flushes == 1
+        queues[1].append(track('b'))
+        await db.flush(queues, {})
+        assert db.flushes == 2
+        # a cleared queue and a stopped player are deleted
+        del queues[1]
+        await db.flush(queues, {})
+        assert db.load() == {}
+        db.close()
+    asyncio.run(main())
+
+# Rows of a guild waiting to be restored are left alone, whatever the bot holds for it meanwhile
+def test_pending_guilds(tmp_path):
+    async def main():
+        db = store(tmp_path)
+        db.load()
+        await db.flush({1: GuildQueue([track('a')]), 2: GuildQueue([track('b')])}, {1: ('a', 5, 10)})
+        db.load()
+        await db.flush({}, {})
+        assert set(db.load()) == {1, 2}
+
+        db.restored(1)
+        queues = {1: GuildQueue([track('c')])}
+        await db.flush(queues, {})
+        saved = db.load()
+        assert saved[1]['queue'] == ['c'] and saved[1]['item'] is None
+        assert saved[2]['queue'] == ['b']
+        db.close()
+    asyncio.run(main())
+
+# A guild that could not be restored saves new state again, its old rows stay until it does
+def test_abandoned_guilds(tmp_path):
+    async def main():
+        db = store(tmp_path)
+        db.load()
+        await db.flush({1: GuildQueue([track('a')]), 2: GuildQueue([track('b')])}, {1: ('a', 5, 10)})
+        db.load()
+        db.abandon(db.pending)
+        assert not db.pending
+        await db.flush({}, {})
+        assert set(db.load()) == {1, 2}
+
+        db.abandon(db.pending)
+        await db.flush({2: GuildQueue([track('d')])}, {})
+        saved = db.load()
+        assert saved[1] == {'queue': ['a'], 'item': 'a', 'offset': 5, 'channel': 10}
+        assert saved[2]['queue'] == ['d']
+        assert db.stats()['pending-restore'] == 2
+        db.close()
+    asyncio.run(main())
+
+# Taking the head or adding at either end writes only the rows that changed
+def test_queue_changes_write_rows(tmp_path):
+    async def main():
+        db = store(tmp_path)
+        db.load()
+        queue = GuildQueue(track(str(i)) for i in range(1000))
+        await db.flush({1: queue}, {})
+        assert db.rowsWritten == 1000
+        for _ in range(3):
+            queue.popleft()
+        queue.append(track('end'))
+        queue.appendleft(track('front'))
+        queue.pop()
+        await db.flush({1: queue}, {})
+        assert db.rowsWritten == 1002
+        assert db.load()[1]['queue'] == ['front'] + [str(i) for i in range(3, 1000)]
+        db.close()
+    asyncio.run(main())
+
+# Whatever the mix of changes, the saved queue reads back the same as the one in memory
+def test_random_queue_changes(tmp_path):
+    async def main():
+        rng = random.Random(7)
+        db, reader = store(tmp_path), store(tmp_path)
+        db.load()
+        queue = GuildQueue(track(str(i)) for i in range(20))
+        serial = 20
+        for _ in range(60):
+            for _ in range(rng.randint(1, 8)):
+                op = rng.random()
+                if op < 0.25:
+                    queue.extend(track(str(serial + i)) for i in range(rng.randint(1, 3)))
+                    serial += 3
+                elif op < 0.4:
+                    queue.appendleft(track(str(serial)))
+                    serial += 1
+                elif op < 0.7 and queue:
+                    queue.popleft()
+                elif op < 0.8 and queue:
+                    queue.pop()
+                elif op < 0.9 and len(queue) > 2:
+                    queue.pop(rng.randrange(1, len(queue) - 1))
+                elif op < 0.95:
+                    queue.shuffle()
+            await db.flush({1: queue}, {})
+            # read back through a second store, loading resets what this one tracks
+            saved = reader.load()
+            assert saved.get(1, {'queue': []})['queue'] == [t.id for t in queue]
+        db.close()
+        reader.close()
+    asyncio.run(main())
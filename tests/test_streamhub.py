@@ -0,0 +1,122 @@
+import asyncio
+
+from jfapi import JFAPI
+from streamhub import StreamHubs
+
+# Stands in for OpusHlsStream, packets are numbered so order can be checked
+class FakeStream():
+    def __init__(self, pages: int, perPage: int) -> None:
+        self.pages = [[f'{p}:{i}'.encode() for i in range(perPage)] for p in range(pages)]
+        self.closed = False
+
+    async def open(self) -> list[bytes]:
+        return self.pages[0]
+
+    async def packets(self):
+        for page in self.pages[1:]:
+            await asyncio.sleep(0)
+            yield page
+
+    async def close(self):
+        self.closed = True
+
+def expected(stream: FakeStream) -> list[bytes]:
+    return [packet for page in stream.pages for packet in page]
+
+async def readAll(listener, count: int) -> list[bytes]:
+    return await asyncio.to_thread(lambda: [listener.read() for _ in range(count)])
+
+def test_shared_listeners_read_every_packet():
+    async def main():
+        hubs = StreamHubs(asyncio.get_running_loop(), ringSize=10, buffer=5, readTimeout=2)
+        stream = FakeStream(20, 5)
+        first = await hubs.listen(('a', 1), stream)
+        second = await hubs.listen(('a', 1), FakeStream(1, 1))
+        assert hubs.stats()['shared'] == 1
+        packets = expected(stream)
+        res = await asyncio.gather(readAll(first, len(packets)), readAll(second, len(packets)))
+        assert res == [packets, packets]
+        assert first.read() == b''
+        first.cleanup()
+        second.cleanup()
+        assert hubs.stats()['hubs'] == 0
+    asyncio.run(main())
+
+# A listener that stops reading while another plays on must not lose its place
+def test_paused_listener_keeps_its_place():
+    async def main():
+        hubs = StreamHubs(asyncio.get_running_loop(), ringSize=10, buffer=5, readTimeout=2)
+        stream = FakeStream(20, 5)
+        playing = await hubs.listen(('a', 1), stream)
+        paused = await hubs.listen(('a', 1), FakeStream(1, 1))
+        packets = expected(stream)
+        assert await readAll(paused, 3) == packets[:3]
+        assert await readAll(playing, len(packets)) == packets
+        assert await readAll(paused, len(packets) - 3) == packets[3:]
+        playing.cleanup()
+        paused.cleanup()
+    asyncio.run(main())
+
+def test_late_listener_gets_its_own_hub():
+    async def main():
+        hubs = StreamHubs(asyncio.get_running_loop(), ringSize=10, buffer=5, readTimeout=2)
+        stream = FakeStream(20, 5)
+        first = await hubs.listen(('a', 1), stream)
+        await readAll(first, 60)
+        late = FakeStream(2, 5)
+        second = await hubs.listen(('a', 1), late)
+        assert second.hub is not first.hub
+        assert await readAll(second, 10) == expected(late)
+        first.cleanup()
+        second.cleanup()
+    asyncio.run(main())
+
+def test_read_timeout_outlasts_retries():
+    client = JFAPI('http://jf', 'key', timeout=15, retries=2, retryBackoff=0.5)
+    assert client.fetchDeadline >= 15 * 3 + 0.5 * 1.5 + 1 * 1.5
+
+# Stands in for a stream whose open waits on the server
+class SlowStream(FakeStream):
+    def __init__(self, pages: int, perPage: int) -> None:
+        super().__init__(pages, perPage)
+        self.opened = asyncio.Event()
+
+    async def open(self) -> list[bytes]:
+        await self.opened.wait()
+        return await super().open()
+
+# The guild that opened a hub moving on must not cancel the guilds waiting on it
+def test_opener_cancelled_while_another_waits():
+    async def main():
+        hubs = StreamHubs(asyncio.get_running_loop(), ringSize=10, buffer=5, readTimeout=2)
+        stream = SlowStream(4, 5)
+        opener = asyncio.create_task(hubs.listen(('a', 1), stream))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hubs.listen(('a', 1), FakeStream(1, 1)))
+        await asyncio.sleep(0)
+        opener.cancel()
+        await asyncio.sleep(0)
+        stream.opened.set()
+        listener = await waiter
+        packets = expected(stream)
+        assert await readAll(listener, len(packets)) == packets
+        assert opener.cancelled() and hubs.stats()['listeners'] == 1
+        listener.cleanup()
+    asyncio.run(main())
+
+# With nobody left waiting the open is abandoned
+def test_open_cancelled_with_its_last_listener():
+    async def main():
+        hubs = StreamHubs(asyncio.get_running_loop(), ringSize=10, buffer=5, readTimeout=2)
+        stream = SlowStream(4, 5)
+        opener = asyncio.create_task(hubs.listen(('a', 1), stream))
+        await asyncio.sleep(0.01)
+        opener.cancel()
+        await asyncio.sleep(0.01)
+        assert opener.cancelled() and hubs.stats()['hubs'] == 0
+        # the next play of the key opens a hub of its own
+        fresh = FakeStream(2, 5)
+        listener = await hubs.listen(('a', 1), fresh)
+        assert await readAll(listener, 10) == expected(fresh)
+        listener.cleanup()
+    asyncio.run(main())